@@ -0,0 +1,59 @@
+import itertools
+import threading
+
+from setup import OTTAI_ACCOUNTS, OTTAI_RATE_LIMIT, OTTAI_RATE_BURST, get_common_ottai_headers
+from ratelimit import TokenBucket
+
+# ========== АККАУНТЫ ФОЛЛОВЕРОВ ==========
+# Один процесс обслуживает несколько аккаунтов фолловеров (OTTAI_TOKEN и
+# OTTAI_TOKEN__<имя>). У каждого аккаунта свои сервер (Ottai или Syai),
+# лимитер запросов, список мастеров и HTTP-сессия Ottai; планировщик и
+# потоки движка общие, мастера разных аккаунтов чередуются
+
+class OttaiAccount:
+    """Аккаунт фолловера: токен, сервер API и его собственные лимитер и список мастеров"""
+
+    def __init__(self, config):
+        self.config = config
+        self.name = config['name']
+        self.base_url = config['base_url']
+        self.customer_id = config['customer_id']
+        self.limiter = TokenBucket(OTTAI_RATE_LIMIT, OTTAI_RATE_BURST)
+        # Список мастеров: данные, время последнего обновления, фоновое
+        # обновление (идёт ли и когда повторить после ошибки)
+        self.user_cache = {
+            'data': None,
+            'timestamp': 0,
+            'refreshing': False,
+            'retry_at': 0,
+            'lock': threading.Lock()
+        }
+
+    def headers(self):
+        """Заголовки запроса к Ottai (timestamp и traceid — новые при каждом вызове)"""
+        return get_common_ottai_headers(self.config)
+
+_accounts = {config['name']: OttaiAccount(config) for config in OTTAI_ACCOUNTS}
+
+def get_accounts():
+    """Все аккаунты в порядке настройки (OTTAI_TOKEN первым)"""
+    return list(_accounts.values())
+
+def get_account(name=None):
+    """Аккаунт по имени; без имени (или неизвестное имя) — первый аккаунт"""
+    account = _accounts.get(name) if name else None
+    return account or next(iter(_accounts.values()))
+
+def fair_order(users):
+    """
+    Мастера, чередующиеся по аккаунтам (по кругу, порядок внутри аккаунта
+    сохраняется): большой аккаунт не занимает общие потоки целиком
+    """
+    groups = {}
+    for user_info in users:
+        groups.setdefault(user_info.get('account'), []).append(user_info)
+
+    if len(groups) < 2:
+        return list(users)
+    return [user_info for row in itertools.zip_longest(*groups.values())
+            for user_info in row if user_info is not None]
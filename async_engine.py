@@ -0,0 +1,428 @@
+import asyncio
+import atexit
+import threading
+import logging
+import time
+from urllib.parse import urlparse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from setup import (
+    CONFIG, DISABLE_SSL_VERIFY, OUTBOX_DRAIN_BATCH,
+    ASYNC_MAX_CONCURRENCY, ASYNC_PER_HOST_LIMIT
+)
+from json_stream import CurveListStreamParser
+from module import (
+    OTTAI_STREAM_CHUNK_SIZE, OTTAI_THROTTLE_RETRIES, OTTAI_COALESCE_SLACK_MS,
+    CHUNK_SENT, CHUNK_FAILED, GZIP_REJECTED_STATUSES, gzip_fallback_needed,
+    master_start_offset, ottai_slot_delay, ottai_account_paused, throttle_ottai, items_in_window,
+    create_user_config, extract_curve_list,
+    get_cached_nightscout_status, store_nightscout_status,
+    nightscout_last_entry_request, parse_nightscout_last_date,
+    plan_sync_window, select_new_entries, enqueue_new_entries,
+    begin_outbox_drain, end_outbox_drain, acknowledge_outbox, log_outbox_drain,
+    iter_entry_chunks, encode_nightscout_body, remember_gzip_support
+)
+from state import load_outbox
+from log import get_logger, master_context
+import metrics
+import profiling
+from circuit import get_breaker, is_server_error, CircuitOpenError
+
+logger = get_logger('async_engine')
+
+# ========== ASYNCIO-ДВИЖОК ЦИКЛА СИНХРОНИЗАЦИИ ==========
+# Включается SYNC_ENGINE=async (нужен пакет aiohttp).
+# Логика окна, дедупликации, подготовки записей и отметок общая с потоковым
+# движком (module.py) — отличается только сетевой ввод-вывод
+
+# Event loop и HTTP-сессия живут между циклами, чтобы переиспользовать соединения
+_async_runtime = {
+    'loop': None,
+    'http': None,
+    'lock': threading.Lock()
+}
+
+# Выполняющиеся запросы данных Ottai (в event loop): from_user_id -> [(start, end, future)]
+_ottai_flights = {}
+
+def async_engine_available():
+    """Доступен ли asyncio-движок (установлен ли aiohttp)"""
+    return aiohttp is not None
+
+def run_async_cycle(configured_users, deadline=None):
+    """
+    Обработка всех настроенных мастеров в asyncio-движке.
+    deadline — момент time.monotonic(), после которого незавершённые задачи отменяются.
+    Возвращает количество отправленных записей
+    """
+    with _async_runtime['lock']:
+        if _async_runtime['loop'] is None:
+            _async_runtime['loop'] = asyncio.new_event_loop()
+        loop = _async_runtime['loop']
+        return loop.run_until_complete(_process_all_users_async(configured_users, deadline))
+
+def close_async_engine():
+    """Закрытие HTTP-сессии и event loop"""
+    with _async_runtime['lock']:
+        loop = _async_runtime['loop']
+        if loop is None:
+            return
+        if _async_runtime['http'] is not None:
+            loop.run_until_complete(_async_runtime['http'].close())
+            _async_runtime['http'] = None
+        loop.close()
+        _async_runtime['loop'] = None
+
+atexit.register(close_async_engine)
+
+def _get_http():
+    """HTTP-сессия aiohttp с глобальным лимитом и лимитом на хост"""
+    if _async_runtime['http'] is None:
+        connector = aiohttp.TCPConnector(
+            limit=ASYNC_MAX_CONCURRENCY,
+            limit_per_host=ASYNC_PER_HOST_LIMIT,
+            ssl=False if DISABLE_SSL_VERIFY else None
+        )
+        _async_runtime['http'] = aiohttp.ClientSession(connector=connector)
+    return _async_runtime['http']
+
+async def _process_all_users_async(configured_users, deadline):
+    http = _get_http()
+    tasks = [asyncio.ensure_future(_process_user_async(http, user_info)) for user_info in configured_users]
+    if not tasks:
+        return 0
+
+    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+
+    if pending:
+        logger.warning("⏱️ Дедлайн цикла: отменено мастеров: %d", len(pending))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    return sum(task.result() for task in done)
+
+async def _request(http, method, url, timeout, read_json=True, **kwargs):
+    """
+    HTTP-запрос; при SSL-ошибке повторяем без проверки сертификата.
+    read_json=False — тело успешного ответа не разбирается.
+    Возвращает (status, json или None)
+    """
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    try:
+        async with http.request(method, url, timeout=client_timeout, **kwargs) as response:
+            return response.status, await _read_json(response, read_json)
+    except aiohttp.ClientSSLError as e:
+        logger.warning("SSL ошибка (%s): %s", url, e)
+        async with http.request(method, url, timeout=client_timeout, ssl=False, **kwargs) as response:
+            return response.status, await _read_json(response, read_json)
+
+async def _read_json(response, read_json=True):
+    if response.status == 200 and not read_json:
+        await response.release()
+        return None
+    if response.status != 200:
+        if logger.isEnabledFor(logging.DEBUG):
+            text = await response.text()
+            if text:
+                logger.debug("Тело ответа: %s", text[:200])
+        return None
+    try:
+        return await response.json(content_type=None)
+    except ValueError:
+        return None
+
+async def _check_nightscout_async(http, user_config):
+    """Аналог _check_nightscout_connection_raw: (доступен, date последней записи)"""
+    url, params = nightscout_last_entry_request(user_config)
+    breaker = get_breaker(user_config['ns_url'])
+    try:
+        breaker.before_request()
+    except CircuitOpenError as e:
+        logger.warning("Nightscout: %s", e)
+        return False, None
+
+    try:
+        status, data = await _request(http, 'GET', url, 10,
+                                      headers=user_config['ns_header'],
+                                      params={key: str(value) for key, value in params.items()})
+    except Exception as e:
+        breaker.record_failure(type(e).__name__)
+        logger.warning("Ошибка при проверке Nightscout: %s", e)
+        return False, None
+
+    if is_server_error(status):
+        breaker.record_failure(f"HTTP {status}")
+    else:
+        breaker.record_success()
+
+    if status != 200:
+        logger.warning("Проверка Nightscout: HTTP %s", status)
+        return False, None
+
+    return True, parse_nightscout_last_date(data)
+
+async def _get_ottai_data_async(http, user_config, start_time, end_time):
+    """
+    Аналог get_ottai_data_batch: одновременный запрос того же мастера с покрывающим
+    окном не повторяется — используется результат уже выполняющегося.
+    None — окно не загружено
+    """
+    user_id = str(user_config['from_user_id'])
+    flights = _ottai_flights.setdefault(user_id, [])
+    for flight_start, flight_end, future in flights:
+        if flight_start <= start_time and flight_end + OTTAI_COALESCE_SLACK_MS >= end_time:
+            curve_list = await asyncio.shield(future)
+            if curve_list is not None:
+                metrics.OTTAI_COALESCED.inc()
+                logger.debug("Запрос данных Ottai объединён с уже выполняющимся")
+                return list(items_in_window(curve_list, start_time, end_time))
+            # Ведущий запрос отменён или не удался — загружаем сами
+            return await _fetch_ottai_data_async(http, user_config, start_time, end_time)
+
+    flight = (start_time, end_time, asyncio.get_running_loop().create_future())
+    flights.append(flight)
+    try:
+        curve_list = await _fetch_ottai_data_async(http, user_config, start_time, end_time)
+        flight[2].set_result(curve_list)
+        return curve_list
+    finally:
+        if not flight[2].done():
+            flight[2].set_result(None)
+        flights.remove(flight)
+        if not flights:
+            del _ottai_flights[user_id]
+
+async def _fetch_ottai_data_async(http, user_config, start_time, end_time):
+    """
+    Запрос окна к Ottai через лимитер аккаунта; на 429 — пауза по Retry-After и повтор.
+    Возвращает записи или None, если окно не загружено (ошибка, пауза аккаунта)
+    """
+    url = f"{user_config['account'].base_url}/link/application/search/tag/queryMonitorBase"
+    params = {
+        'fromUserId': str(user_config['from_user_id']),
+        'isOpen': '0',
+        'startTime': str(start_time),
+        'endTime': str(end_time)
+    }
+    client_timeout = aiohttp.ClientTimeout(total=CONFIG['request_timeout'])
+    kwargs = {'headers': user_config['ottai_headers'], 'params': params, 'timeout': client_timeout}
+
+    started = time.monotonic()
+    try:
+        for attempt in range(OTTAI_THROTTLE_RETRIES + 1):
+            if ottai_account_paused(user_config['account']):
+                return None
+            await asyncio.sleep(ottai_slot_delay(user_config['account']))
+            try:
+                with profiling.span('ottai_fetch'):
+                    status, retry_after, curve_list = await _read_ottai_stream(http.get(url, **kwargs))
+            except aiohttp.ClientSSLError as e:
+                logger.warning("SSL ошибка (%s): %s", url, e)
+                with profiling.span('ottai_fetch'):
+                    status, retry_after, curve_list = await _read_ottai_stream(http.get(url, ssl=False, **kwargs))
+
+            if status != 429 or attempt == OTTAI_THROTTLE_RETRIES:
+                if status != 200:
+                    logger.error("Ошибка запроса Ottai: %s", status)
+                    return None
+                return curve_list
+            throttle_ottai(user_config['account'], retry_after)
+    except Exception as e:
+        logger.error("Ошибка при загрузке данных Ottai: %s", e)
+        return None
+    finally:
+        metrics.OTTAI_FETCH_DURATION.observe(time.monotonic() - started, config_key=user_config['config_key'])
+
+async def _read_ottai_stream(request):
+    """Чтение ответа Ottai потоком: (статус, Retry-After, записи curveList)"""
+    async with request as response:
+        if response.status != 200:
+            return response.status, response.headers.get('Retry-After'), []
+
+        parser = CurveListStreamParser(fallback=extract_curve_list)
+        curve_list = []
+        async for chunk in response.content.iter_chunked(OTTAI_STREAM_CHUNK_SIZE):
+            with profiling.span('json_decode'):
+                curve_list.extend(parser.feed(chunk))
+        with profiling.span('json_decode'):
+            curve_list.extend(parser.close())
+        return response.status, None, curve_list
+
+async def _post_to_nightscout_async(http, user_config, url, payload):
+    """
+    Аналог _post_to_nightscout: POST через breaker хоста с учётом в метриках,
+    сжатием тела и повтором без сжатия, если сервер отверг gzip
+    """
+    breaker = get_breaker(user_config['ns_url'])
+    breaker.before_request()
+
+    started = time.monotonic()
+    status = 'error'
+    try:
+        body, headers = encode_nightscout_body(user_config, payload)
+        status, _ = await _request(http, 'POST', url, CONFIG['request_timeout'], read_json=False,
+                                   headers=headers, data=body)
+
+        if 'Content-Encoding' in headers:
+            if gzip_fallback_needed(user_config['ns_url'], status):
+                rejected = status in GZIP_REJECTED_STATUSES
+                body, headers = encode_nightscout_body(user_config, payload, compress=False)
+                status, _ = await _request(http, 'POST', url, CONFIG['request_timeout'], read_json=False,
+                                           headers=headers, data=body)
+                if rejected and status < 300:
+                    remember_gzip_support(user_config['ns_url'], False)
+            elif status < 300:
+                remember_gzip_support(user_config['ns_url'], True)
+        if is_server_error(status):
+            breaker.record_failure(f"HTTP {status}")
+        else:
+            breaker.record_success()
+        return status
+    except Exception as e:
+        breaker.record_failure(type(e).__name__)
+        raise
+    finally:
+        metrics.NIGHTSCOUT_POST_DURATION.observe(time.monotonic() - started, config_key=user_config['config_key'])
+        metrics.NIGHTSCOUT_RESPONSES.inc(config_key=user_config['config_key'], status=status)
+
+async def _send_chunk_async(http, user_config, url, payload, retries):
+    """
+    Отправка пачки (или одной записи) с повторами — те же правила, что и в _send_chunk.
+    Возвращает CHUNK_SENT, CHUNK_REJECTED или CHUNK_FAILED
+    """
+    for attempt in range(retries + 1):
+        try:
+            status = await _post_to_nightscout_async(http, user_config, url, payload)
+            if status == 200:
+                return CHUNK_SENT
+
+            logger.error("Nightscout отклонил запрос: %s", status)
+
+            # 4xx — повтор не поможет
+            if 400 <= status < 500:
+                return CHUNK_REJECTED
+        except CircuitOpenError:
+            return CHUNK_FAILED
+        except Exception as e:
+            logger.error("Ошибка при отправке в Nightscout (попытка %d/%d): %s", attempt + 1, retries + 1, e)
+
+        if get_breaker(user_config['ns_url']).retry_in() > 0:
+            return CHUNK_FAILED
+
+        if attempt < retries:
+            await asyncio.sleep(min(2 ** attempt, 10))
+
+    return CHUNK_FAILED
+
+async def _upload_entries_async(http, user_config, entries):
+    """Аналог upload_entries: флаги успешной отправки по одному на запись"""
+    url = f"{user_config['ns_url']}/api/v1/entries"
+    breaker = get_breaker(user_config['ns_url'])
+    sent_flags = []
+
+    for chunk_no, total_chunks, chunk in iter_entry_chunks(entries):
+        result = await _send_chunk_async(http, user_config, url, chunk, CONFIG['batch_retries'])
+        if result == CHUNK_SENT:
+            chunk_flags = [True] * len(chunk)
+        elif result == CHUNK_FAILED:
+            logger.warning("Nightscout не принял пачку: пачки %d-%d будут отправлены позже", chunk_no, total_chunks)
+            sent_flags.extend([False] * (len(entries) - len(sent_flags)))
+            break
+        else:
+            logger.warning("Пачка %d/%d не принята, отправляем по одной записи", chunk_no, total_chunks)
+            chunk_flags = []
+            for entry in chunk:
+                if breaker.retry_in() > 0:
+                    break
+                chunk_flags.append(await _send_chunk_async(http, user_config, url, entry, 0) == CHUNK_SENT)
+            chunk_flags.extend([False] * (len(chunk) - len(chunk_flags)))
+
+        sent_flags.extend(chunk_flags)
+        logger.debug("Пачка %d/%d: отправлено %d/%d", chunk_no, total_chunks, sum(chunk_flags), len(chunk))
+
+    return sent_flags
+
+async def _drain_outbox_async(http, user_config, state_key):
+    """Аналог drain_outbox: отправка очереди мастера порциями по OUTBOX_DRAIN_BATCH"""
+    if not begin_outbox_drain(state_key):
+        return 0
+
+    successful = 0
+    depth = 0
+    try:
+        while True:
+            # Чтение и подтверждение очереди (SQLite) — в потоке, не останавливая цикл событий
+            pending = await asyncio.to_thread(load_outbox, state_key, OUTBOX_DRAIN_BATCH, user_config['ns_uploder'])
+            if not pending:
+                break
+
+            sent_flags = await _upload_entries_async(http, user_config, pending)
+            sent, depth = await asyncio.to_thread(acknowledge_outbox, user_config, state_key, pending, sent_flags)
+            successful += sent
+            if sent < len(pending) or not depth:
+                break
+    finally:
+        end_outbox_drain(state_key)
+
+    log_outbox_drain(successful, depth)
+    return successful
+
+def _prepare_new_entries(user_config, state_key, sync_state, curve_list):
+    """Отбор, подготовка и постановка в очередь новых записей (выполняется в потоке)"""
+    entries = select_new_entries(user_config, curve_list, sync_state)
+    if entries is not None:
+        enqueue_new_entries(user_config, state_key, entries)
+
+async def _process_user_async(http, user_info):
+    """Аналог process_user_wrapper + process_user_data_optimized"""
+    await asyncio.sleep(master_start_offset(user_info))
+
+    user_config = create_user_config(user_info['email'], user_info['fromUserId'], user_info.get('userName'),
+                                     user_info.get('account'))
+
+    if not user_config:
+        logger.warning("Пользователь %s не настроен", user_info['email'])
+        return 0
+
+    # Контексты логирования и замеров — свои у каждой задачи asyncio
+    with master_context(user_config['config_key']), \
+            profiling.master_span(user_config['config_key'], urlparse(user_config['ns_url']).netloc):
+        try:
+            logger.debug("Мастер %s (ID: %s)", user_config['email'], user_config['from_user_id'])
+
+            status = get_cached_nightscout_status(user_config)
+            if status is None:
+                with profiling.span('connect'):
+                    status = await _check_nightscout_async(http, user_config)
+                store_nightscout_status(user_config, status)
+
+            if not status[0]:
+                logger.error("❌ Nightscout недоступен, новые записи будут сохранены в очередь")
+
+            # Работа с SQLite и подготовка записей (CPU) выполняются в потоках
+            # (asyncio.to_thread копирует контекст лога и замеров), чтобы не
+            # задерживать запросы остальных мастеров
+            window = await asyncio.to_thread(plan_sync_window, user_config, status[1] if status[0] else None)
+            if window is None:
+                return 0
+            state_key, sync_state, start_time, end_time = window
+
+            curve_list = await _get_ottai_data_async(http, user_config, start_time, end_time)
+
+            with profiling.span('prepare'):
+                await asyncio.to_thread(_prepare_new_entries, user_config, state_key, sync_state, curve_list)
+
+            if not status[0]:
+                return 0
+
+            with profiling.span('upload'):
+                return await _drain_outbox_async(http, user_config, state_key)
+        except Exception as e:
+            logger.exception("Ошибка при обработке %s: %s", user_info['email'], e)
+            return 0
@@ -0,0 +1,130 @@
+import concurrent.futures
+import datetime
+import logging
+import threading
+
+from setup import BACKFILL_WINDOW_HOURS, BACKFILL_WORKERS
+from module import (
+    get_all_users_from_ottai_cached, select_configured_users, create_user_config,
+    get_ottai_data_batch, prepare_nightscout_entries, upload_entries, format_local_time
+)
+from state import get_state_key, load_backfill_progress, mark_backfill_window_done
+from trend import TrendWindow
+from log import get_logger, master_context
+
+logger = get_logger('backfill')
+
+# ========== БЭКФИЛЛ ИСТОРИЧЕСКИХ ДАННЫХ ==========
+# python main.py --backfill FROM TO
+# Диапазон делится на окна по BACKFILL_WINDOW_HOURS, окна загружаются
+# параллельно (BACKFILL_WORKERS) и сразу отправляются в Nightscout.
+# Загруженные окна сохраняются в базе состояния — прерванный бэкфилл
+# при повторном запуске с теми же аргументами продолжается с места остановки
+
+def parse_backfill_time(value):
+    """Время из аргумента командной строки: 2024-10-01 или 2024-10-01T12:00 (локальное)"""
+    return datetime.datetime.fromisoformat(value)
+
+def split_windows(start_time, end_time, window_ms):
+    """Разбиение [start_time, end_time) на окна по window_ms (мс)"""
+    windows = []
+    window_start = start_time
+    while window_start < end_time:
+        window_end = min(window_start + window_ms, end_time)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+def _backfill_window(user_config, job_key, window_start, window_end, progress):
+    """Загрузка одного окна из Ottai и отправка в Nightscout"""
+    with master_context(user_config['config_key']):
+        # Ottai отдаёт диапазон включительно — последнюю миллисекунду оставляем следующему окну
+        curve_list = get_ottai_data_batch(user_config, window_start, window_end - 1)
+
+        # Тренд считается внутри окна: окна загружаются не по порядку
+        entries = prepare_nightscout_entries(curve_list, user_config, TrendWindow()) if curve_list else []
+
+        sent_flags = upload_entries(user_config, entries) if entries else []
+        successful = sum(sent_flags)
+
+        # Окно отмечается загруженным, только если ответ Ottai прочитан до конца
+        # (None — ошибка или прерванная загрузка) и все записи приняты Nightscout
+        complete = curve_list is not None and all(sent_flags)
+        if complete:
+            mark_backfill_window_done(job_key, window_start)
+
+        with progress['lock']:
+            progress['done'] += 1
+            done = progress['done']
+
+        logger.log(logging.INFO if complete else logging.WARNING,
+                   "%s окно %d/%d %s — %s: %s", "✅" if complete else "⚠️",
+                   done, progress['total'], format_local_time(window_start, '%Y-%m-%d %H:%M'),
+                   format_local_time(window_end, '%Y-%m-%d %H:%M'),
+                   f"отправлено {successful}/{len(entries)}" if curve_list is not None else "не загружено из Ottai")
+
+    return successful
+
+def run_backfill(start_dt, end_dt):
+    """
+    Бэкфилл всех настроенных мастеров за [start_dt, end_dt).
+    Возвращает количество отправленных записей
+    """
+    start_time = int(start_dt.timestamp() * 1000)
+    end_time = int(end_dt.timestamp() * 1000)
+
+    logger.info("📦 БЭКФИЛЛ: %s — %s (окно: %d ч, параллельных загрузок: %d)",
+                start_dt.strftime('%Y-%m-%d %H:%M'), end_dt.strftime('%Y-%m-%d %H:%M'),
+                BACKFILL_WINDOW_HOURS, BACKFILL_WORKERS)
+
+    if start_time >= end_time:
+        logger.error("❌ Начало диапазона должно быть раньше конца")
+        return 0
+
+    configured_users = select_configured_users(get_all_users_from_ottai_cached(force_refresh=True))
+    if not configured_users:
+        logger.error("❌ Нет настроенных мастеров")
+        return 0
+
+    windows = split_windows(start_time, end_time, BACKFILL_WINDOW_HOURS * 3600 * 1000)
+    tasks = []
+
+    for user_info in configured_users:
+        user_config = create_user_config(user_info['email'], user_info['fromUserId'], user_info.get('userName'),
+                                         user_info.get('account'))
+        if not user_config:
+            continue
+
+        job_key = f"{get_state_key(user_config)}:{start_time}:{end_time}:{BACKFILL_WINDOW_HOURS}"
+        completed = load_backfill_progress(job_key)
+        pending = [window for window in windows if window[0] not in completed]
+
+        with master_context(user_config['config_key']):
+            logger.info("Окон %d, уже загружено %d", len(windows), len(windows) - len(pending))
+        tasks.extend((user_config, job_key, window_start, window_end) for window_start, window_end in pending)
+
+    if not tasks:
+        logger.info("✅ Все окна уже загружены")
+        return 0
+
+    progress = {'done': 0, 'total': len(tasks), 'lock': threading.Lock()}
+    total_successful = 0
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=BACKFILL_WORKERS)
+    try:
+        futures = [executor.submit(_backfill_window, *task, progress) for task in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                total_successful += future.result()
+            except Exception as e:
+                logger.exception("Ошибка при загрузке окна: %s", e)
+    except KeyboardInterrupt:
+        logger.warning("⏹️  Бэкфилл прерван — загруженные окна сохранены, повторный запуск продолжит с места остановки")
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown(wait=True)
+
+    logger.info("📊 ИТОГ БЭКФИЛЛА: отправлено %d записей", total_successful)
+
+    return total_successful
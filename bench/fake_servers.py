@@ -0,0 +1,236 @@
+import copy
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# ========== ЛОКАЛЬНЫЕ ЗАМЕНИТЕЛИ OTTAI И NIGHTSCOUT ==========
+# Данные Ottai генерируются из ottai_template_by_period.json: значения глюкозы
+# берутся из шаблона по кругу, monitorTime — на сетке SENSOR_STEP_MS до текущего момента
+
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'ottai_template_by_period.json')
+
+SENSOR_STEP_MS = 5 * 60 * 1000
+
+class _Counters:
+    """Счётчики HTTP-вызовов по эндпоинтам"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class FakeOttai:
+    """
+    Ottai: linkQueryList/v2 (список из masters мастеров) и queryMonitorBase
+    (показания за запрошенный период, не старше hours часов)
+    """
+
+    def __init__(self, masters, hours, port=0):
+        with open(TEMPLATE_FILE, encoding='utf-8') as template_file:
+            self.template = json.load(template_file)
+        self.glucose_values = [item['adjustGlucose'] for item in self.template['data']['curveList']]
+        self.masters = masters
+        self.hours = hours
+        self.counters = _Counters()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    @staticmethod
+    def master_id(index):
+        return 100000 + index
+
+    def readings(self, master_index, start_time, end_time):
+        """Показания мастера на сетке SENSOR_STEP_MS в [start_time, end_time]"""
+        now = int(time.time() * 1000)
+        # Фаза сетки — своя у каждого мастера
+        phase = master_index * 7919 % SENSOR_STEP_MS
+        oldest = now - self.hours * 3600 * 1000
+        first = max(start_time, oldest)
+        monitor_time = first - (first - phase) % SENSOR_STEP_MS
+        if monitor_time < first:
+            monitor_time += SENSOR_STEP_MS
+
+        items = []
+        while monitor_time <= min(end_time, now):
+            step = (monitor_time - phase) // SENSOR_STEP_MS
+            items.append({
+                'adjustGlucose': self.glucose_values[(step + master_index) % len(self.glucose_values)],
+                'dataNo': step,
+                'monitorTime': monitor_time
+            })
+            monitor_time += SENSOR_STEP_MS
+        return items
+
+    def _handler(self):
+        fake = self
+
+        class Handler(_JsonHandler):
+            def do_POST(self):
+                self._read_body()
+                if self.path.endswith('/linkQueryList/v2'):
+                    fake.counters.inc('ottai_users')
+                    self._send_json(200, {'code': 'OK', 'data': [
+                        {'fromUserEmail': f"bench{i}@example.com", 'fromUserId': fake.master_id(i),
+                         'userName': f"bench{i}"}
+                        for i in range(fake.masters)
+                    ]})
+                else:
+                    self._send_json(404, {})
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                if not parsed.path.endswith('/queryMonitorBase'):
+                    self._send_json(404, {})
+                    return
+
+                fake.counters.inc('ottai_data')
+                query = parse_qs(parsed.query)
+                master_index = int(query['fromUserId'][0]) - fake.master_id(0)
+                response = copy.copy(fake.template)
+                response['data'] = dict(fake.template['data'])
+                response['data']['curveList'] = fake.readings(master_index, int(query['startTime'][0]),
+                                                              int(query['endTime'][0]))
+                self._send_json(200, response)
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-ottai', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeNightscout:
+    """
+    Nightscout для нескольких хостов: /<host>/api/v1/entries (GET последней записи
+    по find[device], POST записей) и /<host>/api/v1/status.
+    latency — задержка ответа (с), error_rate — доля ответов 503
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, port=0, seed=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.counters = _Counters()
+        self.entries = {}
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+
+    def host_url(self, host):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/{host}"
+
+    def entries_count(self):
+        with self._lock:
+            return sum(len(entries) for entries in self.entries.values())
+
+    def _fail(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def _handler(self):
+        fake = self
+
+        class Handler(_JsonHandler):
+            def _route(self):
+                parsed = urlparse(self.path)
+                parts = parsed.path.strip('/').split('/', 1)
+                if len(parts) < 2:
+                    return None, None, parsed
+                return parts[0], '/' + parts[1], parsed
+
+            def _delay_or_fail(self):
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fake.error_rate and fake._fail():
+                    self._send_json(503, {'status': 503, 'message': 'bench error'})
+                    return True
+                return False
+
+            def do_GET(self):
+                host, path, parsed = self._route()
+                fake.counters.inc('ns_get')
+                if self._delay_or_fail():
+                    return
+
+                if path == '/api/v1/status' or path == '/api/v1/status.json':
+                    self._send_json(200, {'status': 'ok', 'name': 'nightscout'})
+                elif path == '/api/v1/entries.json' or path == '/api/v1/entries':
+                    device = parse_qs(parsed.query).get('find[device]', [None])[0]
+                    with fake._lock:
+                        entries = fake.entries.get(host, {})
+                        dates = [date for (entry_device, date) in entries if entry_device == device]
+                        latest = entries[(device, max(dates))] if dates else None
+                    self._send_json(200, [latest] if latest else [])
+                else:
+                    self._send_json(404, {})
+
+            def do_POST(self):
+                host, path, _ = self._route()
+                body = self._read_body()
+                fake.counters.inc('ns_post')
+                if self._delay_or_fail():
+                    return
+
+                if path != '/api/v1/entries':
+                    self._send_json(404, {})
+                    return
+
+                data = json.loads(body)
+                entries = data if isinstance(data, list) else [data]
+                with fake._lock:
+                    host_entries = fake.entries.setdefault(host, {})
+                    for entry in entries:
+                        # Nightscout не дублирует записи с тем же device и date
+                        host_entries[(entry.get('device'), entry.get('date'))] = entry
+                fake.counters.inc('ns_entries', len(entries))
+                self._send_json(200, entries)
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-nightscout', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,130 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+# ========== БЕНЧМАРК ЦИКЛА СИНХРОНИЗАЦИИ ==========
+# python bench/run_bench.py --masters 50 --hours 24 --cycles 3
+# Поднимает локальные Ottai и Nightscout (bench/fake_servers.py), выполняет
+# process_all_users_optimized() указанное число циклов и выводит для каждого
+# цикла время, пропускную способность, число HTTP-вызовов и пиковый RSS.
+# Первый цикл — начальная загрузка за --hours часов, следующие — штатные циклы
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fake_servers import FakeOttai, FakeNightscout
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк загрузчика Ottai → Nightscout на локальных серверах")
+    parser.add_argument('--masters', type=int, default=10, help="число мастеров")
+    parser.add_argument('--hours', type=int, default=24, help="глубина данных (HOURS_AGO), часов")
+    parser.add_argument('--cycles', type=int, default=3, help="число циклов")
+    parser.add_argument('--engine', choices=('threads', 'pipeline', 'async'), default='threads', help="SYNC_ENGINE")
+    parser.add_argument('--ns-latency', type=float, default=0.0, help="задержка ответа Nightscout, мс")
+    parser.add_argument('--ns-error-rate', type=float, default=0.0, help="доля ответов 503 от Nightscout (0..1)")
+    parser.add_argument('--batch-size', type=int, default=None, help="BATCH_SIZE")
+    parser.add_argument('--json', metavar='FILE', help="сохранить результаты в JSON (для сравнения между версиями)")
+    return parser.parse_args()
+
+def configure_environment(args, ottai, nightscout, state_dir):
+    """
+    Переменные окружения загрузчика. Задаются до импорта module:
+    конфигурация читается один раз при импорте setup
+    """
+    os.environ.update({
+        'OTTAI_TOKEN': 'bench',
+        'OTTAI_BASE_URL': ottai.url,
+        'HOURS_AGO': str(args.hours),
+        'STATE_DIR': state_dir,
+        'SYNC_ENGINE': args.engine,
+        'DISABLE_SSL_VERIFY': 'true',
+        # Каждый цикл опрашивает всех мастеров без случайных задержек
+        'ADAPTIVE_POLLING': 'false',
+        'MASTER_JITTER_SECONDS': '0',
+    })
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    # Лимит запросов к Ottai скрыл бы пропускную способность самого цикла
+    os.environ.setdefault('OTTAI_RATE_LIMIT', '0')
+    if args.batch_size:
+        os.environ['BATCH_SIZE'] = str(args.batch_size)
+
+    for index in range(args.masters):
+        os.environ[f"NS_URL__bench{index}"] = nightscout.host_url(f"h{index}")
+        os.environ[f"NS_SECRET__bench{index}"] = 'bench-secret'
+
+def peak_rss_mb():
+    """Пиковый RSS процесса, МБ (ru_maxrss: КБ в Linux, байты в macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _calls(counters):
+    return {name: value for name, value in counters.items() if name != 'ns_entries'}
+
+def run_cycles(args, ottai, nightscout):
+    import module
+
+    results = []
+    for cycle in range(1, args.cycles + 1):
+        ottai_before = ottai.counters.snapshot()
+        ns_before = nightscout.counters.snapshot()
+
+        started = time.perf_counter()
+        module.process_all_users_optimized()
+        wall_time = time.perf_counter() - started
+
+        ottai_after = ottai.counters.snapshot()
+        ns_after = nightscout.counters.snapshot()
+        calls = {name: value - ottai_before.get(name, 0) for name, value in _calls(ottai_after).items()}
+        calls.update({name: value - ns_before.get(name, 0) for name, value in _calls(ns_after).items()})
+        entries = ns_after.get('ns_entries', 0) - ns_before.get('ns_entries', 0)
+
+        results.append({
+            'cycle': cycle,
+            'wall_time_s': round(wall_time, 4),
+            'entries_sent': entries,
+            'entries_per_s': round(entries / wall_time, 1) if wall_time else 0.0,
+            'http_calls': sum(calls.values()),
+            'http_calls_by_endpoint': calls,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        })
+    return results
+
+def print_report(args, results, stored_entries):
+    print(f"\nМастеров: {args.masters}, данных: {args.hours} ч, движок: {args.engine}, "
+          f"задержка Nightscout: {args.ns_latency:.0f} мс, ошибки: {args.ns_error_rate:.0%}")
+    print(f"{'цикл':>4} {'время, с':>10} {'записей':>9} {'записей/с':>11} {'HTTP':>6} {'RSS, МБ':>9}  по эндпоинтам")
+    for result in results:
+        endpoints = ', '.join(f"{name}={value}" for name, value in sorted(result['http_calls_by_endpoint'].items()))
+        print(f"{result['cycle']:>4} {result['wall_time_s']:>10.3f} {result['entries_sent']:>9} "
+              f"{result['entries_per_s']:>11.1f} {result['http_calls']:>6} {result['peak_rss_mb']:>9.1f}  {endpoints}")
+    print(f"Записей в Nightscout (без дублей): {stored_entries}")
+
+def main():
+    args = parse_args()
+
+    ottai = FakeOttai(args.masters, args.hours).start()
+    nightscout = FakeNightscout(latency=args.ns_latency / 1000, error_rate=args.ns_error_rate).start()
+
+    with tempfile.TemporaryDirectory(prefix='ottai-bench-') as state_dir:
+        configure_environment(args, ottai, nightscout, state_dir)
+        try:
+            results = run_cycles(args, ottai, nightscout)
+        finally:
+            from state import close_state_store
+            close_state_store()
+            ottai.stop()
+            nightscout.stop()
+
+    print_report(args, results, nightscout.entries_count())
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump({'args': vars(args), 'cycles': results}, output, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from setup import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, CIRCUIT_MAX_OPEN_SECONDS
+from log import get_logger
+import metrics
+
+logger = get_logger('circuit')
+
+# ========== CIRCUIT BREAKER ПО ХОСТАМ ==========
+# После CIRCUIT_FAILURE_THRESHOLD ошибок подряд (сеть, таймаут, 5xx) хост
+# считается недоступным: запросы к нему сразу отклоняются (open). По истечении
+# паузы пропускается один пробный запрос (half-open): успех закрывает breaker,
+# ошибка снова открывает его с удвоенной паузой (до CIRCUIT_MAX_OPEN_SECONDS, с jitter)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Значение метрики состояния
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Пробный запрос, не завершившийся за это время, считается потерянным (с)
+PROBE_TIMEOUT_SECONDS = 120
+
+class CircuitOpenError(Exception):
+    """Запрос не выполнен: breaker хоста открыт"""
+
+    def __init__(self, host, retry_in):
+        super().__init__(f"хост {host} недоступен, повтор через {retry_in:.0f} с")
+        self.host = host
+        self.retry_in = retry_in
+
+class CircuitBreaker:
+    """Состояние доступности одного хоста"""
+
+    def __init__(self, host, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                 open_seconds=CIRCUIT_OPEN_SECONDS, max_open_seconds=CIRCUIT_MAX_OPEN_SECONDS):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.open_count = 0
+        self.open_until = 0.0
+        self.probe_started = None
+        self._lock = threading.Lock()
+        metrics.CIRCUIT_STATE.set(STATE_VALUES[CLOSED], host=host)
+
+    def _set_state(self, state):
+        previous, self.state = self.state, state
+        metrics.CIRCUIT_STATE.set(STATE_VALUES[state], host=self.host)
+        return previous
+
+    def _open(self, now):
+        """Открытие breaker с экспоненциальной паузой и jitter"""
+        self.open_count += 1
+        pause = min(self.max_open_seconds, self.open_seconds * 2 ** (self.open_count - 1))
+        # Jitter: хосты, упавшие одновременно, не проверяются одновременно
+        pause *= random.uniform(0.75, 1.0)
+        self.open_until = now + pause
+        self.probe_started = None
+        self._set_state(OPEN)
+        return pause
+
+    def retry_in(self, now=None):
+        """Секунд до следующей попытки (0 — запрос можно выполнить)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state == OPEN:
+                return max(0.0, self.open_until - now)
+            if self.state == HALF_OPEN and self.probe_started is not None \
+                    and now - self.probe_started < PROBE_TIMEOUT_SECONDS:
+                return max(0.0, self.probe_started + PROBE_TIMEOUT_SECONDS - now)
+            return 0.0
+
+    def before_request(self):
+        """
+        Разрешение на запрос. В состоянии open выбрасывает CircuitOpenError;
+        после паузы пропускает один пробный запрос
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.state == CLOSED:
+                return
+
+            probe_lost = self.probe_started is not None and now - self.probe_started >= PROBE_TIMEOUT_SECONDS
+            if (self.state == OPEN and now >= self.open_until) or (self.state == HALF_OPEN and probe_lost):
+                self._set_state(HALF_OPEN)
+                self.probe_started = now
+                logger.info("🔌 %s: пробный запрос после паузы (half-open)", self.host)
+                return
+
+            retry_in = self.open_until - now if self.state == OPEN else PROBE_TIMEOUT_SECONDS
+        metrics.CIRCUIT_REJECTED.inc(host=self.host)
+        raise CircuitOpenError(self.host, max(0.0, retry_in))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.open_count = 0
+                self.probe_started = None
+                self._set_state(CLOSED)
+                logger.info("🔌 %s: хост снова доступен (closed)", self.host)
+
+    def record_failure(self, reason=None):
+        now = time.monotonic()
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                pause = self._open(now)
+                logger.warning("🔌 %s: хост недоступен (%s), запросы приостановлены на %.0f с (open)",
+                               self.host, reason or f"ошибок подряд: {self.failures}", pause)
+
+_breakers = {
+    'hosts': {},
+    'lock': threading.Lock()
+}
+
+def get_breaker(url):
+    """Breaker хоста из URL (один на хост для всех мастеров и путей)"""
+    host = urlparse(url).netloc or url
+    breaker = _breakers['hosts'].get(host)
+    if breaker is None:
+        with _breakers['lock']:
+            breaker = _breakers['hosts'].get(host)
+            if breaker is None:
+                breaker = _breakers['hosts'][host] = CircuitBreaker(host)
+    return breaker
+
+def is_server_error(status_code):
+    """Ответ, который считается отказом хоста"""
+    return status_code >= 500
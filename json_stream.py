@@ -0,0 +1,115 @@
+import codecs
+import json
+
+# ========== ПОТОКОВЫЙ РАЗБОР ОТВЕТА queryMonitorBase ==========
+# Записи curveList выдаются по мере прихода байтов ответа: документ целиком
+# не собирается в память и не разбирается повторно
+
+CURVE_LIST_KEY = '"curveList"'
+
+_WHITESPACE = ' \t\r\n'
+
+class CurveListStreamParser:
+    """
+    Инкрементальный разбор JSON-ответа с массивом curveList.
+
+    feed(chunk) принимает очередной кусок байтов и возвращает записи,
+    которые удалось разобрать. Если ключ curveList в ответе не найден,
+    close() разбирает документ целиком и возвращает данные через
+    fallback(data) — так поддерживаются другие форматы ответа.
+    """
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._state = 'search'
+
+    @property
+    def found(self):
+        """Найден ли массив curveList"""
+        return self._state != 'search'
+
+    def feed(self, chunk):
+        if self._state == 'done':
+            return []
+
+        self._buffer += self._decoder.decode(chunk)
+
+        if self._state == 'search' and not self._find_array():
+            return []
+
+        return self._read_items()
+
+    def close(self):
+        """Завершение разбора; возвращает оставшиеся записи"""
+        self._buffer += self._decoder.decode(b'', final=True)
+
+        if self._state == 'search':
+            # curveList не найден — разбираем документ целиком
+            data = json.loads(self._buffer) if self._buffer.strip() else None
+            self._buffer = ''
+            self._state = 'done'
+            if data is None or self.fallback is None:
+                return []
+            return list(self.fallback(data) or [])
+
+        items = self._read_items()
+        if self._state != 'done':
+            raise ValueError("Ответ Ottai оборван внутри curveList")
+        return items
+
+    def _find_array(self):
+        """Поиск начала массива curveList; True — массив найден"""
+        key_pos = self._buffer.find(CURVE_LIST_KEY)
+        while key_pos != -1:
+            pos = self._skip_whitespace(key_pos + len(CURVE_LIST_KEY))
+            if pos >= len(self._buffer):
+                return False
+            if self._buffer[pos] == ':':
+                pos = self._skip_whitespace(pos + 1)
+                if pos >= len(self._buffer):
+                    return False
+                if self._buffer[pos] == '[':
+                    # Начало документа больше не нужно
+                    self._buffer = self._buffer[pos + 1:]
+                    self._pos = 0
+                    self._state = 'array'
+                    return True
+            key_pos = self._buffer.find(CURVE_LIST_KEY, key_pos + 1)
+        return False
+
+    def _skip_whitespace(self, pos):
+        while pos < len(self._buffer) and self._buffer[pos] in _WHITESPACE:
+            pos += 1
+        return pos
+
+    def _read_items(self):
+        items = []
+        buffer = self._buffer
+        pos = self._pos
+
+        while True:
+            while pos < len(buffer) and (buffer[pos] in _WHITESPACE or buffer[pos] == ','):
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                self._state = 'done'
+                buffer = ''
+                pos = 0
+                break
+            try:
+                item, end = self._json.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # Запись пришла не полностью — ждём следующий кусок
+                break
+            items.append(item)
+            pos = end
+
+        # Разобранную часть буфера отбрасываем
+        self._buffer = buffer[pos:]
+        self._pos = 0
+        return items
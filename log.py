@@ -0,0 +1,78 @@
+import contextlib
+import contextvars
+import json
+import logging
+import sys
+
+from setup import LOG_LEVEL, LOG_FORMAT
+
+# ========== ЛОГИРОВАНИЕ ==========
+# Уровень задаётся LOG_LEVEL, формат — LOG_FORMAT (text или json).
+# Сообщения форматируются лениво (logger.debug("... %s", value)): при
+# отключённом уровне строка не собирается. К каждой записи добавляется
+# config_key мастера, который обрабатывается в текущем потоке/задаче
+
+LOGGER_NAME = 'uploader'
+
+TEXT_FORMAT = '%(asctime)s %(levelname)-7s [%(config_key)s] %(message)s'
+TEXT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# config_key текущего мастера; contextvars — чтобы контекст не смешивался
+# ни между потоками пула, ни между задачами asyncio
+_master_context = contextvars.ContextVar('config_key', default='-')
+
+class MasterContextFilter(logging.Filter):
+    """Добавляет к записи config_key текущего мастера"""
+
+    def filter(self, record):
+        record.config_key = _master_context.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON (для сборщиков логов Docker)"""
+
+    def format(self, record):
+        payload = {
+            'time': self.formatTime(record, TEXT_DATE_FORMAT),
+            'level': record.levelname,
+            'logger': record.name,
+            'config_key': record.config_key,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            payload['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
+
+def setup_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """Настройка логгера приложения (повторный вызов заменяет обработчик)"""
+    logger = logging.getLogger(LOGGER_NAME)
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(MasterContextFilter())
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT, TEXT_DATE_FORMAT))
+
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    return logger
+
+def get_logger(name):
+    """Логгер модуля приложения"""
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+@contextlib.contextmanager
+def master_context(config_key):
+    """Контекст логирования мастера: все записи внутри помечаются config_key"""
+    token = _master_context.set(config_key or '-')
+    try:
+        yield
+    finally:
+        _master_context.reset(token)
+
+setup_logging()
@@ -8,14 +8,22 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 warnings.filterwarnings('ignore', message='Unverified HTTPS request')
 
 from module import *
-import schedule
+from scheduler import CycleScheduler
+from log import get_logger
+from metrics import start_metrics_server
 import time
 import datetime
 import os
 import sys
+import argparse
+
+logger = get_logger('main')
 
 def print_banner():
-    """Вывод заголовка программы"""
+    """Вывод заголовка программы (в режиме LOG_FORMAT=json не выводится)"""
+    if LOG_FORMAT == 'json':
+        return
+    
     banner = """
 ╔════════════════════════════════════════════════════════════════════╗
 ║               OTTAI TO NIGHTSCOUT SYNC MODULE v2.0                 ║
@@ -26,64 +34,101 @@ def print_banner():
 
 def print_system_info():
     """Вывод системной информации"""
-    print("📋 СИСТЕМНАЯ ИНФОРМАЦИЯ:")
-    print(f"   Время запуска: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"   Период загрузки данных: {HOURS_AGO} часов")
-    print(f"   Базовая ссылка Ottai: {OTTAI_BASE_URL}")
-    print(f"   SSL проверка: {'Отключена' if DISABLE_SSL_VERIFY else 'Включена'}")
+    logger.info("📋 Период загрузки данных: %d часов, Ottai: %s, SSL проверка: %s, уровень лога: %s",
+                CONFIG['hours_ago'], ', '.join(f"{account['name']} — {account['base_url']}" for account in OTTAI_ACCOUNTS),
+                'Отключена' if DISABLE_SSL_VERIFY else 'Включена', LOG_LEVEL)
     
     # Показываем найденные конфигурации Nightscout
     config_count = get_all_nightscout_configs_display()
     if config_count > 0:
-        print(f"   Найдено конфигураций Nightscout: {config_count}")
+        logger.info("Найдено конфигураций Nightscout: %d", config_count)
     else:
-        print(f"   Конфигурации Nightscout: не найдены")
-    print()
+        logger.warning("Конфигурации Nightscout: не найдены")
 
-def start_module():
+def start_module(deadline=None):
     """Основная функция обработки данных"""
-    os.system('cls' if os.name == 'nt' else 'clear')
-    
-    print_banner()
-    print_system_info()
+    # Очистка консоли — только для интерактивного терминала (CLEAR_CONSOLE)
+    if CLEAR_CONSOLE:
+        os.system('cls' if os.name == 'nt' else 'clear')
+        print_banner()
+        print_system_info()
     
     # Обрабатываем данные для всех пользователей
-    process_all_users_optimized()
+    process_all_users_optimized(deadline)
+
+def create_scheduler():
+    """Планировщик циклов по настройкам SCHEDULE_*"""
+    if SCHEDULE_OFFSET == 'auto':
+        # Тик через 30 секунд после ожидаемого показания датчика
+        return CycleScheduler(start_module, SCHEDULE_INTERVAL, offset=30,
+                              deadline=CYCLE_DEADLINE, phase_provider=get_latest_monitor_time)
+    
+    return CycleScheduler(start_module, SCHEDULE_INTERVAL, offset=float(SCHEDULE_OFFSET),
+                          deadline=CYCLE_DEADLINE)
+
+def parse_args():
+    """Аргументы командной строки"""
+    parser = argparse.ArgumentParser(description="Ottai/Syai → Nightscout")
+    parser.add_argument('--backfill', nargs=2, metavar=('FROM', 'TO'),
+                        help="загрузить историю за период (например, 2024-10-01 2024-10-07T12:00) и выйти")
+    return parser.parse_args()
+
+def run_backfill_mode(date_from, date_to):
+    """Режим бэкфилла: загрузка истории и выход"""
+    from backfill import parse_backfill_time, run_backfill
+    
+    print_banner()
+    try:
+        run_backfill(parse_backfill_time(date_from), parse_backfill_time(date_to))
+    except ValueError as e:
+        logger.error("❌ Некорректная дата: %s", e)
+    except KeyboardInterrupt:
+        pass
 
 def main():
     """Главная функция с планировщиком"""
+    args = parse_args()
+    if args.backfill:
+        run_backfill_mode(*args.backfill)
+        return
+    
+    scheduler = create_scheduler()
+    
+    # Эндпоинт /metrics (если задан METRICS_PORT)
+    start_metrics_server()
+    
+    if not CLEAR_CONSOLE:
+        print_banner()
+        print_system_info()
+    
+    # Первый цикл выполняется сразу, синхронно
     try:
-        start_module()
+        start_module(time.monotonic() + CYCLE_DEADLINE)
     except KeyboardInterrupt:
-        print("\n\n⏹️  Программа остановлена пользователем")
+        logger.info("⏹️  Программа остановлена пользователем")
         return
     except Exception as e:
-        print(f"\n\n❌ Критическая ошибка при запуске: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Критическая ошибка при запуске: %s", e)
         return
     
     # Настройка периодического выполнения
-    print("\n" + "="*80)
-    print("⏰ ПЛАНИРОВЩИК АКТИВЕН")
-    print("="*80)
-    print("📅 Расписание: запуск каждую минуту")
-    print("⏹️  Для остановки нажмите Ctrl+C")
-    print("="*80 + "\n")
+    offset_str = "по циклу датчика" if SCHEDULE_OFFSET == 'auto' else f"смещение {SCHEDULE_OFFSET} с"
+    logger.info("⏰ ПЛАНИРОВЩИК АКТИВЕН: каждые %d с (%s), дедлайн цикла %.0f с. Для остановки нажмите Ctrl+C",
+                SCHEDULE_INTERVAL, offset_str, CYCLE_DEADLINE)
     
-    schedule.every(1).minutes.do(start_module)
+    # Досылка очереди в Nightscout между циклами
+    start_outbox_drainer()
     
     # Основной цикл
     try:
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        scheduler.run_forever(run_immediately=False)
     except KeyboardInterrupt:
-        print("\n\n👋 Программа остановлена. Всего доброго!")
+        logger.info("⏹️  Остановка: ждём завершения текущего цикла...")
+        scheduler.stop(wait=True)
+        stop_outbox_drainer()
+        logger.info("👋 Программа остановлена. Всего доброго!")
     except Exception as e:
-        print(f"\n\n❌ Критическая ошибка в основном цикле: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Критическая ошибка в основном цикле: %s", e)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
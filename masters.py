@@ -0,0 +1,76 @@
+from collections import namedtuple
+from types import MappingProxyType
+
+from setup import (
+    find_nightscout_config, extract_clean_email, normalize_email_key, get_hash_SHA1,
+    get_nightscout_config_generation
+)
+
+# ========== НАСТРОЕННЫЕ МАСТЕРА ==========
+# Сопоставление мастеров из Ottai с NS_URL__*/NS_SECRET__* выполняется один раз
+# при смене списка мастеров или конфигураций Nightscout: результат — индекс
+# fromUserId -> ResolvedMaster, из которого берутся конфигурации мастеров в цикле
+
+class ResolvedMaster(namedtuple('ResolvedMaster', [
+        'from_user_id', 'email', 'user_name', 'account', 'config_key', 'tier',
+        'ns_url', 'ns_secret', 'ns_uploder', 'ns_header'])):
+    """
+    Неизменяемая конфигурация Nightscout мастера: URL, секрет, имя загрузчика,
+    заголовки (с хешем секрета) и уровень fallback-цепочки, по которому она найдена
+    """
+
+    __slots__ = ()
+
+def resolve_master(email, from_user_id, user_name=None, account=None):
+    """Конфигурация мастера (email — уже очищенный) или None, если Nightscout не настроен"""
+    found = find_nightscout_config(email, user_name, from_user_id)
+    if found is None:
+        return None
+
+    ns_url, ns_secret, tier = found
+    if not ns_url or not ns_secret:
+        return None
+
+    config_key = normalize_email_key(email) or user_name or str(from_user_id)
+    return ResolvedMaster(
+        from_user_id=from_user_id,
+        email=email,
+        user_name=user_name,
+        account=account,
+        config_key=config_key,
+        tier=tier,
+        ns_url=ns_url.rstrip('/'),
+        ns_secret=ns_secret,
+        ns_uploder=f"Ottai-{config_key}",
+        ns_header=MappingProxyType({
+            "api-secret": get_hash_SHA1(ns_secret),
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        })
+    )
+
+class MasterIndex:
+    """
+    Настроенные мастера списка Ottai: fromUserId -> ResolvedMaster.
+    Строится для конкретного объекта списка и версии конфигураций Nightscout
+    """
+
+    def __init__(self, all_users):
+        self.users = all_users
+        self.generation = get_nightscout_config_generation()
+        self.masters = {}
+        for user in all_users:
+            email = extract_clean_email(user['email']) or user['email']
+            resolved = resolve_master(email, user['fromUserId'], user.get('userName', ''), user.get('account'))
+            if resolved is not None:
+                self.masters[str(user['fromUserId'])] = resolved
+
+    def is_current(self, all_users):
+        """Индекс построен для этого списка и текущих конфигураций Nightscout"""
+        return self.users is all_users and self.generation == get_nightscout_config_generation()
+
+    def get(self, from_user_id):
+        return self.masters.get(str(from_user_id))
+
+    def __len__(self):
+        return len(self.masters)
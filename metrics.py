@@ -0,0 +1,237 @@
+import bisect
+import http.server
+import threading
+import time
+
+from setup import METRICS_PORT, METRICS_ADDR
+from log import get_logger
+
+logger = get_logger('metrics')
+
+# ========== МЕТРИКИ (ФОРМАТ PROMETHEUS) ==========
+# Счётчики и гистограммы обновляются всегда (это дешёвые операции под
+# блокировкой), HTTP-эндпоинт /metrics поднимается только при METRICS_PORT > 0
+
+METRIC_PREFIX = 'ottai_uploader_'
+
+# Границы корзин гистограмм длительности (секунды)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CYCLE_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 120.0)
+
+_registry = {
+    'metrics': [],
+    'server': None,
+    'lock': threading.Lock()
+}
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    """Базовая метрика с метками: значения хранятся по кортежу значений меток"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = METRIC_PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry['lock']:
+            _registry['metrics'].append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def remove(self, **labels):
+        """Удаление ряда (например, для мастера, которого больше нет)"""
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = sorted(self._values.items())
+            lines.extend(self._render_samples(samples))
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def _render_samples(self, samples):
+        for key, value in samples:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_max(self, value, **labels):
+        """Установка значения, только если оно больше текущего"""
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values or value > self._values[key]:
+                self._values[key] = value
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+    def snapshot(self):
+        """Копия значений: [(кортеж значений меток, значение)]"""
+        with self._lock:
+            return sorted(self._values.items())
+
+    def _render_samples(self, samples):
+        for key, value in samples:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # [счётчики по корзинам (+Inf последней), сумма]
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def _render_samples(self, samples):
+        for key, (counts, total) in samples:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+# ========== МЕТРИКИ ЗАГРУЗЧИКА ==========
+CYCLE_DURATION = Histogram('cycle_duration_seconds', "Длительность цикла синхронизации",
+                           buckets=CYCLE_BUCKETS)
+OTTAI_FETCH_DURATION = Histogram('ottai_fetch_duration_seconds',
+                                 "Время загрузки данных мастера из Ottai (до конца ответа)",
+                                 ('config_key',))
+NIGHTSCOUT_POST_DURATION = Histogram('nightscout_post_duration_seconds',
+                                     "Время POST-запроса к Nightscout", ('config_key',))
+NIGHTSCOUT_REQUEST_BYTES = Counter('nightscout_request_bytes_total',
+                                   "Байт тела POST-запросов к Nightscout по кодированию (gzip или identity)",
+                                   ('config_key', 'encoding'))
+NIGHTSCOUT_RESPONSES = Counter('nightscout_responses_total',
+                               "Ответы Nightscout на POST по коду статуса (error — без ответа)",
+                               ('config_key', 'status'))
+ENTRIES_FETCHED = Counter('entries_fetched_total', "Записей получено из Ottai", ('config_key',))
+ENTRIES_DEDUPLICATED = Counter('entries_deduplicated_total',
+                               "Записей отброшено как уже отправленные", ('config_key',))
+ENTRIES_SENT = Counter('entries_sent_total', "Записей принято Nightscout", ('config_key',))
+OTTAI_THROTTLED = Counter('ottai_throttled_total', "Ответов 429 (слишком много запросов) от Ottai по аккаунтам",
+                          ('account',))
+OTTAI_RATE_LIMIT_WAIT = Counter('ottai_rate_limit_wait_seconds_total',
+                                "Суммарное ожидание разрешения лимитера запросов аккаунта к Ottai, секунд",
+                                ('account',))
+OTTAI_COALESCED = Counter('ottai_coalesced_total',
+                          "Запросов данных Ottai, объединённых с уже выполняющимся запросом того же мастера")
+CIRCUIT_STATE = Gauge('circuit_state', "Состояние circuit breaker хоста: 0 — closed, 1 — half-open, 2 — open",
+                      ('host',))
+CIRCUIT_REJECTED = Counter('circuit_rejected_total', "Запросов отклонено открытым circuit breaker", ('host',))
+LAST_DELIVERED = Gauge('last_delivered_timestamp_seconds',
+                       "monitorTime самого свежего показания, подтверждённого Nightscout", ('config_key',))
+OUTBOX_DEPTH = Gauge('outbox_depth', "Записей в очереди отправки в Nightscout", ('config_key',))
+OUTBOX_DROPPED = Counter('outbox_dropped_total',
+                         "Самых старых записей удалено из переполненной очереди (OUTBOX_MAX_ENTRIES)",
+                         ('config_key',))
+
+def observe_delivered(config_key, timestamp_ms):
+    """Отметка самого свежего доставленного показания мастера (для data lag)"""
+    LAST_DELIVERED.set_max(timestamp_ms / 1000, config_key=config_key)
+
+def forget_master(config_key):
+    """Удаление рядов lag и очереди мастера, которого больше нет в списке"""
+    LAST_DELIVERED.remove(config_key=config_key)
+    OUTBOX_DEPTH.remove(config_key=config_key)
+
+def _render_data_lag():
+    """data lag считается в момент запроса: now − monitorTime последнего доставленного показания"""
+    name = METRIC_PREFIX + 'data_lag_seconds'
+    lines = [f"# HELP {name} Отставание загрузки: текущее время минус monitorTime последнего доставленного показания",
+             f"# TYPE {name} gauge"]
+    now = time.time()
+    for key, delivered in LAST_DELIVERED.snapshot():
+        lines.append(f"{name}{_format_labels(LAST_DELIVERED.labelnames, key)} {_format_value(max(0.0, now - delivered))}")
+    return lines
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    with _registry['lock']:
+        metrics = list(_registry['metrics'])
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    lines.extend(_render_data_lag())
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics: " + format, *args)
+
+def start_metrics_server(port=METRICS_PORT, addr=METRICS_ADDR):
+    """Запуск эндпоинта /metrics в фоновом потоке (если port > 0)"""
+    if not port or _registry['server'] is not None:
+        return _registry['server']
+
+    server = http.server.ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    _registry['server'] = server
+
+    logger.info("📈 Метрики доступны на http://%s:%d/metrics", addr, server.server_address[1])
+    return server
+
+def stop_metrics_server():
+    """Остановка эндпоинта /metrics"""
+    server = _registry['server']
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        _registry['server'] = None
@@ -3,40 +3,189 @@ import requests
 import json
 import datetime
 from datetime import timedelta
-import traceback
+import logging
 import concurrent.futures
 import threading
 import urllib3
 import time
+import itertools
+import atexit
+import zlib
+import gzip
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+# NumPy ускоряет подготовку больших окон (бэкфилл), но не обязателен
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Подавляем предупреждения о SSL
 if DISABLE_SSL_VERIFY:
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Импортируем необходимые компоненты из setup
+# HOURS_AGO, BATCH_SIZE, BATCH_RETRIES, MAX_WORKERS и REQUEST_TIMEOUT читаются
+# из CONFIG при использовании: они меняются при перечитывании CONFIG_FILE
 from setup import (
-    HOURS_AGO, NS_UNIT_CONVERT,
-    get_common_ottai_headers,
-    OTTAI_BASE_URL, OTTAI_CUSTOMERID, DISABLE_SSL_VERIFY,
-    get_nightscout_config_by_email, extract_clean_email, normalize_email_key,
-    get_all_nightscout_configs, get_all_nightscout_configs_display,
-    get_hash_SHA1
+    CONFIG, NS_UNIT_CONVERT, DISABLE_SSL_VERIFY, NS_GZIP, NS_GZIP_MIN_BYTES, STATE_OVERLAP_MINUTES, SYNC_ENGINE,
+    MASTER_JITTER_SECONDS, DEBUG, ADAPTIVE_POLLING, SENSOR_INTERVAL_SECONDS, POLL_MAX_BACKOFF_SECONDS,
+    OUTBOX_MAX_ENTRIES, OUTBOX_DRAIN_INTERVAL, OUTBOX_DRAIN_BATCH,
+    PIPELINE_FETCH_WORKERS, PIPELINE_UPLOAD_WORKERS, USER_LIST_TTL, USER_LIST_RETRY_SECONDS,
+    extract_clean_email, normalize_email_key, get_all_nightscout_configs, get_all_nightscout_configs_display,
+    reload_nightscout_configs, get_nightscout_config_generation, reload_config_file
+)
+from trend import TrendWindow
+from readings import ReadingStore, NO_DATA_NO
+from json_stream import CurveListStreamParser
+from state import (
+    get_state_key, load_sync_state, save_sync_state, load_latest_monitor_time,
+    enqueue_outbox, load_outbox, ack_outbox, outbox_depths, save_user_list, load_user_list
 )
+from log import get_logger, master_context
+import metrics
+import profiling
+from circuit import get_breaker, is_server_error, CircuitOpenError
+from ratelimit import parse_retry_after
+from accounts import get_accounts, get_account, fair_order
+from masters import MasterIndex, resolve_master
+
+logger = get_logger('module')
 
 # ========== КОНСТАНТЫ И КЭШ ==========
-REQUEST_TIMEOUT = 30
-MAX_WORKERS = 3
-BATCH_SIZE = 50
+# Размер куска при потоковом чтении ответа Ottai (байт)
+OTTAI_STREAM_CHUNK_SIZE = 16384
 
-_user_cache = {
-    'data': None,
-    'timestamp': 0,
-    'lock': threading.Lock()
+# Повторов запроса к Ottai после ответа 429 (каждый — после паузы Retry-After)
+OTTAI_THROTTLE_RETRIES = 2
+
+# Запрос данных мастера присоединяется к уже выполняющемуся, если окно того
+# начинается не позже, а заканчивается не раньше чем на это время (мс).
+# Показания из непокрытого хвоста загрузит следующий цикл (окно с перекрытием)
+OTTAI_COALESCE_SLACK_MS = 30000
+
+# Ключи значения глюкозы и времени в записях Ottai (в порядке приоритета)
+GLUCOSE_KEYS = ['adjustGlucose', 'glucose', 'value', 'bgValue', 'sgv']
+TIMESTAMP_KEYS = ['monitorTime', 'timestamp', 'date', 'time', 'created_at']
+
+# Тренд из данных Ottai -> направление Nightscout
+TREND_MAP = {
+    'rising': 'DoubleUp',
+    'falling': 'DoubleDown',
+    'stable': 'Flat',
+    'DoubleUp': 'DoubleUp',
+    'DoubleDown': 'DoubleDown',
+    'SingleUp': 'SingleUp',
+    'SingleDown': 'SingleDown',
+    'FortyFiveUp': 'FortyFiveUp',
+    'FortyFiveDown': 'FortyFiveDown',
+    'Flat': 'Flat'
+}
+
+# Допустимый диапазон времени для пакетной подготовки (мс, 1970..9999 годы)
+MAX_BATCH_TIMESTAMP = 253402300800000
+
+# Граница значения глюкозы для пакетной подготовки: sgv остаётся в int64
+MAX_BATCH_GLUCOSE = 1e12
+
+# Граница dataNo (хранится в int64)
+MAX_DATA_NO = 2 ** 63 - 1
+
+# Адаптивный опрос: запас после ожидаемого показания, длительность серии
+# повторов и начальный шаг отката для замолчавшего датчика (секунды)
+POLL_GRACE_SECONDS = 20
+POLL_BURST_SECONDS = 240
+POLL_BACKOFF_BASE_SECONDS = 120
+
+# Сжатие запросов в Nightscout: уровень gzip, ответы сервера, не понявшего
+# сжатое тело, и через сколько снова проверить хост, отвергший gzip (с)
+GZIP_LEVEL = 6
+GZIP_REJECTED_STATUSES = (400, 413, 415)
+GZIP_RECHECK_SECONDS = 86400
+
+# Результат отправки пачки: принята, отклонена (4xx — досылается по одной записи)
+# или не отправлена (5xx, сеть, открытый breaker — остаётся в очереди целиком)
+CHUNK_SENT = 'sent'
+CHUNK_REJECTED = 'rejected'
+CHUNK_FAILED = 'failed'
+
+# Объединённый список мастеров всех аккаунтов: списки аккаунтов, из которых
+# он собран (пересобирается, когда список любого аккаунта заменён)
+_merged_users = {
+    'sources': (),
+    'users': None
+}
+
+# Сопоставление списка мастеров с NS_URL__*/NS_SECRET__* (пересчитывается при смене
+# списка или конфигураций Nightscout): индекс настроенных мастеров и результаты отбора
+_user_list_resolution = {
+    'index': None,
+    'statuses': [],
+    'configured': []
 }
 
 _connection_cache = {}
 
+# Долгоживущие HTTP-сессии: одна на хост (Ottai и каждый Nightscout)
+_session_pool = {
+    'sessions': {},
+    'lock': threading.Lock()
+}
+
+# Управление текущим циклом: флаг отмены по дедлайну
+_cycle_control = {
+    'cancel': threading.Event()
+}
+
+# Время (мс) самого свежего показания, отправленного в Nightscout
+_latest_reading = {
+    'time': None
+}
+
+# Расписание опроса мастеров: from_user_id -> {last_reading, next_poll, silent_polls}
+_poll_schedule = {
+    'masters': {},
+    'lock': threading.Lock()
+}
+
+# Окна последних показаний мастеров для расчёта тренда: from_user_id -> TrendWindow
+_trend_windows = {
+    'masters': {},
+    'lock': threading.Lock()
+}
+
+# Выполняющиеся запросы данных Ottai: from_user_id -> [{start, end, items, done}]
+_ottai_flights = {
+    'masters': {},
+    'lock': threading.Lock()
+}
+
+# Поддержка gzip хостами Nightscout: host -> (принимает ли, время проверки).
+# Хост без записи ещё не проверялся — ему отправляется сжатое тело
+_gzip_hosts = {
+    'hosts': {},
+    'lock': threading.Lock()
+}
+
+# Конфигурации мастеров между циклами: from_user_id -> (отпечаток, user_config)
+_user_config_cache = {}
+
+# Очередь отправки: мастера с очередью (state_key -> user_config), мастера,
+# очередь которых сейчас отправляется, и фоновый поток досылки
+_outbox = {
+    'masters': {},
+    'draining': set(),
+    'thread': None,
+    'stop': threading.Event(),
+    'lock': threading.Lock()
+}
+
 # ========== ОПТИМИЗИРОВАННЫЕ ФУНКЦИИ ==========
+def format_local_time(timestamp_ms, fmt='%Y-%m-%d %H:%M:%S'):
+    """Локальное время из отметки в мс (для сообщений лога)"""
+    return datetime.datetime.fromtimestamp(timestamp_ms / 1000).strftime(fmt)
+
 def convert_mmoll_to_mgdl(x):
     """Конвертация ммоль/л в мг/дл"""
     try:
@@ -44,56 +193,247 @@ def convert_mmoll_to_mgdl(x):
     except (TypeError, ValueError):
         return 0
 
-def get_session():
-    """Создание HTTP сессии с настройками SSL"""
+def _create_session():
+    """Создание HTTP сессии с пулом соединений и настройками SSL"""
     session = requests.Session()
     
+    # Соединений на хост — не меньше потоков, обращающихся к нему одновременно
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=max(CONFIG['max_workers'], PIPELINE_FETCH_WORKERS, PIPELINE_UPLOAD_WORKERS))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    
     if DISABLE_SSL_VERIFY:
         session.verify = False
     
     return session
 
-def get_all_users_from_ottai_cached(force_refresh=False):
+def get_session(url, owner=None):
     """
-    Получение списка всех пользователей из Ottai с кэшированием
+    HTTP сессия для хоста из url (создаётся один раз и переиспользуется между циклами,
+    чтобы не повторять TCP/TLS рукопожатия). owner — владелец отдельной сессии
+    (аккаунт фолловера): у каждого аккаунта свои соединения и cookies Ottai
     """
-    current_time = time.time()
+    host = urlparse(url).netloc or url
+    key = host if owner is None else f"{owner}|{host}"
+    
+    with _session_pool['lock']:
+        session = _session_pool['sessions'].get(key)
+        if session is None:
+            session = _create_session()
+            _session_pool['sessions'][key] = session
     
-    if not force_refresh and _user_cache['data'] is not None:
-        if current_time - _user_cache['timestamp'] < 300:
-            print(f"[INFO] Используем кэшированный список пользователей")
-            return _user_cache['data']
+    return session
+
+def close_all_sessions():
+    """Закрытие всех HTTP сессий (при завершении программы)"""
+    with _session_pool['lock']:
+        sessions = list(_session_pool['sessions'].values())
+        _session_pool['sessions'].clear()
+    
+    for session in sessions:
+        try:
+            session.close()
+        except Exception:
+            pass
+
+atexit.register(close_all_sessions)
+
+def ottai_slot_delay(account):
+    """Резерв разрешения лимитера запросов аккаунта к Ottai; возвращает задержку (с)"""
+    delay = account.limiter.reserve()
+    if delay > 0:
+        metrics.OTTAI_RATE_LIMIT_WAIT.inc(delay, account=account.name)
+        logger.debug("Лимит запросов Ottai (аккаунт %s): ожидание %.1f с", account.name, delay)
+    return delay
+
+def throttle_ottai(account, retry_after):
+    """Ответ 429 от Ottai: выдача разрешений аккаунту приостанавливается на Retry-After"""
+    pause = parse_retry_after(retry_after)
+    account.limiter.pause(pause)
+    metrics.OTTAI_THROTTLED.inc(account=account.name)
+    logger.warning("⚠️ Ottai ограничил частоту запросов аккаунта %s (429), пауза %.0f с", account.name, pause)
+
+def ottai_account_paused(account):
+    """
+    Запрос аккаунта на паузе после 429 не выполняется, если аккаунтов несколько:
+    общие потоки не ждут конца паузы, мастер будет опрошен в следующем цикле
+    """
+    pause = account.limiter.paused_for()
+    if pause <= 0 or len(get_accounts()) < 2:
+        return False
     
-    with _user_cache['lock']:
-        if not force_refresh and _user_cache['data'] is not None:
-            if current_time - _user_cache['timestamp'] < 300:
-                return _user_cache['data']
+    logger.info("Запрос к Ottai отложен: аккаунт %s на паузе после 429 ещё %.0f с", account.name, pause)
+    return True
+
+def _ottai_request(account, send):
+    """
+    Запрос к Ottai через лимитер аккаунта: send() выполняет запрос и возвращает ответ.
+    На 429 — пауза по Retry-After и повтор (не больше OTTAI_THROTTLE_RETRIES раз).
+    Возвращает ответ или None, если цикл отменён во время ожидания или запрос
+    отложен (аккаунт на паузе)
+    """
+    for attempt in range(OTTAI_THROTTLE_RETRIES + 1):
+        if ottai_account_paused(account) or wait_cycle_cancelled(ottai_slot_delay(account)):
+            return None
         
-        users = _get_all_users_from_ottai_raw()
+        response = send()
+        if response.status_code != 429 or attempt == OTTAI_THROTTLE_RETRIES:
+            return response
         
-        _user_cache['data'] = users
-        _user_cache['timestamp'] = current_time
+        throttle_ottai(account, response.headers.get('Retry-After'))
+        response.close()
+
+def get_all_users_from_ottai_cached(force_refresh=False):
+    """
+    Получение списка всех пользователей из Ottai (всех аккаунтов фолловеров) с
+    кэшированием (stale-while-revalidate): список старше USER_LIST_TTL
+    возвращается сразу, а обновляется в фоне.
+    Если Ottai не вернул список, используется последний сохранённый на диске.
+    force_refresh — загрузка без кэша (при ошибке — тоже последний сохранённый)
+    """
+    accounts = get_accounts()
+    return _merge_account_users(accounts, [_get_account_users(account, force_refresh) for account in accounts])
+
+def _get_account_users(account, force_refresh):
+    """Список мастеров одного аккаунта (stale-while-revalidate)"""
+    cache = account.user_cache
+    if not force_refresh:
+        if cache['data'] is None:
+            _load_saved_user_list(account)
         
-        return users
+        users = cache['data']
+        if users is not None:
+            if time.time() - cache['timestamp'] >= USER_LIST_TTL:
+                _start_user_list_refresh(account)
+            else:
+                logger.debug("Используем кэшированный список пользователей (аккаунт %s)", account.name)
+            return users
+    
+    # Списка ещё нет (или нужен свежий) — загружаем синхронно
+    if not _refresh_user_list(account) and cache['data'] is None:
+        _load_saved_user_list(account)
+    return cache['data'] or []
 
-def _get_all_users_from_ottai_raw():
+def _merge_account_users(accounts, user_lists):
     """
-    Получение списка всех пользователей из Ottai (без кэширования)
+    Объединение списков аккаунтов. Мастер, доступный нескольким аккаунтам,
+    обрабатывается один раз — через первый из них.
+    Объект результата меняется только при замене списка какого-либо аккаунта
     """
+    sources = tuple(user_lists)
+    if _merged_users['users'] is not None and len(sources) == len(_merged_users['sources']) \
+            and all(a is b for a, b in zip(sources, _merged_users['sources'])):
+        return _merged_users['users']
+    
+    if len(user_lists) == 1:
+        merged = user_lists[0]
+    else:
+        owners = {}
+        merged = []
+        for account, users in zip(accounts, user_lists):
+            for user in users:
+                user_id = str(user['fromUserId'])
+                if user_id in owners:
+                    logger.info("Мастер %s (ID: %s) доступен аккаунтам %s и %s, используется %s",
+                                user['email'] or user.get('userName') or user_id, user_id,
+                                owners[user_id], account.name, owners[user_id])
+                    continue
+                owners[user_id] = account.name
+                merged.append(user)
+    
+    _merged_users['sources'] = sources
+    _merged_users['users'] = merged
+    return merged
+
+def _load_saved_user_list(account):
+    """Последний сохранённый список (первый запуск): используется, пока не загружен свежий"""
+    saved_users, saved_at = load_user_list(account.name)
+    if not saved_users:
+        return
+    
+    for user in saved_users:
+        user['account'] = account.name
+    
+    cache = account.user_cache
+    with cache['lock']:
+        if cache['data'] is None:
+            cache['data'] = saved_users
+            logger.info("Используем сохранённый список пользователей аккаунта %s (от %s)",
+                        account.name, format_local_time(saved_at * 1000))
+
+def _user_list_fingerprint(users):
+    return [(user['email'], str(user['fromUserId']), user.get('userName', '')) for user in users]
+
+def _refresh_user_list(account):
+    """
+    Загрузка списка аккаунта из Ottai. Пустой ответ считается ошибкой: прежний список сохраняется.
+    Объект списка заменяется только при изменении состава мастеров.
+    Возвращает True при успехе
+    """
+    users = _get_all_users_from_ottai_raw(account)
+    
+    cache = account.user_cache
+    with cache['lock']:
+        if not users:
+            cache['retry_at'] = time.time() + USER_LIST_RETRY_SECONDS
+            if cache['data'] is not None:
+                logger.warning("⚠️ Не удалось обновить список пользователей аккаунта %s, используем прежний",
+                               account.name)
+            return False
+        
+        current = cache['data']
+        if current is None or _user_list_fingerprint(current) != _user_list_fingerprint(users):
+            if current is not None:
+                logger.info("Список пользователей аккаунта %s изменился", account.name)
+            cache['data'] = users
+            save_user_list(account.name, users)
+        cache['timestamp'] = time.time()
+        cache['retry_at'] = 0
+        return True
+
+def _refresh_user_list_background(account):
     try:
-        url = f"{OTTAI_BASE_URL}/link/application/app/tagFromInviteLink/linkQueryList/v2"
-        headers = get_common_ottai_headers()
+        _refresh_user_list(account)
+    except Exception as e:
+        logger.exception("Ошибка фонового обновления списка пользователей: %s", e)
+    finally:
+        account.user_cache['refreshing'] = False
+
+def _start_user_list_refresh(account):
+    """Фоновое обновление списка (не чаще одного одновременно и не раньше паузы после ошибки)"""
+    cache = account.user_cache
+    with cache['lock']:
+        if cache['refreshing'] or time.time() < cache['retry_at']:
+            return
+        cache['refreshing'] = True
+    
+    logger.debug("Обновляем список пользователей аккаунта %s в фоне", account.name)
+    threading.Thread(target=_refresh_user_list_background, args=(account,),
+                     name=f'user-list-refresh-{account.name}', daemon=True).start()
+
+def _get_all_users_from_ottai_raw(account):
+    """
+    Получение списка всех пользователей аккаунта фолловера из Ottai (без кэширования)
+    """
+    try:
+        url = f"{account.base_url}/link/application/app/tagFromInviteLink/linkQueryList/v2"
+        headers = account.headers()
         headers['content-length'] = '0'
         
-        print(f"[INFO] Запрос списка пользователей из Ottai...")
+        logger.debug("Запрос списка пользователей из Ottai (аккаунт %s)...", account.name)
         
-        session = get_session()
-        response = session.post(url, headers=headers, timeout=REQUEST_TIMEOUT, verify=not DISABLE_SSL_VERIFY)
+        session = get_session(account.base_url, account.name)
+        response = _ottai_request(account, lambda: session.post(url, headers=headers, timeout=CONFIG['request_timeout'],
+                                                       verify=not DISABLE_SSL_VERIFY))
+        if response is None:
+            return []
         
         if response.status_code != 200:
-            print(f"[ERROR] Ошибка запроса пользователей: {response.status_code}")
-            if response.text:
-                print(f"[DEBUG] Тело ответа: {response.text[:500]}")
+            logger.error("Ошибка запроса пользователей: %s", response.status_code)
+            if logger.isEnabledFor(logging.DEBUG) and response.text:
+                logger.debug("Тело ответа: %s", response.text[:500])
             return []
         
         data = response.json()
@@ -115,6 +455,7 @@ def _get_all_users_from_ottai_raw():
                         'email': email or '',
                         'fromUserId': user_id,
                         'userName': user_name,
+                        'account': account.name,
                         'raw_data': user_item
                     })
 
@@ -131,48 +472,46 @@ def _get_all_users_from_ottai_raw():
                     'email': '',
                     'fromUserId': str(single_id),
                     'userName': '',
+                    'account': account.name,
                     'raw_data': data
                 })
 
         # Fallback: OTTAI_CUSTOMER_ID из переменной окружения
-        if not users and OTTAI_CUSTOMERID:
-            print(f"[INFO] Список пользователей пуст, используем OTTAI_CUSTOMER_ID={OTTAI_CUSTOMERID}")
+        if not users and account.customer_id:
+            logger.info("Список пользователей пуст, используем OTTAI_CUSTOMER_ID=%s", account.customer_id)
             users.append({
                 'email': '',
-                'fromUserId': OTTAI_CUSTOMERID,
+                'fromUserId': account.customer_id,
                 'userName': '',
+                'account': account.name,
                 'raw_data': {}
             })
 
-        print(f"[INFO] Найдено пользователей: {len(users)}")
+        logger.info("Найдено пользователей: %d (аккаунт %s)", len(users), account.name)
         return users
         
     except requests.exceptions.Timeout:
-        print(f"[ERROR] Таймаут при запросе пользователей")
+        logger.error("Таймаут при запросе пользователей")
         return []
     except requests.exceptions.SSLError as e:
-        print(f"[ERROR] SSL ошибка: {e}")
+        logger.error("SSL ошибка: %s", e)
         return []
     except Exception as e:
-        print(f"[ERROR] Ошибка при получении пользователей: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Ошибка при получении пользователей: %s", e)
         return []
 
-def display_available_masters(all_users):
+def display_available_masters(all_users, index=None):
     """
-    Отображение всех доступных мастеров
+    Отображение всех доступных мастеров (index — MasterIndex этого списка)
     """
-    print("\n" + "="*80)
-    print("ДОСТУПНЫЕ МАСТЕРЫ В OTTAI")
-    print("="*80)
-    
     if not all_users:
-        print("❌ Нет доступных мастеров в Ottai")
+        logger.error("❌ Нет доступных мастеров в Ottai")
         return []
 
-    print(f"Всего мастеров в Ottai: {len(all_users)}")
-    print("\nСписок мастеров:")
-    print("-"*80)
+    if index is None:
+        index = MasterIndex(all_users)
+
+    logger.info("Всего мастеров в Ottai: %d", len(all_users))
 
     master_statuses = []
 
@@ -180,220 +519,544 @@ def display_available_masters(all_users):
         email = user['email']
         user_id = user['fromUserId']
         user_name = user.get('userName', '')
-        clean_email = extract_clean_email(email)
+        resolved = index.get(user_id)
 
-        ns_url, ns_secret = get_nightscout_config_by_email(clean_email or email, user_name, user_id)
-        status = "✅ НАСТРОЕН" if ns_url and ns_secret else "❌ НЕ НАСТРОЕН"
-
-        config_key = "—"
-        if ns_url and ns_secret:
-            config_key = normalize_email_key(clean_email or email) or user_name or str(user_id) or "unknown"
+        status = "✅ НАСТРОЕН" if resolved else "❌ НЕ НАСТРОЕН"
+        config_key = f"{resolved.config_key} (по {resolved.tier})" if resolved else "—"
         
         master_statuses.append({
             'index': idx,
             'email': email,
-            'clean_email': clean_email,
+            'clean_email': resolved.email if resolved else extract_clean_email(email),
             'user_name': user_name,
             'user_id': user_id,
-            'configured': bool(ns_url and ns_secret),
-            'config_key': config_key
+            'configured': resolved is not None,
+            'config_key': resolved.config_key if resolved else "—",
+            'tier': resolved.tier if resolved else None
         })
 
-        print(f"{idx:2d}. {email or f'(нет email, userName={user_name})'}")
-        print(f"    ID: {user_id}")
-        if user_name:
-            print(f"    userName: {user_name}")
-        print(f"    Статус: {status}")
-        if ns_url and ns_secret:
-            print(f"    Конфиг: {config_key}")
-            print(f"    Nightscout URL: {ns_url[:50]}...")
-        print()
+        # Настроенные мастера — только на уровне DEBUG (иначе список выводился бы
+        # каждый цикл), ненастроенные — на INFO, чтобы было видно, кого настроить
+        logger.log(logging.DEBUG if resolved else logging.INFO,
+                   "%2d. %s | ID: %s | userName: %s | %s | конфиг: %s | Nightscout URL: %s",
+                   idx, email or '(нет email)', user_id, user_name or '—', status,
+                   config_key, resolved.ns_url[:50] if resolved else '—')
     
     return master_statuses
 
-def create_user_config(user_email, from_user_id, user_name=None):
+def create_user_config(user_email, from_user_id, user_name=None, account=None):
     """
-    Создание конфигурации пользователя
+    Создание конфигурации пользователя. account — имя аккаунта фолловера,
+    через который доступен мастер (по умолчанию — первый).
+    Конфигурация Nightscout берётся из индекса настроенных мастеров (при его
+    отсутствии — ищется заново). Конфигурация кэшируется между циклами и
+    пересоздаётся только при изменении NS_URL__*/NS_SECRET__* или данных мастера
     """
-    ns_url, ns_secret = get_nightscout_config_by_email(user_email, user_name, from_user_id)
+    account = get_account(account)
+    resolved = _resolved_master(user_email, from_user_id, user_name or '', account.name)
 
-    if not ns_url or not ns_secret:
+    if resolved is None:
+        _user_config_cache.pop(str(from_user_id), None)
         return None
 
-    config_key = normalize_email_key(user_email) or user_name or str(from_user_id)
-    
+    cached = _user_config_cache.get(str(from_user_id))
+    if cached and cached[0] == resolved:
+        user_config = cached[1]
+        # Заголовки Ottai содержат timestamp и traceid — обновляем их каждый цикл
+        user_config['ottai_headers'] = account.headers()
+        return user_config
+
     user_config = {
         'email': user_email,
         'from_user_id': from_user_id,
-        'ns_url': ns_url.rstrip('/'),
-        'ns_secret': ns_secret,
-        'config_key': config_key,
-        'ns_uploder': f"Ottai-{config_key}",
-        'session': get_session()
+        'ns_url': resolved.ns_url,
+        'ns_secret': resolved.ns_secret,
+        'config_key': resolved.config_key,
+        'ns_uploder': resolved.ns_uploder,
+        'ns_header': resolved.ns_header,
+        'account': account,
+        'session': get_session(resolved.ns_url),
+        'ottai_session': get_session(account.base_url, account.name)
     }
     
-    user_config['ns_header'] = {
-        "api-secret": get_hash_SHA1(ns_secret),
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
+    user_config['ottai_headers'] = account.headers()
     
-    user_config['ottai_headers'] = get_common_ottai_headers()
+    _user_config_cache[str(from_user_id)] = (resolved, user_config)
     
     return user_config
 
-def check_nightscout_connection_cached(user_config):
+def _resolved_master(user_email, from_user_id, user_name, account_name):
+    """Конфигурация Nightscout мастера: из актуального индекса или поиском по цепочке"""
+    index = _user_list_resolution['index']
+    if index is not None and index.generation == get_nightscout_config_generation():
+        resolved = index.get(from_user_id)
+        if resolved is not None and resolved.email == user_email and resolved.user_name == user_name \
+                and resolved.account == account_name:
+            return resolved
+    
+    return resolve_master(user_email, from_user_id, user_name, account_name)
+
+def get_cached_nightscout_status(user_config):
     """
-    Проверка соединения с Nightscout (с кэшированием)
+    Закэшированное состояние Nightscout или None, если кэш устарел
     """
-    cache_key = f"{user_config['email']}_connection"
-    current_time = time.time()
+    cache_key = f"{user_config['ns_url']}|{user_config['ns_uploder']}"
     
     if cache_key in _connection_cache:
         cached_result, timestamp = _connection_cache[cache_key]
-        if current_time - timestamp < 60:
+        if time.time() - timestamp < 60:
             return cached_result
     
-    result = _check_nightscout_connection_raw(user_config)
-    _connection_cache[cache_key] = (result, current_time)
+    return None
+
+def store_nightscout_status(user_config, result):
+    """Сохранение состояния Nightscout в кэш"""
+    cache_key = f"{user_config['ns_url']}|{user_config['ns_uploder']}"
+    _connection_cache[cache_key] = (result, time.time())
+
+def _get_nightscout_status_cached(user_config):
+    """
+    Состояние Nightscout (с кэшированием): (доступен, date последней записи этого загрузчика)
+    """
+    result = get_cached_nightscout_status(user_config)
+    
+    if result is None:
+        result = _check_nightscout_connection_raw(user_config)
+        store_nightscout_status(user_config, result)
     
     return result
 
+def check_nightscout_connection_cached(user_config):
+    """
+    Проверка соединения с Nightscout (с кэшированием)
+    """
+    return _get_nightscout_status_cached(user_config)[0]
+
+def get_nightscout_last_entry_date_cached(user_config):
+    """
+    Дата (мс) последней записи этого загрузчика в Nightscout или None
+    """
+    return _get_nightscout_status_cached(user_config)[1]
+
+def remember_nightscout_last_date(user_config, last_date):
+    """Обновление кэшированной даты последней записи после успешной отправки"""
+    cache_key = f"{user_config['ns_url']}|{user_config['ns_uploder']}"
+    cached = _connection_cache.get(cache_key)
+    if cached:
+        (available, cached_date), timestamp = cached
+        if cached_date is None or last_date > cached_date:
+            _connection_cache[cache_key] = ((available, last_date), timestamp)
+
+def nightscout_last_entry_request(user_config):
+    """URL и параметры запроса последней записи этого загрузчика"""
+    url = f"{user_config['ns_url']}/api/v1/entries.json"
+    params = {
+        'count': 1,
+        'find[device]': user_config['ns_uploder'],
+    }
+    return url, params
+
+def parse_nightscout_last_date(data):
+    """date последней записи из ответа /api/v1/entries.json или None"""
+    try:
+        if isinstance(data, list) and data and data[0].get('date') is not None:
+            return int(data[0]['date'])
+    except (ValueError, TypeError, AttributeError):
+        pass
+    return None
+
 def _check_nightscout_connection_raw(user_config):
     """
-    Проверка соединения с Nightscout (без кэширования)
+    Проверка соединения с Nightscout (без кэширования).
+    Вместо /api/v1/status запрашиваем последнюю запись этого загрузчика —
+    один запрос даёт и доступность, и точку дедупликации
     """
+    url, params = nightscout_last_entry_request(user_config)
+    session = user_config['session']
+    breaker = get_breaker(user_config['ns_url'])
+    
     try:
-        base_url = user_config['ns_url']
-        url = f"{base_url}/api/v1/status"
-        
-        session = user_config['session']
-        response = session.get(url, headers=user_config['ns_header'], timeout=10, verify=not DISABLE_SSL_VERIFY)
-        
-        return response.status_code == 200
+        breaker.before_request()
+    except CircuitOpenError as e:
+        logger.warning("Nightscout: %s", e)
+        return False, None
+    
+    try:
+        try:
+            response = session.get(url, headers=user_config['ns_header'], params=params,
+                                   timeout=10, verify=not DISABLE_SSL_VERIFY)
+        except requests.exceptions.SSLError as e:
+            logger.warning("SSL ошибка при проверке Nightscout: %s", e)
+            response = session.get(url, headers=user_config['ns_header'], params=params,
+                                   timeout=10, verify=False)
+    except Exception as e:
+        breaker.record_failure(type(e).__name__)
+        logger.warning("Ошибка при проверке Nightscout: %s", e)
+        return False, None
+    
+    if is_server_error(response.status_code):
+        breaker.record_failure(f"HTTP {response.status_code}")
+    else:
+        breaker.record_success()
+    
+    if response.status_code != 200:
+        logger.warning("Проверка Nightscout: HTTP %s", response.status_code)
+        return False, None
+    
+    try:
+        return True, parse_nightscout_last_date(response.json())
+    except ValueError:
+        return True, None
+
+def extract_curve_list(data):
+    """
+    Извлечение curveList из ответа queryMonitorBase (пробуем разные пути к данным)
+    """
+    curve_list = None
+    
+    if isinstance(data, list):
+        curve_list = data
+    elif 'data' in data:
+        if isinstance(data['data'], dict) and 'curveList' in data['data']:
+            curve_list = data['data']['curveList']
+        elif isinstance(data['data'], list):
+            curve_list = data['data']
+    elif 'curveList' in data and isinstance(data['curveList'], list):
+        curve_list = data['curveList']
+    
+    return curve_list
+
+def _extract_curve_list_or_dump(data):
+    """extract_curve_list с выводом полного ответа (только при DEBUG), если curveList нет"""
+    curve_list = extract_curve_list(data)
+    if not curve_list and DEBUG:
+        logger.debug("Полный ответ: %s", json.dumps(data, indent=2))
+    return curve_list
+
+def _open_ottai_stream(user_config, url, params):
+    """GET к Ottai с потоковым чтением тела; при SSL-ошибке — без проверки сертификата"""
+    session = user_config['ottai_session']
+    try:
+        return session.get(url,
+                           headers=user_config['ottai_headers'],
+                           params=params,
+                           timeout=CONFIG['request_timeout'],
+                           verify=not DISABLE_SSL_VERIFY,
+                           stream=True)
+    except requests.exceptions.SSLError:
+        return session.get(url,
+                           headers=user_config['ottai_headers'],
+                           params=params,
+                           timeout=CONFIG['request_timeout'],
+                           verify=False,
+                           stream=True)
+
+def _join_ottai_flight(user_id, start_time, end_time):
+    """
+    Выполняющийся запрос мастера, окно которого покрывает [start_time, end_time].
+    Возвращает (запрос, False) или новый запрос и True (текущий поток — ведущий)
+    """
+    with _ottai_flights['lock']:
+        flights = _ottai_flights['masters'].setdefault(user_id, [])
+        for flight in flights:
+            if flight['start'] <= start_time and flight['end'] + OTTAI_COALESCE_SLACK_MS >= end_time:
+                return flight, False
         
-    except requests.exceptions.SSLError as e:
-        print(f"[WARNING] SSL ошибка при проверке Nightscout: {e}")
+        flight = {'start': start_time, 'end': end_time, 'items': None, 'done': threading.Event()}
+        flights.append(flight)
+        return flight, True
+
+def _finish_ottai_flight(user_id, flight, items):
+    """Завершение запроса: items — записи ответа или None, если ответ прочитан не полностью"""
+    with _ottai_flights['lock']:
+        flights = _ottai_flights['masters'].get(user_id, [])
+        flights.remove(flight)
+        if not flights:
+            del _ottai_flights['masters'][user_id]
+    
+    flight['items'] = items
+    flight['done'].set()
+
+class OttaiFetchError(Exception):
+    """Окно мастера не загружено из Ottai полностью: ошибка запроса, пауза аккаунта или отмена цикла"""
+
+def items_in_window(curve_list, start_time, end_time):
+    """Записи ответа Ottai из окна [start_time, end_time] (для объединённого запроса)"""
+    for item in curve_list:
+        monitor_time = item.get('monitorTime')
+        if monitor_time is None:
+            yield item
+            continue
         try:
-            session = user_config['session']
-            response = session.get(url, headers=user_config['ns_header'], timeout=10, verify=False)
-            return response.status_code == 200
-        except:
-            return False
-    except Exception:
-        return False
+            in_window = start_time <= int(monitor_time) <= end_time
+        except (TypeError, ValueError):
+            # Некорректную запись пропустит и отбор новых записей
+            continue
+        if in_window:
+            yield item
 
-def get_ottai_data_batch(user_config, start_time, end_time):
+def iter_ottai_data(user_config, start_time, end_time):
     """
-    Получение данных из Ottai пакетами (использует GET запрос)
+    Потоковое получение записей curveList из Ottai (генератор).
+    Записи выдаются по мере чтения ответа. Одновременный запрос того же мастера
+    с покрывающим окном не повторяется: используются записи уже выполняющегося.
+    Если окно не загружено до конца — OttaiFetchError (после выданных записей)
     """
+    user_id = str(user_config['from_user_id'])
+    flight, leader = _join_ottai_flight(user_id, start_time, end_time)
+    
+    if not leader:
+        while not flight['done'].wait(1.0):
+            if cycle_cancelled():
+                raise OttaiFetchError("цикл отменён")
+        if flight['items'] is not None:
+            metrics.OTTAI_COALESCED.inc()
+            logger.debug("Запрос данных Ottai объединён с уже выполняющимся")
+            yield from items_in_window(flight['items'], start_time, end_time)
+            return
+        # Ведущий запрос прерван — загружаем сами
+        yield from _stream_ottai_data(user_config, start_time, end_time)
+        return
+    
+    items = []
+    complete = False
+    try:
+        for item in _stream_ottai_data(user_config, start_time, end_time):
+            items.append(item)
+            yield item
+        complete = True
+    finally:
+        _finish_ottai_flight(user_id, flight, items if complete else None)
+
+def _stream_ottai_data(user_config, start_time, end_time):
+    """
+    Запрос окна мастера к Ottai с разбором ответа по мере чтения (генератор).
+    Ошибка запроса, пауза аккаунта или отмена цикла — OttaiFetchError
+    """
+    url = f"{user_config['account'].base_url}/link/application/search/tag/queryMonitorBase"
+    
+    # Формируем параметры для GET-запроса
+    params = {
+        'fromUserId': user_config['from_user_id'],
+        'isOpen': 0,
+        'startTime': start_time,
+        'endTime': end_time
+    }
+    
+    logger.debug("Запрос данных Ottai: %.1f минут", (end_time - start_time) / 1000 / 60)
+    if DEBUG:
+        logger.debug("URL: %s, параметры: %s", url, params)
+    
+    # Время загрузки — до конца ответа (записи разбираются по мере чтения)
+    started = time.monotonic()
     try:
-        url = f"{OTTAI_BASE_URL}/link/application/search/tag/queryMonitorBase"
-        session = user_config['session']
-        
-        # Формируем параметры для GET-запроса
-        params = {
-            'fromUserId': user_config['from_user_id'],
-            'isOpen': 0,
-            'startTime': start_time,
-            'endTime': end_time
-        }
-        
-        print(f"[DEBUG] Запрос данных Ottai для {user_config['email']}")
-        print(f"[DEBUG] Метод: GET")
-        print(f"[DEBUG] URL: {url}")
-        print(f"[DEBUG] Параметры: {json.dumps(params, indent=2)}")
-        print(f"[DEBUG] Start time: {datetime.datetime.fromtimestamp(start_time/1000).strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"[DEBUG] End time: {datetime.datetime.fromtimestamp(end_time/1000).strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"[DEBUG] Time range: {(end_time - start_time) / 1000 / 60:.1f} минут")
-        
-        response = session.get(url, 
-                             headers=user_config['ottai_headers'], 
-                             params=params,
-                             timeout=REQUEST_TIMEOUT,
-                             verify=not DISABLE_SSL_VERIFY)
-        
-        print(f"[DEBUG] Статус ответа Ottai: {response.status_code}")
+        with profiling.span('ottai_fetch'):
+            response = _ottai_request(user_config['account'], lambda: _open_ottai_stream(user_config, url, params))
+        if response is None:
+            raise OttaiFetchError("запрос отложен: аккаунт на паузе или цикл отменён")
         
-        if response.status_code != 200:
-            print(f"[ERROR] Ошибка запроса Ottai: {response.status_code}")
-            if response.text:
-                print(f"[DEBUG] Тело ответа: {response.text[:500]}")
-            return []
+        with response:
+            if response.status_code != 200:
+                logger.error("Ошибка запроса Ottai: %s", response.status_code)
+                if logger.isEnabledFor(logging.DEBUG) and response.text:
+                    logger.debug("Тело ответа: %s", response.text[:500])
+                raise OttaiFetchError(f"HTTP {response.status_code}")
+            
+            parser = CurveListStreamParser(fallback=_extract_curve_list_or_dump)
+            count = 0
+            
+            chunks = response.iter_content(chunk_size=OTTAI_STREAM_CHUNK_SIZE)
+            
+            # Замеры фаз не охватывают yield: время обработки записей
+            # относится к вызывающей фазе
+            while True:
+                with profiling.span('ottai_fetch'):
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                with profiling.span('json_decode'):
+                    items = parser.feed(chunk)
+                for item in items:
+                    count += 1
+                    yield item
+            
+            with profiling.span('json_decode'):
+                items = parser.close()
+            for item in items:
+                count += 1
+                yield item
+            
+            logger.debug("Найдено записей в curveList: %d", count)
         
-        data = response.json()
-        print(f"[DEBUG] Успешно получен ответ от Ottai")
-        print(f"[DEBUG] Структура ответа (первые 500 символов): {json.dumps(data, indent=2)[:500]}...")
-        
-        curve_list = None
-        
-        # Пробуем разные пути к данным
-        if 'data' in data:
-            if isinstance(data['data'], dict) and 'curveList' in data['data']:
-                curve_list = data['data']['curveList']
-            elif isinstance(data['data'], list):
-                curve_list = data['data']
-        elif 'curveList' in data and isinstance(data['curveList'], list):
-            curve_list = data['curveList']
-        elif isinstance(data, list):
-            curve_list = data
-        
-        if curve_list:
-            print(f"[DEBUG] Найдено записей в curveList: {len(curve_list)}")
-            if len(curve_list) > 0:
-                first_item = curve_list[0]
-                print(f"[DEBUG] Первая запись: {json.dumps(first_item, indent=2)[:200]}...")
+    except OttaiFetchError:
+        raise
+    except Exception as e:
+        logger.exception("Ошибка при загрузке данных Ottai: %s", e)
+        raise OttaiFetchError(str(e)) from e
+    finally:
+        metrics.OTTAI_FETCH_DURATION.observe(time.monotonic() - started, config_key=user_config['config_key'])
+
+def get_ottai_data_batch(user_config, start_time, end_time):
+    """
+    Получение данных из Ottai: список записей curveList или None, если окно
+    не загружено полностью (ошибка, пауза аккаунта, отмена цикла)
+    """
+    try:
+        return list(iter_ottai_data(user_config, start_time, end_time))
+    except OttaiFetchError as e:
+        logger.debug("Окно Ottai не загружено: %s", e)
+        return None
+
+def get_trend_window(user_config):
+    """Окно последних показаний мастера (живёт между циклами)"""
+    key = str(user_config['from_user_id'])
+    
+    with _trend_windows['lock']:
+        window = _trend_windows['masters'].get(key)
+        if window is None:
+            window = TrendWindow()
+            _trend_windows['masters'][key] = window
+    
+    return window
+
+def _apply_trend(store, trend_window):
+    """
+    Расчёт direction и delta по скользящему окну (O(1) на показание).
+    Направление из самих данных Ottai (trend/direction) имеет приоритет.
+    Хранилище упорядочено по времени
+    """
+    # Показания старше окна мастера (повторная отправка, перекрытие) считаем
+    # по предыдущим показаниям этой же пачки
+    batch_window = TrendWindow()
+    newest = trend_window.readings[-1][0] if trend_window.readings else None
+    
+    for index, (date, sgv) in enumerate(zip(store.dates, store.sgv)):
+        if newest is not None and date <= newest:
+            direction, delta = batch_window.push(date, sgv)
+            if direction is None:
+                direction, delta = trend_window.push(date, sgv)
         else:
-            print(f"[DEBUG] curveList не найден или пуст")
-            print(f"[DEBUG] Полный ответ: {json.dumps(data, indent=2)}")
+            direction, delta = trend_window.push(date, sgv)
         
-        return curve_list or []
+        if direction is not None:
+            store.set_trend(index, direction, delta)
+
+def _detect_schema(first):
+    """
+    Определение схемы ответа по первой записи:
+    (ключ глюкозы, ключ времени, ключи, которых не должно быть в записях) или None
+    """
+    glucose_key = next((key for key in GLUCOSE_KEYS if first.get(key) is not None), None)
+    timestamp_key = next((key for key in TIMESTAMP_KEYS if first.get(key) is not None), None)
+    
+    if glucose_key is None or timestamp_key is None:
+        return None
+    
+    # Ключи с большим приоритетом должны отсутствовать, иначе поштучная
+    # подготовка выбрала бы их
+    shadowing_keys = GLUCOSE_KEYS[:GLUCOSE_KEYS.index(glucose_key)] \
+        + TIMESTAMP_KEYS[:TIMESTAMP_KEYS.index(timestamp_key)] + ['trend', 'direction']
+    
+    return glucose_key, timestamp_key, shadowing_keys
+
+def _parse_data_no(value):
+    """dataNo записи Ottai (NO_DATA_NO, если его нет или он некорректен)"""
+    try:
+        data_no = value if type(value) is int else int(value)
+    except (TypeError, ValueError):
+        return NO_DATA_NO
+    # dataNo хранится в int64
+    return data_no if -MAX_DATA_NO <= data_no <= MAX_DATA_NO else NO_DATA_NO
+
+def _convert_glucose_values(values):
+    """Пакетная конвертация ммоль/л в мг/дл (как convert_mmoll_to_mgdl)"""
+    if np is not None:
+        return (np.array(values, dtype=np.float64) * NS_UNIT_CONVERT + 0.5).astype(np.int64).tolist()
+    
+    return [int(float(value) * NS_UNIT_CONVERT + 0.5) for value in values]
+
+def _prepare_readings_batch(curve_list, store):
+    """
+    Пакетная подготовка показаний за один проход: схема определяется по первой записи,
+    конвертация выполняется по колонкам.
+    Записи, начиная с первой не подходящей под схему, готовятся поштучно —
+    результат совпадает с поштучной подготовкой
+    """
+    items = iter(curve_list)
+    first = next(items, None)
+    if first is None:
+        return
+    
+    items = itertools.chain([first], items)
+    schema = _detect_schema(first)
+    if schema is None:
+        _prepare_readings_per_item(items, store)
+        return
+    glucose_key, timestamp_key, shadowing_keys = schema
+    
+    glucose_values = []
+    timestamps = []
+    data_numbers = []
+    rest = None
+    
+    for item in items:
+        glucose = item.get(glucose_key)
+        timestamp = item.get(timestamp_key)
+        glucose_type = type(glucose)
         
-    except requests.exceptions.SSLError:
-        try:
-            session = user_config['session']
-            response = session.get(url, 
-                                 headers=user_config['ottai_headers'], 
-                                 params=params,
-                                 timeout=REQUEST_TIMEOUT,
-                                 verify=False)
-            if response.status_code == 200:
-                data = response.json()
-                if 'data' in data and isinstance(data['data'], dict) and 'curveList' in data['data']:
-                    return data['data']['curveList']
-                elif 'curveList' in data and isinstance(data['curveList'], list):
-                    return data['curveList']
-        except Exception as e:
-            print(f"[ERROR] SSL ошибка при загрузке данных Ottai: {e}")
+        # Другая схема и крайние значения (inf/nan, время вне диапазона datetime) — поштучно
+        if (glucose_type is not float and glucose_type is not int) or type(timestamp) is not int \
+                or not -MAX_BATCH_GLUCOSE < glucose < MAX_BATCH_GLUCOSE or not 0 <= timestamp < MAX_BATCH_TIMESTAMP \
+                or any(key in item for key in shadowing_keys):
+            rest = itertools.chain([item], items)
+            break
         
-        return []
-    except Exception as e:
-        print(f"[ERROR] Ошибка при загрузке данных Ottai: {str(e)}")
-        traceback.print_exc()
-        return []
+        glucose_values.append(glucose)
+        timestamps.append(timestamp)
+        data_numbers.append(_parse_data_no(item.get('dataNo')))
+    
+    if timestamps:
+        store.extend(timestamps, _convert_glucose_values(glucose_values), data_numbers)
+    
+    if rest is not None:
+        _prepare_readings_per_item(rest, store)
 
-def prepare_nightscout_entries(curve_list, user_config):
+def prepare_nightscout_entries(curve_list, user_config, trend_window=None):
     """
-    Подготовка записей для Nightscout
+    Подготовка записей для Nightscout.
+    curve_list — список или поток записей Ottai;
+    trend_window — окно для расчёта тренда (по умолчанию — общее окно мастера).
+    Возвращает ReadingStore, упорядоченный по времени: словари записей
+    создаются только при обращении к ним
     """
-    entries = []
+    if trend_window is None:
+        trend_window = get_trend_window(user_config)
+    
+    store = ReadingStore(user_config['ns_uploder'])
+    _prepare_readings_batch(curve_list, store)
+    store.sort()
     
+    _apply_trend(store, trend_window)
+    
+    logger.debug("Подготовлено %d записей для Nightscout", len(store))
+    return store
+
+def _prepare_readings_per_item(curve_list, store):
+    """Поштучная подготовка показаний (произвольная схема в каждой записи)"""
     for item in curve_list:
         try:
             # Проверяем разные возможные ключи для глюкозы
             glucose_value = None
-            glucose_keys = ['adjustGlucose', 'glucose', 'value', 'bgValue', 'sgv']
             
-            for key in glucose_keys:
+            for key in GLUCOSE_KEYS:
                 if key in item and item[key] is not None:
                     glucose_value = item[key]
                     break
             
             # Проверяем разные возможные ключи для времени
             timestamp_value = None
-            timestamp_keys = ['monitorTime', 'timestamp', 'date', 'time', 'created_at']
             
-            for key in timestamp_keys:
+            for key in TIMESTAMP_KEYS:
                 if key in item and item[key] is not None:
                     timestamp_value = item[key]
                     break
@@ -403,240 +1066,890 @@ def prepare_nightscout_entries(curve_list, user_config):
             
             glucose = float(glucose_value)
             timestamp = int(timestamp_value)
+            sgv = convert_mmoll_to_mgdl(glucose)
             
-            entry = {
-                "type": "sgv",
-                "sgv": convert_mmoll_to_mgdl(glucose),
-                "direction": "Flat",
-                "device": user_config['ns_uploder'],
-                "date": timestamp,
-                "dateString": datetime.datetime.utcfromtimestamp(timestamp/1000).isoformat(timespec='milliseconds') + "Z"
-            }
+            # Время вне диапазона datetime — запись пропускается
+            datetime.datetime.utcfromtimestamp(timestamp / 1000)
             
-            # Пытаемся определить направление тренда
+            # Направление тренда из данных Ottai
+            direction = None
             if 'trend' in item:
-                trend_map = {
-                    'rising': 'DoubleUp',
-                    'falling': 'DoubleDown',
-                    'stable': 'Flat',
-                    'DoubleUp': 'DoubleUp',
-                    'DoubleDown': 'DoubleDown',
-                    'SingleUp': 'SingleUp',
-                    'SingleDown': 'SingleDown',
-                    'FortyFiveUp': 'FortyFiveUp',
-                    'FortyFiveDown': 'FortyFiveDown',
-                    'Flat': 'Flat'
-                }
-                entry['direction'] = trend_map.get(item['trend'], 'Flat')
+                direction = TREND_MAP.get(item['trend'], 'Flat')
             elif 'direction' in item:
-                entry['direction'] = item['direction']
+                direction = item['direction']
             
-            entries.append(entry)
+            store.append(timestamp, sgv, _parse_data_no(item.get('dataNo')), direction,
+                         explicit='trend' in item or 'direction' in item)
             
         except Exception as e:
-            print(f"[DEBUG] Ошибка обработки записи: {e}")
+            logger.debug("Ошибка обработки записи: %s", e)
             continue
+
+# ========== СЖАТИЕ ЗАПРОСОВ В NIGHTSCOUT ==========
+def _gzip_host(ns_url):
+    return urlparse(ns_url).netloc or ns_url
+
+def nightscout_accepts_gzip(ns_url):
+    """Сжимать ли запросы к хосту: NS_GZIP включён и хост не отвергал gzip (или пора проверить снова)"""
+    if not NS_GZIP:
+        return False
     
-    print(f"[DEBUG] Подготовлено {len(entries)} записей для Nightscout")
-    return entries
+    known = _gzip_hosts['hosts'].get(_gzip_host(ns_url))
+    if known is None:
+        return True
+    accepted, checked_at = known
+    return accepted or time.monotonic() - checked_at >= GZIP_RECHECK_SECONDS
 
-def send_to_nightscout_batch(user_config, entries):
+def gzip_fallback_needed(ns_url, status):
     """
-    Отправка записей в Nightscout пачками
+    Повторять ли без сжатия сжатый запрос, получивший ответ status: при 400/413/415
+    (сервер не понял сжатое тело) — всегда, при 5xx (прокси мог не справиться
+    со сжатым телом) — пока хост не подтвердил, что принимает gzip.
+    Хост запоминается как не принимающий gzip только по GZIP_REJECTED_STATUSES:
+    случайный 5xx не отключает сжатие
     """
-    if not entries:
-        return 0
+    if status in GZIP_REJECTED_STATUSES:
+        return True
+    if not is_server_error(status):
+        return False
+    known = _gzip_hosts['hosts'].get(_gzip_host(ns_url))
+    return known is None or not known[0]
+
+def remember_gzip_support(ns_url, accepted):
+    """Запоминание поддержки gzip хостом (по ответам на сжатый и обычный запросы)"""
+    host = _gzip_host(ns_url)
+    with _gzip_hosts['lock']:
+        known = _gzip_hosts['hosts'].get(host)
+        _gzip_hosts['hosts'][host] = (accepted, time.monotonic())
     
-    base_url = user_config['ns_url']
-    url = f"{base_url}/api/v1/entries"
+    if known is None or known[0] != accepted:
+        if accepted:
+            logger.info("🗜️ %s принимает сжатые запросы (gzip)", host)
+        else:
+            logger.warning("🗜️ %s не принимает сжатые запросы, отправляем без сжатия", host)
+
+def encode_nightscout_body(user_config, payload, compress=True):
+    """
+    Тело POST в Nightscout: (байты, заголовки). Тело сжимается gzip, если хост
+    его принимает и размер не меньше NS_GZIP_MIN_BYTES
+    """
+    body = json.dumps(payload, separators=(',', ':'), allow_nan=False).encode('utf-8')
+    headers = user_config['ns_header']
+    encoding = 'identity'
+    
+    if compress and len(body) >= NS_GZIP_MIN_BYTES and nightscout_accepts_gzip(user_config['ns_url']):
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+        headers = {**headers, 'Content-Encoding': 'gzip'}
+        encoding = 'gzip'
+    
+    metrics.NIGHTSCOUT_REQUEST_BYTES.inc(len(body), config_key=user_config['config_key'], encoding=encoding)
+    return body, headers
+
+def _discard_response_body(response):
+    """
+    Тело успешного ответа на POST (принятые записи) или ответа, после которого
+    запрос повторяется, не нужно: оно дочитывается без распаковки и разбора JSON,
+    соединение возвращается в пул
+    """
+    try:
+        response.raw.drain_conn()
+    except Exception:
+        pass
+    finally:
+        response.close()
+
+def _post_to_nightscout(user_config, url, payload):
+    """
+    POST в Nightscout с повтором без проверки SSL при SSL-ошибке.
+    Тело сжимается gzip, если хост его принимает; сжатый запрос, отвергнутый
+    сервером, повторяется без сжатия (gzip_fallback_needed).
+    Ответ возвращается закрытым: тело ответа не 200 прочитано (response.text доступен),
+    соединение возвращено в пул.
+    Если breaker хоста открыт — сразу CircuitOpenError
+    """
     session = user_config['session']
+    breaker = get_breaker(user_config['ns_url'])
+    breaker.before_request()
     
-    successful = 0
+    def send(body, headers):
+        try:
+            return session.post(url, headers=headers, data=body, timeout=CONFIG['request_timeout'],
+                                verify=not DISABLE_SSL_VERIFY, stream=True)
+        except requests.exceptions.SSLError:
+            return session.post(url, headers=headers, data=body, timeout=CONFIG['request_timeout'],
+                                verify=False, stream=True)
     
-    # Отправляем по одной записи для лучшей отладки
-    for i, entry in enumerate(entries):
+    started = time.monotonic()
+    status = 'error'
+    try:
+        body, headers = encode_nightscout_body(user_config, payload)
+        response = send(body, headers)
+        
+        if 'Content-Encoding' in headers:
+            if gzip_fallback_needed(user_config['ns_url'], response.status_code):
+                # Сервер мог не понять сжатое тело — проверяем тем же запросом без сжатия
+                rejected = response.status_code in GZIP_REJECTED_STATUSES
+                _discard_response_body(response)
+                response = send(*encode_nightscout_body(user_config, payload, compress=False))
+                if rejected and response.status_code < 300:
+                    remember_gzip_support(user_config['ns_url'], False)
+            elif response.status_code < 300:
+                remember_gzip_support(user_config['ns_url'], True)
+        
+        if response.status_code == 200:
+            _discard_response_body(response)
+        else:
+            # Тело ошибки (обычно короткое) читается для лога, соединение возвращается в пул
+            with response:
+                response.content
+        status = response.status_code
+        return response
+    except Exception as e:
+        breaker.record_failure(type(e).__name__)
+        raise
+    finally:
+        if status != 'error':
+            if is_server_error(status):
+                breaker.record_failure(f"HTTP {status}")
+            else:
+                breaker.record_success()
+        metrics.NIGHTSCOUT_POST_DURATION.observe(time.monotonic() - started, config_key=user_config['config_key'])
+        metrics.NIGHTSCOUT_RESPONSES.inc(config_key=user_config['config_key'], status=status)
+
+def _send_chunk(user_config, url, chunk):
+    """
+    Отправка пачки записей одним запросом (JSON-массив) с повторами.
+    Возвращает CHUNK_SENT, CHUNK_REJECTED или CHUNK_FAILED
+    """
+    retries = CONFIG['batch_retries']
+    for attempt in range(retries + 1):
         try:
-            time_str = datetime.datetime.fromtimestamp(entry['date']/1000).strftime('%H:%M:%S')
-            print(f"[DEBUG] Отправка записи {i+1}/{len(entries)}: {time_str}, глюкоза: {entry['sgv']}")
+            response = _post_to_nightscout(user_config, url, chunk)
             
-            response = session.post(url, 
-                                   headers=user_config['ns_header'], 
-                                   json=entry,
-                                   timeout=REQUEST_TIMEOUT,
-                                   verify=not DISABLE_SSL_VERIFY)
+            if response.status_code == 200:
+                return CHUNK_SENT
+            
+            logger.error("Nightscout отклонил пачку (%d записей): %s", len(chunk), response.status_code)
+            if logger.isEnabledFor(logging.DEBUG) and response.text:
+                logger.debug("Ответ Nightscout: %s", response.text[:200])
+            
+            # 4xx — повтор не поможет, переходим к поштучной отправке
+            if 400 <= response.status_code < 500:
+                return CHUNK_REJECTED
+        except CircuitOpenError:
+            return CHUNK_FAILED
+        except Exception as e:
+            logger.error("Ошибка при отправке пачки (попытка %d/%d): %s", attempt + 1, retries + 1, e)
+        
+        # Хост признан недоступным — повторы бессмысленны
+        if get_breaker(user_config['ns_url']).retry_in() > 0:
+            return CHUNK_FAILED
+        
+        if attempt < retries:
+            time.sleep(min(2 ** attempt, 10))
+    
+    return CHUNK_FAILED
+
+def _send_entries_one_by_one(user_config, url, entries):
+    """
+    Поштучная отправка записей (fallback для отклонённой пачки).
+    Возвращает список флагов успешной отправки
+    """
+    sent_flags = []
+    
+    for entry in entries:
+        sent = False
+        try:
+            response = _post_to_nightscout(user_config, url, entry)
             
             if response.status_code == 200:
-                successful += 1
-                print(f"[DEBUG] ✅ Запись {time_str} отправлена успешно")
+                sent = True
             else:
-                print(f"[ERROR] Ошибка при отправке записи {time_str}: {response.status_code}")
-                if response.text:
-                    print(f"[DEBUG] Ответ Nightscout: {response.text[:200]}")
-        except requests.exceptions.SSLError:
-            try:
-                response = session.post(url, 
-                                       headers=user_config['ns_header'], 
-                                       json=entry,
-                                       timeout=REQUEST_TIMEOUT,
-                                       verify=False)
-                if response.status_code == 200:
-                    successful += 1
-                    print(f"[DEBUG] ✅ Запись {time_str} отправлена успешно (с отключенным SSL)")
-                else:
-                    print(f"[ERROR] Ошибка SSL при отправке записи {time_str}: {response.status_code}")
-            except Exception as e:
-                print(f"[ERROR] SSL ошибка при отправке в Nightscout: {e}")
+                logger.error("Ошибка при отправке записи %s: %s", entry['dateString'], response.status_code)
+                if logger.isEnabledFor(logging.DEBUG) and response.text:
+                    logger.debug("Ответ Nightscout: %s", response.text[:200])
+        except CircuitOpenError as e:
+            # Хост недоступен — остальные записи не отправляем
+            logger.warning("Поштучная отправка прервана: %s", e)
+            break
         except Exception as e:
-            print(f"[ERROR] Ошибка при отправке записи {time_str}: {e}")
+            logger.error("Ошибка при отправке записи %s: %s", entry['dateString'], e)
+        sent_flags.append(sent)
     
-    return successful
+    sent_flags.extend([False] * (len(entries) - len(sent_flags)))
+    return sent_flags
 
-def process_user_data_optimized(user_config):
+def iter_entry_chunks(entries):
+    """Разбиение записей на пачки по BATCH_SIZE: (номер, всего пачек, пачка)"""
+    batch_size = CONFIG['batch_size']
+    total_chunks = (len(entries) + batch_size - 1) // batch_size
+    
+    for chunk_no, offset in enumerate(range(0, len(entries), batch_size), 1):
+        yield chunk_no, total_chunks, entries[offset:offset + batch_size]
+
+def upload_entries(user_config, entries, stop_on_deadline=True):
     """
-    Оптимизированная обработка данных пользователя БЕЗ учета последней записи
-    Просто загружаем данные за фиксированный период и отправляем их
+    Отправка записей пачками по BATCH_SIZE.
+    Возвращает список флагов успешной отправки (по одному на запись).
+    stop_on_deadline=False — отправка вне цикла (фоновая досылка очереди)
     """
-    print(f"\n[USER] {user_config['email']} (ID: {user_config['from_user_id']})")
+    base_url = user_config['ns_url']
+    url = f"{base_url}/api/v1/entries"
+    
+    sent_flags = []
+    
+    for chunk_no, total_chunks, chunk in iter_entry_chunks(entries):
+        if stop_on_deadline and cycle_cancelled():
+            logger.warning("Дедлайн цикла: пачки %d-%d будут отправлены позже", chunk_no, total_chunks)
+            sent_flags.extend([False] * (len(entries) - len(sent_flags)))
+            break
+        
+        result = _send_chunk(user_config, url, chunk)
+        if result == CHUNK_SENT:
+            chunk_flags = [True] * len(chunk)
+        elif result == CHUNK_FAILED:
+            # 5xx, сеть или открытый breaker: поштучная отправка заплатила бы
+            # таймаут за каждую запись — пачка и остальные ждут следующей отправки
+            logger.warning("Nightscout не принял пачку: пачки %d-%d будут отправлены позже", chunk_no, total_chunks)
+            sent_flags.extend([False] * (len(entries) - len(sent_flags)))
+            break
+        else:
+            logger.warning("Пачка %d/%d не принята, отправляем по одной записи", chunk_no, total_chunks)
+            chunk_flags = _send_entries_one_by_one(user_config, url, chunk)
+        
+        sent_flags.extend(chunk_flags)
+        logger.debug("Пачка %d/%d: отправлено %d/%d", chunk_no, total_chunks, sum(chunk_flags), len(chunk))
     
-    if not check_nightscout_connection_cached(user_config):
-        print(f"  ❌ Nightscout недоступен")
+    return sent_flags
+
+def send_to_nightscout_batch(user_config, entries):
+    """
+    Отправка записей в Nightscout пачками по BATCH_SIZE.
+    Отклонённая (4xx) пачка досылается по одной записи
+    """
+    if not entries:
         return 0
     
-    # Фиксированный временной диапазон - за HOURS_AGO часов
+    return sum(upload_entries(user_config, entries))
+
+def _iter_new_readings(curve_list, sync_state, stats):
+    """
+    Отбрасывание записей, уже подтверждённых Nightscout (по monitorTime и dataNo).
+    Работает потоком; в stats собирает количество записей и самое свежее время
+    """
+    last_time = sync_state['last_monitor_time'] if sync_state else None
+    last_data_no = sync_state.get('last_data_no') if sync_state else None
+    
+    for item in curve_list:
+        stats['count'] += 1
+        monitor_time = item.get('monitorTime')
+        
+        if monitor_time is not None:
+            # Запись с некорректным monitorTime пропускается, иначе отметка мастера не сдвинется за неё
+            try:
+                monitor_time = int(monitor_time)
+            except (TypeError, ValueError):
+                logger.warning("Запись Ottai пропущена: некорректный monitorTime %r", monitor_time)
+                continue
+            if stats['newest'] is None or monitor_time > stats['newest']:
+                stats['newest'] = monitor_time
+            if last_time is not None and monitor_time <= last_time:
+                continue
+        else:
+            # Без monitorTime сверяем по dataNo (номер сбрасывается при смене датчика,
+            # поэтому он используется только как запасной признак)
+            data_no = _parse_data_no(item.get('dataNo'))
+            if last_data_no is not None and data_no != NO_DATA_NO and data_no <= last_data_no:
+                continue
+        
+        stats['new'] += 1
+        yield item
+
+def plan_sync_window(user_config, ns_last_date):
+    """
+    Расчёт окна загрузки мастера: с последней сохранённой записи (с перекрытием),
+    но не глубже HOURS_AGO часов. Возвращает (state_key, sync_state, start_time, end_time)
+    или None при некорректном диапазоне
+    """
+    state_key = get_state_key(user_config)
+    sync_state = load_sync_state(state_key)
+    
+    # Окно начинается с локальной отметки: Nightscout может содержать записи
+    # новее неё при пропуске перед ними (пачка отклонена, следующая принята).
+    # Последняя запись Nightscout — только нижняя граница при первом запуске
+    # (нет локального состояния, новый volume): её записи не отправляем повторно
+    if ns_last_date is not None and not sync_state:
+        sync_state = {'last_monitor_time': ns_last_date, 'last_data_no': None}
+    
+    # Последняя запись в Nightscout — от неё считается data lag (отметка
+    # sync_state может опережать её на записи, ещё ждущие в очереди)
+    if ns_last_date is not None:
+        metrics.observe_delivered(user_config['config_key'], ns_last_date)
+    
+    # Временной диапазон: не глубже HOURS_AGO часов
     end_time = int(datetime.datetime.now().timestamp() * 1000)
-    start_time = int((datetime.datetime.now() - timedelta(hours=HOURS_AGO)).timestamp() * 1000)
+    start_time = int((datetime.datetime.now() - timedelta(hours=CONFIG['hours_ago'])).timestamp() * 1000)
     
-    start_str = datetime.datetime.fromtimestamp(start_time/1000).strftime('%Y-%m-%d %H:%M:%S')
-    end_str = datetime.datetime.fromtimestamp(end_time/1000).strftime('%Y-%m-%d %H:%M:%S')
+    if sync_state:
+        resume_time = sync_state['last_monitor_time'] - STATE_OVERLAP_MINUTES * 60 * 1000
+        start_time = max(start_time, resume_time)
     
-    print(f"  📊 Загружаем данные за {HOURS_AGO} часов")
-    print(f"     Начало: {start_str}")
-    print(f"     Конец:  {end_str}")
+    # Даты форматируются только при включённом DEBUG
+    if logger.isEnabledFor(logging.DEBUG):
+        if sync_state:
+            logger.debug("📊 Загружаем данные после последней записи в Nightscout (%s)",
+                         format_local_time(sync_state['last_monitor_time']))
+        else:
+            logger.debug("📊 Загружаем данные за %d часов", CONFIG['hours_ago'])
+        logger.debug("Окно: %s — %s", format_local_time(start_time), format_local_time(end_time))
     
     if start_time >= end_time:
-        print(f"  ℹ️ Некорректный временной диапазон")
-        return 0
+        logger.info("ℹ️ Некорректный временной диапазон")
+        return None
     
-    # Получаем данные из Ottai
-    curve_list = get_ottai_data_batch(user_config, start_time, end_time)
+    return state_key, sync_state, start_time, end_time
+
+def select_new_entries(user_config, curve_list, sync_state):
+    """
+    Отбор новых записей из ответа Ottai (списка или потока) и подготовка их для Nightscout.
+    curve_list None (или OttaiFetchError из потока) — окно не загружено.
+    Возвращает ReadingStore новых записей или None, если отправлять нечего
+    """
+    stats = {'count': 0, 'new': 0, 'newest': None}
     
-    if not curve_list:
-        print(f"  ℹ️ Нет данных в Ottai")
-        return 0
+    # Подготавливаем записи для Nightscout прямо из потока
+    try:
+        if curve_list is None:
+            raise OttaiFetchError("окно не загружено")
+        entries = prepare_nightscout_entries(_iter_new_readings(curve_list, sync_state, stats), user_config)
+    except OttaiFetchError as e:
+        # Неудачная загрузка — не признак молчащего датчика: расписание опроса
+        # и счётчик молчания не меняются, мастер опрашивается на следующем тике.
+        # Частично загруженное окно не отправляется: отметка не сдвигается
+        logger.warning("⚠️ Данные Ottai не загружены (%s), повтор в следующем цикле", e)
+        return None
     
-    print(f"  📥 Получено {len(curve_list)} записей из Ottai")
+    metrics.ENTRIES_FETCHED.inc(stats['count'], config_key=user_config['config_key'])
+    metrics.ENTRIES_DEDUPLICATED.inc(stats['count'] - stats['new'], config_key=user_config['config_key'])
     
-    # Подготавливаем записи для Nightscout
-    entries = prepare_nightscout_entries(curve_list, user_config)
+    if not stats['count']:
+        logger.info("ℹ️ Нет данных в Ottai")
+        schedule_next_poll(user_config, None)
+        return None
+    
+    if not stats['new']:
+        logger.info("📥 Получено %d записей из Ottai, новых нет", stats['count'])
+        schedule_next_poll(user_config, stats['newest'])
+        return None
     
     if not entries:
-        print(f"  ℹ️ Нет записей для обработки")
-        return 0
+        logger.info("ℹ️ Нет записей для обработки")
+        schedule_next_poll(user_config, None)
+        return None
+    
+    logger.info("📥 Получено %d записей из Ottai, новых: %d", stats['count'], len(entries))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("📊 Диапазон новых данных: %s — %s",
+                     format_local_time(entries.dates[0], '%H:%M:%S'),
+                     format_local_time(entries.dates[-1], '%H:%M:%S'))
+    
+    return entries
+
+def enqueue_new_entries(user_config, state_key, entries):
+    """
+    Сохранение подготовленных записей в очередь отправки. Отметка загрузки
+    сдвигается сразу: записи уже не потеряются, даже если Nightscout недоступен
+    дольше HOURS_AGO
+    """
+    config_key = user_config['config_key']
+    depth, dropped = enqueue_outbox(state_key, entries, OUTBOX_MAX_ENTRIES)
     
-    print(f"  📊 Диапазон данных в Ottai:")
-    if entries:
-        first_time = datetime.datetime.fromtimestamp(entries[0]['date']/1000).strftime('%H:%M:%S')
-        last_time = datetime.datetime.fromtimestamp(entries[-1]['date']/1000).strftime('%H:%M:%S')
-        print(f"     Первая запись: {first_time}")
-        print(f"     Последняя запись: {last_time}")
+    with _outbox['lock']:
+        _outbox['masters'][state_key] = user_config
     
-    # Отправляем записи в Nightscout
-    successful = send_to_nightscout_batch(user_config, entries)
+    newest = entries.newest()
+    save_sync_state(state_key, newest, entries.data_no_at(newest))
+    if _latest_reading['time'] is None or newest > _latest_reading['time']:
+        _latest_reading['time'] = newest
     
+    metrics.OUTBOX_DEPTH.set(depth, config_key=config_key)
+    if dropped:
+        metrics.OUTBOX_DROPPED.inc(dropped, config_key=config_key)
+        logger.warning("⚠️ Очередь отправки переполнена (OUTBOX_MAX_ENTRIES=%d): удалено старых записей: %d",
+                       OUTBOX_MAX_ENTRIES, dropped)
+    
+    schedule_next_poll(user_config, newest)
+    logger.debug("В очереди отправки: %d", depth)
+
+def begin_outbox_drain(state_key):
+    """Захват очереди мастера для отправки (False — её уже отправляет другой поток)"""
+    with _outbox['lock']:
+        if state_key in _outbox['draining']:
+            return False
+        _outbox['draining'].add(state_key)
+        return True
+
+def end_outbox_drain(state_key):
+    with _outbox['lock']:
+        _outbox['draining'].discard(state_key)
+
+def acknowledge_outbox(user_config, state_key, pending, sent_flags):
+    """
+    Удаление из очереди записей, принятых Nightscout.
+    Возвращает (принято записей, оставшаяся глубина очереди)
+    """
+    config_key = user_config['config_key']
+    sent_dates = [date for date, sent in zip(pending.dates, sent_flags) if sent]
+    depth = ack_outbox(state_key, sent_dates)
+    metrics.OUTBOX_DEPTH.set(depth, config_key=config_key)
+    
+    if sent_dates:
+        newest = max(sent_dates)
+        remember_nightscout_last_date(user_config, newest)
+        metrics.observe_delivered(config_key, newest)
+        metrics.ENTRIES_SENT.inc(len(sent_dates), config_key=config_key)
+    
+    return len(sent_dates), depth
+
+def log_outbox_drain(successful, depth):
     if successful > 0:
-        print(f"  ✅ Отправлено {successful} записей в Nightscout")
-    else:
-        print(f"  ❌ Не удалось отправить записи")
+        logger.info("✅ Отправлено %d записей в Nightscout", successful)
+    if depth:
+        logger.warning("⏳ В очереди отправки осталось %d записей, повтор позже", depth)
+
+def drain_outbox(user_config, state_key, stop_on_deadline=True):
+    """
+    Отправка очереди мастера в Nightscout порциями по OUTBOX_DRAIN_BATCH
+    (самые старые — первыми). Возвращает количество отправленных записей
+    """
+    if not begin_outbox_drain(state_key):
+        return 0
+    
+    successful = 0
+    depth = 0
+    try:
+        while True:
+            pending = load_outbox(state_key, OUTBOX_DRAIN_BATCH, user_config['ns_uploder'])
+            if not pending:
+                break
+            
+            sent_flags = upload_entries(user_config, pending, stop_on_deadline)
+            sent, depth = acknowledge_outbox(user_config, state_key, pending, sent_flags)
+            successful += sent
+            if sent < len(pending) or not depth:
+                break
+    finally:
+        end_outbox_drain(state_key)
     
+    log_outbox_drain(successful, depth)
     return successful
 
-def process_user_wrapper(user_info):
+def _drain_pending_outboxes():
+    """Проход фоновой досылки: непустые очереди мастеров с доступным Nightscout"""
+    for state_key, depth in outbox_depths().items():
+        with _outbox['lock']:
+            user_config = _outbox['masters'].get(state_key)
+        
+        # Очереди мастеров, ещё не обработанных в этом запуске, отправит их цикл
+        if user_config is None or get_breaker(user_config['ns_url']).retry_in() > 0:
+            continue
+        
+        with master_context(user_config['config_key']):
+            logger.debug("Досылка очереди: %d записей", depth)
+            drain_outbox(user_config, state_key, stop_on_deadline=False)
+
+def _outbox_drainer_loop():
+    while not _outbox['stop'].wait(OUTBOX_DRAIN_INTERVAL):
+        try:
+            _drain_pending_outboxes()
+        except Exception as e:
+            logger.exception("Ошибка фоновой досылки очереди: %s", e)
+
+def start_outbox_drainer():
+    """Запуск фоновой досылки очереди каждые OUTBOX_DRAIN_INTERVAL секунд"""
+    if _outbox['thread'] is not None:
+        return
+    
+    _outbox['stop'].clear()
+    _outbox['thread'] = threading.Thread(target=_outbox_drainer_loop, name='outbox-drainer', daemon=True)
+    _outbox['thread'].start()
+
+def stop_outbox_drainer():
+    """Остановка фоновой досылки (текущий проход завершается)"""
+    thread = _outbox['thread']
+    if thread is None:
+        return
+    
+    _outbox['stop'].set()
+    thread.join()
+    _outbox['thread'] = None
+
+def process_user_data_optimized(user_config):
     """
-    Обертка для обработки пользователя в потоке
+    Оптимизированная обработка данных пользователя.
+    Загружаем данные начиная с последней сохранённой записи (с перекрытием),
+    но не глубже HOURS_AGO часов, новые записи ставим в очередь и отправляем очередь.
+    Недоступность Nightscout не останавливает загрузку: записи ждут в очереди
     """
-    user_config = create_user_config(user_info['email'], user_info['fromUserId'], user_info.get('userName'))
+    logger.debug("Мастер %s (ID: %s)", user_config['email'], user_config['from_user_id'])
     
-    if not user_config:
-        print(f"[WARNING] Пользователь {user_info['email']} не настроен")
+    with profiling.span('connect'):
+        connected = check_nightscout_connection_cached(user_config)
+    if not connected:
+        logger.error("❌ Nightscout недоступен, новые записи будут сохранены в очередь")
+    
+    ns_last_date = get_nightscout_last_entry_date_cached(user_config) if connected else None
+    window = plan_sync_window(user_config, ns_last_date)
+    if window is None:
         return 0
+    state_key, sync_state, start_time, end_time = window
     
-    try:
-        return process_user_data_optimized(user_config)
-    except Exception as e:
-        print(f"[ERROR] Ошибка при обработке {user_info['email']}: {str(e)}")
-        traceback.print_exc()
+    if cycle_cancelled():
+        logger.warning("⏱️ Дедлайн цикла, мастер пропущен")
         return 0
+    
+    # Получаем данные из Ottai потоком (загрузка и разбор — вложенные фазы подготовки)
+    curve_list = iter_ottai_data(user_config, start_time, end_time)
+    
+    with profiling.span('prepare'):
+        entries = select_new_entries(user_config, curve_list, sync_state)
+        if entries is not None:
+            enqueue_new_entries(user_config, state_key, entries)
+    
+    if not connected:
+        return 0
+    
+    # Отправляем очередь в Nightscout (новые записи и оставшиеся с прошлых циклов)
+    with profiling.span('upload'):
+        return drain_outbox(user_config, state_key)
 
-def process_all_users_optimized():
+def schedule_next_poll(user_config, newest_reading):
     """
-    Оптимизированная обработка всех пользователей
+    Планирование следующего опроса мастера по циклу датчика (SENSOR_INTERVAL_SECONDS):
+    - пришло новое показание — спим до ожидаемого следующего (+ POLL_GRACE_SECONDS);
+    - показание запаздывает — опрашиваем каждый тик в течение POLL_BURST_SECONDS;
+    - датчик молчит дольше (смена датчика) — экспоненциальный откат до POLL_MAX_BACKOFF_SECONDS
     """
-    print("\n" + "="*80)
-    print(f"🚀 НАЧАЛО ОБРАБОТКИ (SSL: {'Отключена' if DISABLE_SSL_VERIFY else 'Включена'})")
-    print(f"📊 Загружаем данные за {HOURS_AGO} часов для каждого пользователя")
-    print("="*80)
+    if not ADAPTIVE_POLLING:
+        return
     
-    all_users = get_all_users_from_ottai_cached()
+    now = time.time()
     
-    if not all_users:
-        print("❌ Не удалось получить пользователей из Ottai")
-        return
+    with _poll_schedule['lock']:
+        state = _poll_schedule['masters'].setdefault(str(user_config['from_user_id']), {
+            'last_reading': None,
+            'next_poll': 0.0,
+            'silent_polls': 0
+        })
+        
+        if newest_reading is not None and (state['last_reading'] is None or newest_reading > state['last_reading']):
+            state['last_reading'] = newest_reading
+            state['silent_polls'] = 0
+        
+        due = None
+        if state['last_reading'] is not None:
+            due = state['last_reading'] / 1000 + SENSOR_INTERVAL_SECONDS + POLL_GRACE_SECONDS
+        
+        if due is not None and now < due:
+            state['next_poll'] = due
+        elif due is not None and now < due + POLL_BURST_SECONDS:
+            state['next_poll'] = 0.0
+        else:
+            state['silent_polls'] += 1
+            backoff = min(POLL_BACKOFF_BASE_SECONDS * 2 ** (state['silent_polls'] - 1), POLL_MAX_BACKOFF_SECONDS)
+            state['next_poll'] = now + backoff
+
+def is_master_due(user_info, now=None):
+    """Пора ли опрашивать мастера (при ADAPTIVE_POLLING)"""
+    if not ADAPTIVE_POLLING:
+        return True
+    
+    now = time.time() if now is None else now
+    
+    with _poll_schedule['lock']:
+        state = _poll_schedule['masters'].get(str(user_info['fromUserId']))
+        return state is None or now >= state['next_poll']
+
+def _next_poll_time(user_info):
+    with _poll_schedule['lock']:
+        state = _poll_schedule['masters'].get(str(user_info['fromUserId']))
+        return state['next_poll'] if state else 0.0
+
+def cycle_cancelled():
+    """Истёк ли дедлайн текущего цикла (задачи должны прерваться)"""
+    return _cycle_control['cancel'].is_set()
+
+def wait_cycle_cancelled(timeout):
+    """Ожидание не дольше timeout секунд; True — цикл отменён"""
+    return _cycle_control['cancel'].wait(timeout)
+
+def cancel_cycle():
+    """Отмена текущего цикла по дедлайну"""
+    _cycle_control['cancel'].set()
+
+def get_latest_monitor_time():
+    """
+    Время (мс) самого свежего отправленного показания — для выравнивания
+    тиков планировщика по циклу датчика
+    """
+    if _latest_reading['time'] is None:
+        _latest_reading['time'] = load_latest_monitor_time()
+    return _latest_reading['time']
+
+def master_start_offset(user_info):
+    """
+    Детерминированная задержка старта мастера в пределах MASTER_JITTER_SECONDS,
+    чтобы запросы к Ottai не уходили одновременно
+    """
+    if MASTER_JITTER_SECONDS <= 0:
+        return 0.0
     
-    # Отображаем мастеров
-    master_statuses = display_available_masters(all_users)
+    bucket = zlib.crc32(str(user_info['fromUserId']).encode()) % 1000
+    return bucket / 1000 * MASTER_JITTER_SECONDS
+
+def process_user_wrapper(user_info, started=None):
+    """
+    Обертка для обработки пользователя в потоке.
+    started — начало цикла (time.monotonic()): смещение старта отсчитывается
+    от него, а не от момента, когда задача досталась потоку пула
+    """
+    delay = master_start_offset(user_info)
+    if started is not None:
+        delay = max(0.0, started + delay - time.monotonic())
+    
+    # Ожидание смещения старта прерывается при отмене цикла
+    if _cycle_control['cancel'].wait(delay):
+        return 0
+    
+    user_config = create_user_config(user_info['email'], user_info['fromUserId'], user_info.get('userName'),
+                                     user_info.get('account'))
+    
+    if not user_config:
+        logger.warning("Пользователь %s не настроен", user_info['email'])
+        return 0
+    
+    with master_context(user_config['config_key']), profiling.profile_thread(), \
+            profiling.master_span(user_config['config_key'], urlparse(user_config['ns_url']).netloc):
+        try:
+            return process_user_data_optimized(user_config)
+        except Exception as e:
+            logger.exception("Ошибка при обработке %s: %s", user_info['email'], e)
+            return 0
+
+def resolve_users(all_users):
+    """
+    Статусы мастеров для вывода и настроенные мастера. Список сопоставляется
+    с NS_URL__*/NS_SECRET__* заново только при смене списка или конфигураций Nightscout
+    """
+    index = _user_list_resolution['index']
+    if index is None or not index.is_current(all_users):
+        index = MasterIndex(all_users)
+        _user_list_resolution['statuses'] = display_available_masters(all_users, index)
+        _user_list_resolution['configured'] = select_configured_users(all_users, index)
+        _user_list_resolution['index'] = index
+    
+    return _user_list_resolution['statuses'], _user_list_resolution['configured']
+
+def select_configured_users(all_users, index=None):
+    """
+    Мастера, для которых настроен Nightscout (index — MasterIndex этого списка)
+    """
+    if index is None:
+        index = MasterIndex(all_users)
     
-    # Фильтруем настроенных пользователей
     configured_users = []
     for user in all_users:
-        email = extract_clean_email(user['email']) or user['email']
-        user_name = user.get('userName', '')
-        user_id = user['fromUserId']
-        ns_url, ns_secret = get_nightscout_config_by_email(email, user_name, user_id)
-        if ns_url and ns_secret:
+        resolved = index.get(user['fromUserId'])
+        if resolved is not None:
             configured_users.append({
-                'email': email,
-                'fromUserId': user_id,
-                'userName': user_name,
+                'email': resolved.email,
+                'fromUserId': resolved.from_user_id,
+                'userName': resolved.user_name,
+                'account': resolved.account,
             })
+    return configured_users
+
+def process_all_users_optimized(deadline=None):
+    """
+    Оптимизированная обработка всех пользователей.
+    deadline — момент time.monotonic(), после которого незавершённые задачи отменяются
+    """
+    profiling.begin_cycle()
+    started = time.monotonic()
+    try:
+        with profiling.profile_thread():
+            _process_all_users(deadline)
+    finally:
+        metrics.CYCLE_DURATION.observe(time.monotonic() - started)
+        profiling.report_cycle()
+        profiling.finish_capture()
+
+def _reload_config_file():
+    """Перечитывание CONFIG_FILE при изменении; при ошибке действует прежняя конфигурация"""
+    try:
+        result = reload_config_file()
+    except (OSError, ValueError) as e:
+        logger.error("❌ Файл конфигурации не применён: %s", e)
+        return
+    
+    if result is None:
+        return
+    
+    applied, restart = result
+    logger.info("⚙️ Файл конфигурации перечитан%s", f", применено: {', '.join(applied)}" if applied else "")
+    if restart:
+        logger.warning("⚠️ Изменения вступят в силу после перезапуска: %s", ', '.join(restart))
+
+def _process_all_users(deadline):
+    """Один цикл синхронизации: список мастеров, отбор, запуск движка"""
+    _cycle_control['cancel'].clear()
+    
+    # Изменённый CONFIG_FILE применяется до начала цикла
+    _reload_config_file()
+    
+    logger.info("🚀 НАЧАЛО ОБРАБОТКИ (SSL: %s, не глубже %d часов)",
+                'Отключена' if DISABLE_SSL_VERIFY else 'Включена', CONFIG['hours_ago'])
+    
+    all_users = get_all_users_from_ottai_cached()
+    
+    if not all_users:
+        logger.error("❌ Не удалось получить пользователей из Ottai")
+        return
+    
+    # Изменённые NS_URL__*/NS_SECRET__* применяются без перезапуска
+    if reload_nightscout_configs():
+        logger.info("Конфигурации Nightscout изменились, мастера будут сопоставлены заново")
+    
+    # Отображаем мастеров и фильтруем настроенных (при смене списка)
+    master_statuses, configured_users = resolve_users(all_users)
+    
+    logger.info("Настроено пользователей: %d", len(configured_users))
     
-    print(f"\n[INFO] Настроено пользователей: {len(configured_users)}")
+    # Забываем конфигурации мастеров, которых больше нет в списке
+    active_ids = {str(user['fromUserId']) for user in configured_users}
+    for user_id in list(_user_config_cache):
+        if user_id not in active_ids:
+            metrics.forget_master(_user_config_cache[user_id][1]['config_key'])
+            del _user_config_cache[user_id]
+    with _poll_schedule['lock']:
+        for user_id in list(_poll_schedule['masters']):
+            if user_id not in active_ids:
+                del _poll_schedule['masters'][user_id]
+    with _trend_windows['lock']:
+        for user_id in list(_trend_windows['masters']):
+            if user_id not in active_ids:
+                del _trend_windows['masters'][user_id]
+    with _outbox['lock']:
+        for state_key, user_config in list(_outbox['masters'].items()):
+            if str(user_config['from_user_id']) not in active_ids:
+                del _outbox['masters'][state_key]
     
     if not configured_users:
-        print("\n💡 ДОБАВЬТЕ ПЕРЕМЕННЫЕ ОКРУЖЕНИЯ:")
-        print("   Для каждого пользователя нужно добавить две переменные:")
-        print()
+        logger.warning("💡 ДОБАВЬТЕ ПЕРЕМЕННЫЕ ОКРУЖЕНИЯ: для каждого пользователя нужны две переменные")
 
         for master in master_statuses:
             if not master['configured']:
                 label = master['clean_email'] or master['email'] or master['user_name'] or str(master['user_id'])
-                print(f"   Для пользователя '{label}':")
                 # Ключ: email → userName → userId
                 key = normalize_email_key(master['clean_email'] or master['email']) \
                       or master['user_name'] \
                       or str(master['user_id'])
                 if key:
-                    print(f"   NS_URL__{key}=https://ваш_nightscout.herokuapp.com")
-                    print(f"   NS_SECRET__{key}=ваш_секрет")
-                print()
+                    logger.warning("Для пользователя '%s': NS_URL__%s=https://ваш_nightscout.herokuapp.com, "
+                                   "NS_SECRET__%s=ваш_секрет", label, key, key)
         return
     
+    # Адаптивный опрос: мастера, у которых новое показание ещё не ожидается, пропускаем
+    due_users = [user_info for user_info in configured_users if is_master_due(user_info)]
+    if len(due_users) < len(configured_users):
+        deferred = [user_info for user_info in configured_users if not is_master_due(user_info)]
+        next_poll = min(_next_poll_time(user_info) for user_info in deferred)
+        logger.info("Опрос отложен для %d мастеров (ближайший в %s)",
+                    len(deferred), format_local_time(next_poll * 1000, '%H:%M:%S'))
+    configured_users = _defer_throttled_accounts(due_users)
+    
+    if SYNC_ENGINE == 'async' and _async_engine_ready():
+        from async_engine import run_async_cycle
+        total_successful = run_async_cycle(configured_users, deadline)
+    elif SYNC_ENGINE == 'pipeline':
+        from pipeline import run_pipeline_cycle
+        total_successful = run_pipeline_cycle(configured_users, deadline)
+    else:
+        total_successful = _process_users_threaded(configured_users, deadline)
+    
+    _cleanup_old_cache()
+    
+    logger.info("📊 ИТОГ: Успешно обработано %d записей", total_successful)
+
+def _defer_throttled_accounts(users):
+    """
+    Мастера в порядке обработки: чередование по аккаунтам фолловеров. При
+    нескольких аккаунтах мастера аккаунта на паузе после 429 откладываются
+    до следующего цикла, чтобы не занимать общие потоки ожиданием
+    """
+    accounts = get_accounts()
+    if len(accounts) > 1:
+        paused = {}
+        for account in accounts:
+            pause = account.limiter.paused_for()
+            if pause > 0:
+                paused[account.name] = pause
+        
+        if paused:
+            deferred = [user_info for user_info in users if get_account(user_info.get('account')).name in paused]
+            if deferred:
+                logger.info("Опрос отложен для %d мастеров: аккаунты на паузе после 429: %s", len(deferred),
+                            ', '.join(f"{name} ({pause:.0f} с)" for name, pause in paused.items()))
+                users = [user_info for user_info in users if user_info not in deferred]
+    
+    return fair_order(users)
+
+def _async_engine_ready():
+    """Проверка, что asyncio-движок можно использовать (иначе — потоки)"""
+    from async_engine import async_engine_available
+    
+    if async_engine_available():
+        return True
+    
+    logger.warning("SYNC_ENGINE=async требует пакет aiohttp (pip install aiohttp), используем потоки")
+    return False
+
+def _process_users_threaded(configured_users, deadline=None):
+    """
+    Параллельная обработка пользователей в пуле потоков.
+    По дедлайну неначатые задачи отменяются, а выполняющиеся прерываются
+    на ближайшей контрольной точке (перед запросом к Ottai или очередной пачкой)
+    """
     total_successful = 0
     
-    # Параллельная обработка пользователей
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=CONFIG['max_workers'])
+    try:
+        # Задачи подаются в порядке смещения старта: ожидания потоков не
+        # складываются, все мастера стартуют в пределах MASTER_JITTER_SECONDS
+        started = time.monotonic()
         futures = []
-        for user_info in configured_users:
-            future = executor.submit(process_user_wrapper, user_info)
+        for user_info in sorted(configured_users, key=master_start_offset):
+            future = executor.submit(process_user_wrapper, user_info, started)
             futures.append(future)
         
-        for future in concurrent.futures.as_completed(futures):
-            total_successful += future.result()
-    
-    _cleanup_old_cache()
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        done = set()
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout=timeout):
+                done.add(future)
+                total_successful += future.result()
+        except concurrent.futures.TimeoutError:
+            _cycle_control['cancel'].set()
+            cancelled = sum(1 for future in futures if future.cancel())
+            logger.warning("⏱️ Дедлайн цикла: отменено мастеров: %d, ожидаем прерывания выполняющихся",
+                           cancelled)
+            for future in futures:
+                if future not in done and not future.cancelled():
+                    total_successful += future.result()
+    finally:
+        executor.shutdown(wait=True)
     
-    print("\n" + "="*80)
-    print(f"📊 ИТОГ: Успешно обработано {total_successful} записей")
-    print("="*80)
+    return total_successful
 
 def _cleanup_old_cache():
     """Очистка устаревших кэшей"""
@@ -648,8 +1961,4 @@ def _cleanup_old_cache():
             keys_to_remove.append(key)
     
     for key in keys_to_remove:
-        del _connection_cache[key]
-    
-    if current_time - _user_cache['timestamp'] > 600:
-        _user_cache['data'] = None
-        _user_cache['timestamp'] = 0
\ No newline at end of file
+        del _connection_cache[key]
\ No newline at end of file
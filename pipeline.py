@@ -0,0 +1,191 @@
+import queue
+import threading
+import time
+from urllib.parse import urlparse
+
+from setup import (
+    PIPELINE_FETCH_WORKERS, PIPELINE_PREPARE_WORKERS, PIPELINE_UPLOAD_WORKERS, PIPELINE_QUEUE_SIZE
+)
+from module import (
+    master_start_offset, create_user_config, cycle_cancelled, wait_cycle_cancelled, cancel_cycle,
+    check_nightscout_connection_cached, get_nightscout_last_entry_date_cached,
+    plan_sync_window, get_ottai_data_batch, select_new_entries, enqueue_new_entries, drain_outbox
+)
+from log import get_logger, master_context
+import profiling
+
+logger = get_logger('pipeline')
+
+# ========== КОНВЕЙЕР ЦИКЛА СИНХРОНИЗАЦИИ ==========
+# Включается SYNC_ENGINE=pipeline. Обработка мастера разбита
+# на стадии со своими пулами потоков, связанные ограниченными очередями:
+#   connect (Nightscout) → fetch (Ottai) → prepare (CPU) → upload (Nightscout)
+# Медленный ответ Ottai не задерживает отправку других мастеров, а медленный
+# Nightscout — загрузку из Ottai. Логика окна, дедупликации и очереди отправки
+# общая с другими движками (module.py)
+
+# Признак конца входной очереди стадии
+_STOP = object()
+
+class _Stage:
+    """
+    Стадия конвейера: потоки читают задания из входной очереди и передают
+    их следующей стадии, если обработчик вернул True
+    """
+
+    def __init__(self, pipeline, name, workers, handler, output=None, maxsize=0):
+        self.pipeline = pipeline
+        self.name = name
+        self.handler = handler
+        self.output = output
+        self.input = queue.Queue(maxsize)
+        self.threads = [threading.Thread(target=self._run, name=f"pipeline-{name}-{index}", daemon=True)
+                        for index in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def close(self):
+        """Конец входных заданий: потоки завершаются, разобрав очередь"""
+        for _ in self.threads:
+            self.input.put(_STOP)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        with profiling.profile_thread():
+            while True:
+                job = self.input.get()
+                if job is _STOP:
+                    return
+
+                user_config = job['config']
+                # После дедлайна задания только проходят насквозь, не выполняя работу
+                forward = False
+                with master_context(user_config['config_key']), profiling.resume_master(job['profile']):
+                    try:
+                        forward = not cycle_cancelled() and self.handler(job)
+                    except Exception as e:
+                        logger.exception("Ошибка при обработке %s (стадия %s): %s",
+                                         user_config['email'], self.name, e)
+
+                if forward and self.output is not None:
+                    self.output.input.put(job)
+                else:
+                    self.pipeline.finish(job)
+
+class _Pipeline:
+    """Стадии одного цикла и учёт завершённых мастеров"""
+
+    def __init__(self):
+        self.upload = _Stage(self, 'upload', PIPELINE_UPLOAD_WORKERS, _upload, None, PIPELINE_QUEUE_SIZE)
+        self.prepare = _Stage(self, 'prepare', PIPELINE_PREPARE_WORKERS, _prepare, self.upload, PIPELINE_QUEUE_SIZE)
+        self.fetch = _Stage(self, 'fetch', PIPELINE_FETCH_WORKERS, _fetch, self.prepare, PIPELINE_QUEUE_SIZE)
+        # Вход конвейера не ограничен: в нём только конфигурации мастеров
+        self.connect = _Stage(self, 'connect', PIPELINE_UPLOAD_WORKERS, _connect, self.fetch)
+        self.stages = [self.connect, self.fetch, self.prepare, self.upload]
+        self.finished = 0
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def finish(self, job):
+        profiling.finish_master(job['profile'])
+        with self._lock:
+            self.finished += 1
+            self.sent += job['sent']
+
+    def feed(self, configured_users):
+        """
+        Подача мастеров на вход со смещением старта (MASTER_JITTER_SECONDS)
+        и закрытие стадий по порядку после завершения предыдущей
+        """
+        started = time.monotonic()
+        for user_info in sorted(configured_users, key=master_start_offset):
+            delay = master_start_offset(user_info) - (time.monotonic() - started)
+            if wait_cycle_cancelled(max(0.0, delay)):
+                break
+
+            user_config = create_user_config(user_info['email'], user_info['fromUserId'], user_info.get('userName'),
+                                             user_info.get('account'))
+            if not user_config:
+                logger.warning("Пользователь %s не настроен", user_info['email'])
+                continue
+
+            self.connect.input.put({
+                'config': user_config,
+                'profile': profiling.start_master(user_config['config_key'],
+                                                  urlparse(user_config['ns_url']).netloc),
+                'sent': 0
+            })
+
+        for stage in self.stages:
+            stage.close()
+            stage.join()
+
+def _connect(job):
+    """Проверка Nightscout и окно загрузки мастера"""
+    user_config = job['config']
+    logger.debug("Мастер %s (ID: %s)", user_config['email'], user_config['from_user_id'])
+
+    with profiling.span('connect'):
+        job['connected'] = check_nightscout_connection_cached(user_config)
+    if not job['connected']:
+        logger.error("❌ Nightscout недоступен, новые записи будут сохранены в очередь")
+
+    ns_last_date = get_nightscout_last_entry_date_cached(user_config) if job['connected'] else None
+    job['window'] = plan_sync_window(user_config, ns_last_date)
+    return job['window'] is not None
+
+def _fetch(job):
+    """
+    Загрузка окна из Ottai. Ответ разбирается по мере чтения, но стадии подготовки
+    передаётся полный список записей окна (память ограничена PIPELINE_QUEUE_SIZE):
+    поток загрузки освобождается до подготовки
+    """
+    _, _, start_time, end_time = job['window']
+    job['curve_list'] = get_ottai_data_batch(job['config'], start_time, end_time)
+    return True
+
+def _prepare(job):
+    """Отбор новых записей, подготовка для Nightscout и постановка в очередь отправки"""
+    user_config = job['config']
+    state_key, sync_state, _, _ = job['window']
+
+    with profiling.span('prepare'):
+        entries = select_new_entries(user_config, job.pop('curve_list'), sync_state)
+        if entries is not None:
+            enqueue_new_entries(user_config, state_key, entries)
+
+    return job['connected']
+
+def _upload(job):
+    """Отправка очереди мастера в Nightscout"""
+    with profiling.span('upload'):
+        job['sent'] = drain_outbox(job['config'], job['window'][0])
+    return True
+
+def run_pipeline_cycle(configured_users, deadline=None):
+    """
+    Обработка всех настроенных мастеров конвейером.
+    deadline — момент time.monotonic(), после которого цикл отменяется: новые
+    задания не начинаются, выполняющиеся прерываются на ближайшей контрольной точке.
+    Возвращает количество отправленных записей
+    """
+    pipeline = _Pipeline()
+    for stage in pipeline.stages:
+        stage.start()
+
+    feeder = threading.Thread(target=pipeline.feed, args=(configured_users,), name='pipeline-feed', daemon=True)
+    feeder.start()
+
+    feeder.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+    if feeder.is_alive():
+        cancel_cycle()
+        logger.warning("⏱️ Дедлайн цикла: не завершено мастеров: %d, ожидаем прерывания выполняющихся",
+                       len(configured_users) - pipeline.finished)
+        feeder.join()
+
+    return pipeline.sent
@@ -0,0 +1,212 @@
+import contextlib
+import contextvars
+import cProfile
+import math
+import os
+import pstats
+import threading
+import time
+
+from setup import PROFILE, PROFILE_CYCLES, PROFILE_DIR
+from log import get_logger
+
+logger = get_logger('profiling')
+
+# ========== ПРОФИЛИРОВАНИЕ ЦИКЛА ==========
+# PROFILE=true — замер фаз обработки каждого мастера и сводка в конце цикла
+# (по мастерам и в целом: p50/p95, самый медленный хост Nightscout).
+# PROFILE_CYCLES=N — запись cProfile за N циклов в PROFILE_DIR (pstats-файл).
+#
+# Время фазы — собственное (без вложенных фаз): загрузка из Ottai и разбор JSON
+# выполняются внутри подготовки записей (поток), но учитываются отдельно
+
+PHASES = ('connect', 'ottai_fetch', 'json_decode', 'prepare', 'upload')
+
+# Фазы, время которых зависит от хоста Nightscout
+HOST_PHASES = ('connect', 'upload')
+
+# Замеры мастера, обрабатываемого в текущем потоке/задаче asyncio
+_current_master = contextvars.ContextVar('profile_master', default=None)
+
+_profile_state = {
+    'masters': [],
+    'profiles': [],
+    'cycles_left': PROFILE_CYCLES,
+    'stats': None,
+    'path': None,
+    'lock': threading.Lock()
+}
+
+def capture_active():
+    """Идёт ли запись cProfile"""
+    return _profile_state['cycles_left'] > 0
+
+def begin_cycle():
+    """Начало цикла: сброс замеров прошлого цикла"""
+    with _profile_state['lock']:
+        _profile_state['masters'] = []
+        _profile_state['profiles'] = []
+
+def start_master(config_key, host):
+    """
+    Начало замеров мастера, фазы которого выполняются в разных потоках
+    (стадии конвейера). None при PROFILE=false
+    """
+    if not PROFILE:
+        return None
+
+    return {'config_key': config_key, 'host': host, 'phases': dict.fromkeys(PHASES, 0.0),
+            'stack': [], 'total': 0.0, 'started': time.perf_counter()}
+
+@contextlib.contextmanager
+def resume_master(record):
+    """Замеры мастера в текущем потоке/задаче (внутри — вызовы span())"""
+    if record is None:
+        yield
+        return
+
+    token = _current_master.set(record)
+    try:
+        yield
+    finally:
+        _current_master.reset(token)
+
+def finish_master(record):
+    """
+    Конец замеров мастера. В конвейере общее время — от первой стадии
+    до последней, включая ожидание в очередях между стадиями
+    """
+    if record is None:
+        return
+
+    record['total'] = time.perf_counter() - record.pop('started')
+    del record['stack']
+    with _profile_state['lock']:
+        _profile_state['masters'].append(record)
+
+@contextlib.contextmanager
+def master_span(config_key, host):
+    """Замеры фаз одного мастера (внутри — вызовы span())"""
+    record = start_master(config_key, host)
+    try:
+        with resume_master(record):
+            yield
+    finally:
+        finish_master(record)
+
+@contextlib.contextmanager
+def span(phase):
+    """Замер фазы мастера; время вложенных фаз вычитается из родительской"""
+    record = _current_master.get()
+    if record is None:
+        yield
+        return
+
+    stack = record['stack']
+    # [фаза, время вложенных фаз]
+    frame = [phase, 0.0]
+    stack.append(frame)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stack.pop()
+        record['phases'][phase] += elapsed - frame[1]
+        if stack:
+            stack[-1][1] += elapsed
+
+@contextlib.contextmanager
+def profile_thread():
+    """
+    cProfile для текущего потока (профайлер cProfile работает только в потоке,
+    где включён, поэтому каждый поток пула профилируется отдельно)
+    """
+    if not capture_active():
+        yield
+        return
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Профайлер уже активен (в Python 3.12+ cProfile один на процесс
+        # и профиль цикла охватывает все потоки)
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        profile.disable()
+        with _profile_state['lock']:
+            _profile_state['profiles'].append(profile)
+
+def _percentile(values, percent):
+    """Перцентиль по методу ближайшего ранга"""
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def _format_phases(phases):
+    return ', '.join(f"{phase} {phases[phase] * 1000:.0f}" for phase in PHASES)
+
+def report_cycle():
+    """Сводка замеров цикла в лог (PROFILE=true)"""
+    with _profile_state['lock']:
+        masters = list(_profile_state['masters'])
+
+    if not PROFILE or not masters:
+        return
+
+    logger.info("⏱️ Профиль цикла (мс): мастеров %d", len(masters))
+    for record in sorted(masters, key=lambda record: record['total'], reverse=True):
+        logger.info("   %s [%s]: всего %.0f — %s", record['config_key'], record['host'],
+                    record['total'] * 1000, _format_phases(record['phases']))
+
+    for phase in PHASES + ('total',):
+        values = [record['phases'][phase] if phase != 'total' else record['total'] for record in masters]
+        logger.info("   %-11s p50 %.0f, p95 %.0f, max %.0f", phase, _percentile(values, 50) * 1000,
+                    _percentile(values, 95) * 1000, max(values) * 1000)
+
+    hosts = {}
+    for record in masters:
+        hosts.setdefault(record['host'], []).append(sum(record['phases'][phase] for phase in HOST_PHASES))
+    slowest_host, host_times = max(hosts.items(), key=lambda item: sum(item[1]) / len(item[1]))
+    logger.info("   Самый медленный хост Nightscout: %s (connect+upload в среднем %.0f мс, мастеров %d)",
+                slowest_host, sum(host_times) / len(host_times) * 1000, len(host_times))
+
+def finish_capture():
+    """
+    Конец цикла при PROFILE_CYCLES: профили потоков цикла добавляются к общему
+    pstats-файлу (файл перезаписывается после каждого цикла)
+    """
+    with _profile_state['lock']:
+        if _profile_state['cycles_left'] <= 0:
+            return
+        profiles = _profile_state['profiles']
+        _profile_state['profiles'] = []
+        _profile_state['cycles_left'] -= 1
+        cycles_left = _profile_state['cycles_left']
+
+        for profile in profiles:
+            if _profile_state['stats'] is None:
+                _profile_state['stats'] = pstats.Stats(profile)
+            else:
+                _profile_state['stats'].add(profile)
+
+        stats = _profile_state['stats']
+        if stats is None:
+            return
+
+        if _profile_state['path'] is None:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            _profile_state['path'] = os.path.join(
+                PROFILE_DIR, f"cycles-{time.strftime('%Y%m%d-%H%M%S')}.pstats")
+        stats.dump_stats(_profile_state['path'])
+
+    if cycles_left:
+        logger.info("🧪 Профиль cProfile сохранён в %s (осталось циклов: %d)", _profile_state['path'], cycles_left)
+    else:
+        logger.info("🧪 Запись профиля завершена: %s (python -m pstats %s)",
+                    _profile_state['path'], _profile_state['path'])
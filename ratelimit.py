@@ -0,0 +1,73 @@
+import email.utils
+import threading
+import time
+
+from log import get_logger
+
+logger = get_logger('ratelimit')
+
+# ========== ЛИМИТ ЗАПРОСОВ К OTTAI ==========
+# Все мастера аккаунта фолловера работают через один токен, поэтому запросы
+# всех потоков и задач аккаунта проходят через его token bucket (accounts.py):
+# OTTAI_RATE_LIMIT запросов в секунду в среднем и до OTTAI_RATE_BURST подряд.
+# Ответ 429 приостанавливает выдачу разрешений на время из Retry-After
+
+# Пауза после 429 без Retry-After и верхняя граница паузы (с)
+DEFAULT_RETRY_AFTER_SECONDS = 30
+MAX_RETRY_AFTER_SECONDS = 900
+
+class TokenBucket:
+    """
+    Token bucket в форме GCRA: вместо счётчика токенов хранится время,
+    к которому будут израсходованы уже выданные разрешения. rate <= 0 — без лимита
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._next_free = 0.0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Резерв разрешения на один запрос. Возвращает задержку (с), после
+        которой запрос можно выполнять (0 — сразу)
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.rate <= 0:
+                return max(0.0, self._paused_until - now)
+
+            interval = 1.0 / self.rate
+            next_free = max(self._next_free, now)
+            # Подряд можно выполнить burst запросов: допуск burst - 1 интервалов
+            allowed_at = max(next_free - (self.burst - 1) * interval, self._paused_until, now)
+            self._next_free = max(next_free, allowed_at) + interval
+            return allowed_at - now
+
+    def pause(self, seconds):
+        """Приостановка выдачи разрешений (ответ 429)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def paused_for(self):
+        """Сколько секунд ещё длится пауза после 429 (0 — паузы нет)"""
+        with self._lock:
+            return max(0.0, self._paused_until - time.monotonic())
+
+def parse_retry_after(value, default=DEFAULT_RETRY_AFTER_SECONDS):
+    """Retry-After в секундах (число секунд или HTTP-дата), не больше MAX_RETRY_AFTER_SECONDS"""
+    if not value:
+        return default
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            logger.debug("Некорректный Retry-After: %s", value)
+            return default
+
+    return min(MAX_RETRY_AFTER_SECONDS, max(0.0, seconds))
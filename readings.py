@@ -0,0 +1,196 @@
+import bisect
+import datetime
+import math
+from array import array
+from datetime import timedelta
+
+# NumPy ускоряет форматирование дат больших окон, но не обязателен
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# ========== КОМПАКТНОЕ ХРАНЕНИЕ ПОКАЗАНИЙ ==========
+# Подготовленные показания мастера хранятся колонками array (8 байт на значение)
+# вместо списка словарей с повторяющимися "type", device и dateString.
+# В очередь отправки сохраняются те же колонки, а словари записей Nightscout
+# создаются по запросу — пачками при отправке
+
+# Показание без dataNo
+NO_DATA_NO = -1
+
+# Показание без направления (в записи Nightscout — Flat)
+NO_DIRECTION = -1
+
+# Сколько записей создаётся за раз при переборе хранилища
+MATERIALIZE_CHUNK = 256
+
+def format_date_strings(timestamps):
+    """
+    ISO-строки UTC с миллисекундами ('2024-10-12T13:13:34.879Z') для списка времён (мс)
+    """
+    if np is not None:
+        values = np.datetime_as_string(np.array(timestamps, dtype='datetime64[ms]'), unit='ms')
+        return [value + 'Z' for value in values.tolist()]
+
+    # Без NumPy: дата кэшируется по дням, время собирается из целых
+    day_cache = {}
+    date_strings = []
+    for timestamp in timestamps:
+        day, ms_of_day = divmod(timestamp, 86400000)
+        day_str = day_cache.get(day)
+        if day_str is None:
+            day_str = (datetime.date(1970, 1, 1) + timedelta(days=day)).isoformat()
+            day_cache[day] = day_str
+        seconds, ms = divmod(ms_of_day, 1000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        date_strings.append(f"{day_str}T{hours:02d}:{minutes:02d}:{seconds:02d}.{ms:03d}Z")
+    return date_strings
+
+class ReadingStore:
+    """
+    Показания одного мастера: время (мс), dataNo, sgv (мг/дл), направление и delta.
+    Ведёт себя как последовательность записей Nightscout: store[i] и store[a:b]
+    создают словари только для запрошенных показаний.
+    delta хранится в 'd' (float64): во float32 округлённое значение (2.3)
+    превратилось бы в 2.299999952 в JSON
+    """
+
+    __slots__ = ('device', 'dates', 'data_numbers', 'sgv', 'deltas', 'directions', 'direction_names',
+                 '_direction_codes')
+
+    def __init__(self, device):
+        self.device = device
+        self.dates = array('q')
+        self.data_numbers = array('q')
+        self.sgv = array('q')
+        self.deltas = array('d')
+        self.directions = array('h')
+        # Направления кодируются номером в direction_names (их немного: значения TREND_MAP)
+        self.direction_names = []
+        self._direction_codes = {}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def _direction_code(self, direction):
+        code = self._direction_codes.get(direction)
+        if code is None:
+            code = self._direction_codes[direction] = len(self.direction_names)
+            self.direction_names.append(direction)
+        return code
+
+    def append(self, date, sgv, data_no=NO_DATA_NO, direction=None, explicit=False):
+        """
+        Добавление показания. explicit — направление задано в данных Ottai
+        (direction сохраняется как есть, даже None); иначе его рассчитает тренд.
+        Значения вне диапазона колонок (OverflowError) не добавляются
+        """
+        code = self._direction_code(direction) if explicit else NO_DIRECTION
+        columns = (self.dates, self.sgv, self.data_numbers)
+        try:
+            for column, value in zip(columns, (date, sgv, data_no)):
+                column.append(value)
+        except OverflowError:
+            # Откат частично добавленного показания: колонки одной длины
+            size = len(self.deltas)
+            for column in columns:
+                del column[size:]
+            raise
+        self.deltas.append(math.nan)
+        self.directions.append(code)
+
+    def extend(self, dates, sgv_values, data_numbers):
+        """Добавление колонок показаний без направления (пакетная подготовка)"""
+        self.dates.extend(dates)
+        self.sgv.extend(sgv_values)
+        self.data_numbers.extend(data_numbers)
+        self.deltas.extend([math.nan] * len(dates))
+        self.directions.extend([NO_DIRECTION] * len(dates))
+
+    def set_trend(self, index, direction, delta):
+        """Направление по тренду (если не задано в данных) и delta"""
+        if self.directions[index] == NO_DIRECTION:
+            self.directions[index] = self._direction_code(direction)
+        self.deltas[index] = delta
+
+    def sort(self):
+        """Упорядочивание по времени (нужно для поиска по времени)"""
+        dates = self.dates
+        if all(dates[i - 1] <= dates[i] for i in range(1, len(dates))):
+            return
+
+        order = sorted(range(len(dates)), key=dates.__getitem__)
+        for name in ('dates', 'data_numbers', 'sgv', 'deltas', 'directions'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (column[i] for i in order)))
+
+    def newest(self):
+        """Время самого свежего показания (хранилище упорядочено) или None"""
+        return self.dates[-1] if self.dates else None
+
+    def find(self, date):
+        """Индекс показания с временем date или -1 (хранилище упорядочено)"""
+        index = bisect.bisect_left(self.dates, date)
+        if index < len(self.dates) and self.dates[index] == date:
+            return index
+        return -1
+
+    def data_no_at(self, date):
+        """dataNo показания с временем date или None"""
+        index = self.find(date)
+        if index < 0 or self.data_numbers[index] == NO_DATA_NO:
+            return None
+        return self.data_numbers[index]
+
+    def _entries(self, start, stop):
+        date_strings = format_date_strings(self.dates[start:stop])
+        entries = []
+        for index, date_string in zip(range(start, stop), date_strings):
+            code = self.directions[index]
+            entry = {
+                "type": "sgv",
+                "sgv": self.sgv[index],
+                "direction": self.direction_names[code] if code != NO_DIRECTION else "Flat",
+                "device": self.device,
+                "date": self.dates[index],
+                "dateString": date_string
+            }
+            delta = self.deltas[index]
+            if not math.isnan(delta):
+                entry['delta'] = delta
+            entries.append(entry)
+        return entries
+
+    def append_prepared(self, date, sgv, direction, delta=None):
+        """Добавление показания с уже рассчитанными направлением и delta (из очереди отправки)"""
+        self.append(date, sgv, direction=direction, explicit=True)
+        if delta is not None:
+            self.deltas[-1] = delta
+
+    def rows(self):
+        """Показания без создания словарей: (время, sgv, направление, delta или None)"""
+        for index in range(len(self)):
+            code = self.directions[index]
+            delta = self.deltas[index]
+            yield (self.dates[index], self.sgv[index],
+                   self.direction_names[code] if code != NO_DIRECTION else "Flat",
+                   None if math.isnan(delta) else delta)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("шаг среза не поддерживается")
+            return self._entries(start, max(start, stop))
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._entries(index, index + 1)[0]
+
+    def __iter__(self):
+        for start in range(0, len(self), MATERIALIZE_CHUNK):
+            yield from self._entries(start, min(start + MATERIALIZE_CHUNK, len(self)))
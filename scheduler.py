@@ -0,0 +1,140 @@
+import threading
+import time
+import collections
+
+from log import get_logger
+
+logger = get_logger('scheduler')
+
+# ========== ПЛАНИРОВЩИК ЦИКЛОВ ==========
+# Тики с фиксированным шагом, выровненные по времени (а не "через N секунд
+# после окончания прошлого цикла"), без наложения циклов и с дедлайном на цикл
+
+class CycleScheduler:
+    """
+    Планировщик циклов синхронизации.
+
+    job(deadline) вызывается на каждом тике в отдельном потоке; deadline —
+    момент time.monotonic(), к которому цикл должен завершиться (задачи,
+    не успевшие к дедлайну, отменяются самим циклом). Если предыдущий цикл
+    ещё выполняется, тик пропускается.
+    """
+
+    def __init__(self, job, interval, offset=0, deadline=None, phase_provider=None, history_size=100):
+        self.job = job
+        self.interval = interval
+        self.offset = offset
+        self.deadline = deadline if deadline else interval * 0.9
+        # Функция, возвращающая время (мс) последнего показания датчика —
+        # по нему выравниваются тики (SCHEDULE_OFFSET=auto)
+        self.phase_provider = phase_provider
+        self.tick_stats = collections.deque(maxlen=history_size)
+        self.tick_count = 0
+        self.skipped_ticks = 0
+        self._running = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _current_offset(self):
+        """Смещение тиков внутри интервала (секунды)"""
+        if self.phase_provider is None:
+            return self.offset
+
+        try:
+            last_reading = self.phase_provider()
+        except Exception:
+            last_reading = None
+
+        if not last_reading:
+            return self.offset
+
+        # Тик через self.offset секунд после ожидаемого показания датчика
+        return (last_reading / 1000 + self.offset) % self.interval
+
+    def next_tick_time(self, now=None):
+        """Ближайшее выровненное время тика (time.time())"""
+        now = time.time() if now is None else now
+        offset = self._current_offset()
+        tick = (now - offset) // self.interval * self.interval + offset
+        while tick <= now:
+            tick += self.interval
+        return tick
+
+    def is_running(self):
+        """Выполняется ли сейчас цикл"""
+        with self._lock:
+            return self._running is not None and self._running.is_alive()
+
+    def _run_job(self, tick_no, scheduled_at, deadline):
+        started_at = time.time()
+        started_monotonic = time.monotonic()
+        outcome = 'ok'
+        try:
+            self.job(deadline)
+        except Exception as e:
+            outcome = 'error'
+            logger.exception("❌ Критическая ошибка в цикле: %s", e)
+
+        duration = time.monotonic() - started_monotonic
+        if outcome == 'ok' and time.monotonic() > deadline:
+            outcome = 'deadline'
+
+        self._record(tick_no, scheduled_at, started_at, duration, outcome)
+
+    def _record(self, tick_no, scheduled_at, started_at, duration, outcome):
+        stats = {
+            'tick': tick_no,
+            'scheduled_at': scheduled_at,
+            'start_lag': max(0.0, started_at - scheduled_at) if started_at else None,
+            'duration': duration,
+            'outcome': outcome,
+        }
+        self.tick_stats.append(stats)
+
+        if outcome == 'skipped':
+            logger.warning("⏱️ Тик #%d пропущен: предыдущий цикл ещё выполняется (пропущено всего: %d)",
+                           tick_no, self.skipped_ticks)
+        else:
+            logger.info("⏱️ Тик #%d: задержка старта %.0f мс, длительность %.1f с, результат: %s",
+                        tick_no, stats['start_lag'] * 1000, duration, outcome)
+
+    def tick(self, scheduled_at=None):
+        """Запуск одного цикла (если предыдущий не выполняется)"""
+        scheduled_at = time.time() if scheduled_at is None else scheduled_at
+
+        with self._lock:
+            self.tick_count += 1
+            tick_no = self.tick_count
+            if self._running is not None and self._running.is_alive():
+                self.skipped_ticks += 1
+                skipped = True
+            else:
+                skipped = False
+                deadline = time.monotonic() + self.deadline
+                self._running = threading.Thread(target=self._run_job, args=(tick_no, scheduled_at, deadline),
+                                                 name=f"sync-cycle-{tick_no}", daemon=True)
+                self._running.start()
+
+        if skipped:
+            self._record(tick_no, scheduled_at, None, 0.0, 'skipped')
+
+        return not skipped
+
+    def run_forever(self, run_immediately=True):
+        """Основной цикл планировщика (до stop() или KeyboardInterrupt)"""
+        if run_immediately:
+            self.tick()
+
+        while not self._stop.is_set():
+            scheduled_at = self.next_tick_time()
+            if self._stop.wait(max(0.0, scheduled_at - time.time())):
+                break
+            self.tick(scheduled_at)
+
+    def stop(self, wait=True):
+        """Остановка планировщика; при wait=True ждём завершения текущего цикла"""
+        self._stop.set()
+        with self._lock:
+            running = self._running
+        if wait and running is not None:
+            running.join()
@@ -9,42 +9,283 @@ import json
 import warnings
 from urllib.parse import urlparse
 
+# Форматы файла конфигурации: TOML — Python 3.11+, YAML — при установленном PyYAML
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 # Подавляем предупреждения SSL
 warnings.filterwarnings('ignore', message='Unverified HTTPS request')
 
+# Имя аккаунта фолловера из OTTAI_TOKEN (без суффикса)
+DEFAULT_ACCOUNT = 'default'
+
 # ========== ПРОВЕРКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ==========
-def load_config():
-    """Загрузка конфигурации из переменных окружения"""
+def load_config(env=None):
+    """
+    Загрузка конфигурации из переменных окружения (и файла CONFIG_FILE).
+    env — источник переменных (по умолчанию get_config_source())
+    """
+    env = get_config_source() if env is None else env
     config = {}
     
-    try:
-        config['ottai_token'] = str(os.environ['OTTAI_TOKEN'])
-    except KeyError:
-        sys.exit("OTTAI_TOKEN required. Pass it as an Environment Variable.")
+    config['ottai_token'] = env.get('OTTAI_TOKEN', '').strip()
 
-    base_url = os.environ.get('OTTAI_BASE_URL', '').strip()
+    base_url = env.get('OTTAI_BASE_URL', '').strip()
     config['ottai_base_url'] = base_url if base_url else "https://seas.ottai.com"
     
+    config['ottai_customerid'] = env.get('OTTAI_CUSTOMER_ID', "")
+    
+    # Аккаунты фолловеров: OTTAI_TOKEN и/или OTTAI_TOKEN__<имя>
+    config['ottai_accounts'] = load_ottai_accounts(config, env)
+    if not config['ottai_accounts']:
+        sys.exit("OTTAI_TOKEN required. Pass it as an Environment Variable.")
+    
     try:
-        config['hours_ago'] = int(os.environ['HOURS_AGO'])
+        config['hours_ago'] = int(env['HOURS_AGO'])
     except KeyError:
         sys.exit("HOURS_AGO required. Pass it as an Environment Variable.")
     
-    config['ottai_customerid'] = os.environ.get('OTTAI_CUSTOMER_ID', "")
-    
     # Настройка SSL
-    config['disable_ssl_verify'] = os.environ.get('DISABLE_SSL_VERIFY', 'True').lower() in ('true', '1', 'yes')
+    config['disable_ssl_verify'] = env.get('DISABLE_SSL_VERIFY', 'True').lower() in ('true', '1', 'yes')
+    
+    # Подробный отладочный вывод (дампы запросов и ответов)
+    config['debug'] = env.get('DEBUG', 'False').lower() in ('true', '1', 'yes')
+    
+    # Логирование: уровень, формат (text или json) и очистка консоли перед циклом
+    config['log_level'] = env.get('LOG_LEVEL', '').strip().upper() or ('DEBUG' if config['debug'] else 'INFO')
+    if config['log_level'] not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+        sys.exit("LOG_LEVEL must be one of DEBUG, INFO, WARNING, ERROR, CRITICAL.")
+    config['log_format'] = env.get('LOG_FORMAT', 'text').strip().lower() or 'text'
+    clear_console = env.get('CLEAR_CONSOLE', '').strip().lower()
+    config['clear_console'] = clear_console in ('true', '1', 'yes') if clear_console else sys.stdout.isatty()
+    
+    # Пакетная отправка в Nightscout
+    config['batch_size'] = max(1, int(env.get('BATCH_SIZE', 50)))
+    config['batch_retries'] = max(0, int(env.get('BATCH_RETRIES', 2)))
+    
+    # Таймаут HTTP-запросов (с) и потоков обработки мастеров (SYNC_ENGINE=threads)
+    config['request_timeout'] = max(1.0, float(env.get('REQUEST_TIMEOUT', 30)))
+    config['max_workers'] = max(1, int(env.get('MAX_WORKERS', 3)))
+    
+    # Сжатие тела запросов в Nightscout (gzip): поддержка определяется по каждому хосту,
+    # тела меньше NS_GZIP_MIN_BYTES отправляются без сжатия
+    config['ns_gzip'] = env.get('NS_GZIP', 'True').lower() in ('true', '1', 'yes')
+    config['ns_gzip_min_bytes'] = max(0, int(env.get('NS_GZIP_MIN_BYTES', 1024)))
+    
+    # Состояние синхронизации (отметка последней отправленной записи)
+    config['state_dir'] = env.get('STATE_DIR', '').strip() or 'data'
+    config['state_overlap_minutes'] = max(0, int(env.get('STATE_OVERLAP_MINUTES', 15)))
+    
+    # Планировщик: шаг тиков, смещение (секунды или auto — по циклу датчика),
+    # дедлайн цикла и разброс старта мастеров
+    config['schedule_interval'] = max(1, int(env.get('SCHEDULE_INTERVAL', 60)))
+    config['schedule_offset'] = env.get('SCHEDULE_OFFSET', '0').strip().lower() or '0'
+    config['cycle_deadline'] = float(env.get('CYCLE_DEADLINE', 0)) or config['schedule_interval'] * 0.9
+    config['master_jitter_seconds'] = max(0.0, float(env.get('MASTER_JITTER_SECONDS', 5)))
+    
+    # Адаптивный опрос по циклу датчика
+    config['adaptive_polling'] = env.get('ADAPTIVE_POLLING', 'True').lower() in ('true', '1', 'yes')
+    config['sensor_interval_seconds'] = max(60, int(env.get('SENSOR_INTERVAL_SECONDS', 300)))
+    config['poll_max_backoff_seconds'] = max(60, int(env.get('POLL_MAX_BACKOFF_SECONDS', 1800)))
+    
+    # Бэкфилл (--backfill FROM TO): размер окна и число параллельных загрузок
+    config['backfill_window_hours'] = max(1, int(env.get('BACKFILL_WINDOW_HOURS', 6)))
+    config['backfill_workers'] = max(1, int(env.get('BACKFILL_WORKERS', 3)))
+    
+    # Движок цикла: threads (по умолчанию), pipeline или async (нужен aiohttp)
+    config['sync_engine'] = env.get('SYNC_ENGINE', 'threads').strip().lower() or 'threads'
+    config['async_max_concurrency'] = max(1, int(env.get('ASYNC_MAX_CONCURRENCY', 20)))
+    config['async_per_host_limit'] = max(1, int(env.get('ASYNC_PER_HOST_LIMIT', 4)))
+    
+    # Конвейер (SYNC_ENGINE=pipeline): потоки стадий и размер очередей между стадиями.
+    # Загрузка из Ottai — один хост, её пул и ограничивает нагрузку на Ottai
+    config['pipeline_fetch_workers'] = max(1, int(env.get('PIPELINE_FETCH_WORKERS', 3)))
+    config['pipeline_prepare_workers'] = max(1, int(env.get('PIPELINE_PREPARE_WORKERS', 2)))
+    config['pipeline_upload_workers'] = max(1, int(env.get('PIPELINE_UPLOAD_WORKERS', 8)))
+    config['pipeline_queue_size'] = max(1, int(env.get('PIPELINE_QUEUE_SIZE', 16)))
+    
+    # Список мастеров из Ottai: срок свежести (с) и пауза перед повтором после ошибки обновления
+    config['user_list_ttl'] = max(10, int(env.get('USER_LIST_TTL', 300)))
+    config['user_list_retry_seconds'] = max(5, int(env.get('USER_LIST_RETRY_SECONDS', 60)))
+    
+    # Лимит запросов к Ottai (общий для всех мастеров): запросов в секунду (0 — без лимита) и пачка подряд
+    config['ottai_rate_limit'] = max(0.0, float(env.get('OTTAI_RATE_LIMIT', 5)))
+    config['ottai_rate_burst'] = max(1, int(env.get('OTTAI_RATE_BURST', 10)))
+    
+    # Circuit breaker хостов Nightscout: ошибок подряд до открытия и пауза (растёт вдвое до максимума)
+    config['circuit_failure_threshold'] = max(1, int(env.get('CIRCUIT_FAILURE_THRESHOLD', 3)))
+    config['circuit_open_seconds'] = max(1.0, float(env.get('CIRCUIT_OPEN_SECONDS', 30)))
+    config['circuit_max_open_seconds'] = max(config['circuit_open_seconds'],
+                                             float(env.get('CIRCUIT_MAX_OPEN_SECONDS', 900)))
+    
+    # Очередь отправки в Nightscout (outbox): предел записей на мастера,
+    # интервал фоновой досылки (с) и записей за один проход досылки
+    config['outbox_max_entries'] = max(1, int(env.get('OUTBOX_MAX_ENTRIES', 10000)))
+    config['outbox_drain_interval'] = max(1.0, float(env.get('OUTBOX_DRAIN_INTERVAL', 30)))
+    config['outbox_drain_batch'] = max(1, int(env.get('OUTBOX_DRAIN_BATCH', 1000)))
+    
+    # Эндпоинт метрик Prometheus (/metrics); 0 — выключен
+    config['metrics_port'] = max(0, int(env.get('METRICS_PORT', 0)))
+    config['metrics_addr'] = env.get('METRICS_ADDR', '').strip() or '0.0.0.0'
+    
+    # Профилирование: замеры фаз с отчётом по циклу и запись cProfile за N циклов
+    config['profile'] = env.get('PROFILE', 'False').lower() in ('true', '1', 'yes')
+    config['profile_cycles'] = max(0, int(env.get('PROFILE_CYCLES', 0)))
+    config['profile_dir'] = env.get('PROFILE_DIR', '').strip() or os.path.join(config['state_dir'], 'profiles')
     
     return config
 
+def load_ottai_accounts(config, env_vars):
+    """
+    Аккаунты фолловеров Ottai/Syai: OTTAI_TOKEN (аккаунт default) и OTTAI_TOKEN__<имя>.
+    Для аккаунта <имя> свои OTTAI_BASE_URL__<имя> и OTTAI_CUSTOMER_ID__<имя>;
+    если их нет — общие OTTAI_BASE_URL и OTTAI_CUSTOMER_ID
+    """
+    accounts = []
+    
+    if config['ottai_token']:
+        accounts.append({
+            'name': DEFAULT_ACCOUNT,
+            'token': config['ottai_token'],
+            'base_url': config['ottai_base_url'],
+            'customer_id': config['ottai_customerid']
+        })
+    
+    for key in sorted(env_vars):
+        if not key.startswith("OTTAI_TOKEN__"):
+            continue
+        
+        name = key[13:]
+        token = env_vars[key].strip()
+        if not name or not token:
+            continue
+        if name == DEFAULT_ACCOUNT and config['ottai_token']:
+            sys.exit(f"OTTAI_TOKEN__{DEFAULT_ACCOUNT} conflicts with OTTAI_TOKEN.")
+        
+        base_url = env_vars.get(f"OTTAI_BASE_URL__{name}", '').strip()
+        accounts.append({
+            'name': name,
+            'token': token,
+            'base_url': base_url.rstrip('/') if base_url else config['ottai_base_url'],
+            'customer_id': env_vars.get(f"OTTAI_CUSTOMER_ID__{name}", config['ottai_customerid'])
+        })
+    
+    return accounts
+
+# ========== ФАЙЛ КОНФИГУРАЦИИ ==========
+# CONFIG_FILE — необязательный файл (JSON, TOML или YAML) с теми же переменными,
+# что и окружение: NS_URL__<ключ>, NS_SECRET__<ключ>, HOURS_AGO и т.д.; значения
+# файла важнее окружения. Файл перечитывается при изменении mtime (проверка в
+# начале каждого цикла): соответствие мастеров Nightscout и RELOADABLE_SETTINGS
+# применяются без перезапуска, остальные настройки — после перезапуска
+
+# Настройки, применяемые при перечитывании файла без перезапуска
+RELOADABLE_SETTINGS = ('hours_ago', 'batch_size', 'batch_retries', 'max_workers', 'request_timeout')
+
+_config_file = {
+    'path': os.environ.get('CONFIG_FILE', '').strip(),
+    'mtime': None,
+    'values': {}
+}
+
+def read_config_file(path):
+    """Переменные из файла конфигурации: {имя: строка}. Формат — по расширению (.json, .toml, .yaml)"""
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, 'rb') as f:
+        if ext == '.toml':
+            if tomllib is None:
+                raise ValueError("для TOML нужен Python 3.11+")
+            data = tomllib.load(f)
+        elif ext in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ValueError("для YAML нужен PyYAML (pip install pyyaml)")
+            data = yaml.safe_load(f) or {}
+        else:
+            data = json.load(f)
+    
+    if not isinstance(data, dict):
+        raise ValueError("файл должен содержать переменные в виде словаря")
+    
+    values = {}
+    for key, value in data.items():
+        if value is None or isinstance(value, (dict, list)):
+            raise ValueError(f"{key}: ожидается строка или число")
+        values[str(key)] = str(value).lower() if isinstance(value, bool) else str(value)
+    return values
+
+def get_config_source():
+    """Переменные конфигурации: окружение, дополненное и переопределённое файлом CONFIG_FILE"""
+    if not _config_file['values']:
+        return os.environ
+    
+    source = dict(os.environ)
+    source.update(_config_file['values'])
+    return source
+
+def reload_config_file():
+    """
+    Перечитывание CONFIG_FILE, если изменился его mtime. Возвращает None, если
+    файл не менялся, иначе (применённые настройки, настройки, требующие перезапуска).
+    Ошибка чтения или некорректное значение — OSError/ValueError, действует прежняя конфигурация
+    """
+    path = _config_file['path']
+    if not path:
+        return None
+    
+    mtime = os.stat(path).st_mtime_ns
+    if mtime == _config_file['mtime']:
+        return None
+    # Файл с ошибкой не перечитывается до следующего изменения
+    _config_file['mtime'] = mtime
+    
+    previous = _config_file['values']
+    _config_file['values'] = read_config_file(path)
+    try:
+        config = load_config()
+    except (SystemExit, ValueError) as e:
+        _config_file['values'] = previous
+        raise ValueError(str(e)) from None
+    
+    applied = [key for key in RELOADABLE_SETTINGS if config[key] != CONFIG[key]]
+    for key in applied:
+        CONFIG[key] = config[key]
+    restart = [key for key in config if key not in RELOADABLE_SETTINGS and config[key] != CONFIG[key]]
+    return applied, restart
+
+if _config_file['path']:
+    try:
+        _config_file['mtime'] = os.stat(_config_file['path']).st_mtime_ns
+        _config_file['values'] = read_config_file(_config_file['path'])
+    except (OSError, ValueError) as e:
+        sys.exit(f"CONFIG_FILE {_config_file['path']}: {e}")
+
 CONFIG = load_config()
 
 # ========== КОНСТАНТЫ ==========
 NS_UNIT_CONVERT = 18.018
 
+# Символы, заменяемые "_" в ключе конфигурации, и email в строке
+_KEY_UNSAFE_RE = re.compile(r'[^a-z0-9_]')
+_EMAIL_RE = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+
+# Уровни fallback-цепочки поиска конфигурации Nightscout
+TIER_EMAIL = 'email'
+TIER_USER_NAME = 'userName'
+TIER_USER_ID = 'fromUserId'
+
 # ========== КЭШ ==========
 _nightscout_config_cache = None
 
+# Номер версии конфигураций Nightscout (растёт при каждом изменении)
+_nightscout_config_generation = 0
+
 # ========== ФУНКЦИИ ДЛЯ ЗАГОЛОВКОВ ==========
 def get_hash_SHA1(data):
     """Хеширование для Nightscout API secret"""
@@ -64,7 +305,7 @@ def normalize_email_key(email):
         return None
     
     username = email.split('@')[0].lower() if '@' in email else email.lower()
-    return re.sub(r'[^a-z0-9_]', '_', username)
+    return _KEY_UNSAFE_RE.sub('_', username)
 
 def extract_clean_email(email_string):
     """Извлечение чистого email"""
@@ -72,7 +313,7 @@ def extract_clean_email(email_string):
         return None
     
     email_string = email_string.strip()
-    match = re.search(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', email_string)
+    match = _EMAIL_RE.search(email_string)
     
     if match:
         return match.group(0).lower()
@@ -86,37 +327,69 @@ def extract_clean_email(email_string):
 
 def get_nightscout_config_by_email(user_email, user_name=None, user_id=None):
     """Получение конфигурации Nightscout. Fallback-цепочка: email → userName → fromUserId"""
+    found = find_nightscout_config(user_email, user_name, user_id)
+    return found[:2] if found else (None, None)
+
+def find_nightscout_config(user_email, user_name=None, user_id=None):
+    """
+    Поиск конфигурации Nightscout по fallback-цепочке email → userName → fromUserId.
+    Возвращает (url, secret, уровень цепочки) или None
+    """
     configs = get_all_nightscout_configs()
 
     # 1. По email
     if user_email:
         user_key = normalize_email_key(user_email)
         if user_key and user_key in configs:
-            return configs[user_key]
+            return configs[user_key] + (TIER_EMAIL,)
 
     # 2. По userName
     if user_name:
-        user_key = re.sub(r'[^a-z0-9_]', '_', user_name.lower())
+        user_key = _KEY_UNSAFE_RE.sub('_', user_name.lower())
         if user_key and user_key in configs:
-            return configs[user_key]
+            return configs[user_key] + (TIER_USER_NAME,)
 
     # 3. По fromUserId
     if user_id:
         user_key = str(user_id)
         if user_key in configs:
-            return configs[user_key]
+            return configs[user_key] + (TIER_USER_ID,)
 
-    return None, None
+    return None
 
 def get_all_nightscout_configs():
     """Получение всех конфигураций Nightscout"""
     global _nightscout_config_cache
     
-    if _nightscout_config_cache is not None:
-        return _nightscout_config_cache
+    if _nightscout_config_cache is None:
+        _nightscout_config_cache = _scan_nightscout_configs()
+    return _nightscout_config_cache
+
+def reload_nightscout_configs():
+    """
+    Повторное чтение NS_URL__*/NS_SECRET__*. Если конфигурации изменились,
+    увеличивает номер версии и возвращает True
+    """
+    global _nightscout_config_cache, _nightscout_config_generation
+    
+    configs = _scan_nightscout_configs()
+    if configs == _nightscout_config_cache:
+        return False
     
+    changed = _nightscout_config_cache is not None
+    _nightscout_config_cache = configs
+    _nightscout_config_generation += 1
+    return changed
+
+def get_nightscout_config_generation():
+    """Номер версии конфигураций Nightscout (для кэшей, построенных по ним)"""
+    get_all_nightscout_configs()
+    return _nightscout_config_generation
+
+def _scan_nightscout_configs():
+    """Конфигурации Nightscout из переменных окружения и CONFIG_FILE: ключ -> (url, secret)"""
     configs = {}
-    env_vars = os.environ
+    env_vars = get_config_source()
     
     for key, value in env_vars.items():
         if key.startswith("NS_URL__"):
@@ -130,7 +403,6 @@ def get_all_nightscout_configs():
                 if secret:
                     configs[config_key] = (value.strip(), secret.strip())
     
-    _nightscout_config_cache = configs
     return configs
 
 def get_all_nightscout_configs_display():
@@ -139,11 +411,12 @@ def get_all_nightscout_configs_display():
     return len(configs)
 
 # ========== БАЗОВЫЕ ЗАГОЛОВКИ OTTAI ==========
-def get_common_ottai_headers():
-    """Создание базовых заголовков Ottai/Syai"""
-    host = urlparse(CONFIG['ottai_base_url']).netloc or CONFIG['ottai_base_url']
+def get_common_ottai_headers(account=None):
+    """Создание базовых заголовков Ottai/Syai (по умолчанию — первого аккаунта фолловера)"""
+    account = account or CONFIG['ottai_accounts'][0]
+    host = urlparse(account['base_url']).netloc or account['base_url']
     return {
-        "authorization": CONFIG['ottai_token'],
+        "authorization": account['token'],
         "user-agent": "Dart/3.8 (dart:io)",
         "ua": "android",
         "deviceid": "Ottai Share:a:f:ee77b3508c1914df75fd5073c4450a9c",
@@ -160,7 +433,7 @@ def get_common_ottai_headers():
         "host": host,
         "unit": "mmol_L",
         "timezonename": "MSK",
-        "customerid": CONFIG['ottai_customerid'],
+        "customerid": account['customer_id'],
         "versionname": "1.8.0",
     }
 
@@ -169,4 +442,49 @@ OTTAI_TOKEN = CONFIG['ottai_token']
 OTTAI_BASE_URL = CONFIG['ottai_base_url']
 HOURS_AGO = CONFIG['hours_ago']
 OTTAI_CUSTOMERID = CONFIG['ottai_customerid']
-DISABLE_SSL_VERIFY = CONFIG['disable_ssl_verify']
\ No newline at end of file
+OTTAI_ACCOUNTS = CONFIG['ottai_accounts']
+DISABLE_SSL_VERIFY = CONFIG['disable_ssl_verify']
+DEBUG = CONFIG['debug']
+LOG_LEVEL = CONFIG['log_level']
+LOG_FORMAT = CONFIG['log_format']
+CLEAR_CONSOLE = CONFIG['clear_console']
+BATCH_SIZE = CONFIG['batch_size']
+BATCH_RETRIES = CONFIG['batch_retries']
+REQUEST_TIMEOUT = CONFIG['request_timeout']
+MAX_WORKERS = CONFIG['max_workers']
+CONFIG_FILE = _config_file['path']
+NS_GZIP = CONFIG['ns_gzip']
+NS_GZIP_MIN_BYTES = CONFIG['ns_gzip_min_bytes']
+STATE_DIR = CONFIG['state_dir']
+STATE_OVERLAP_MINUTES = CONFIG['state_overlap_minutes']
+SCHEDULE_INTERVAL = CONFIG['schedule_interval']
+SCHEDULE_OFFSET = CONFIG['schedule_offset']
+CYCLE_DEADLINE = CONFIG['cycle_deadline']
+MASTER_JITTER_SECONDS = CONFIG['master_jitter_seconds']
+ADAPTIVE_POLLING = CONFIG['adaptive_polling']
+SENSOR_INTERVAL_SECONDS = CONFIG['sensor_interval_seconds']
+POLL_MAX_BACKOFF_SECONDS = CONFIG['poll_max_backoff_seconds']
+BACKFILL_WINDOW_HOURS = CONFIG['backfill_window_hours']
+BACKFILL_WORKERS = CONFIG['backfill_workers']
+SYNC_ENGINE = CONFIG['sync_engine']
+ASYNC_MAX_CONCURRENCY = CONFIG['async_max_concurrency']
+ASYNC_PER_HOST_LIMIT = CONFIG['async_per_host_limit']
+PIPELINE_FETCH_WORKERS = CONFIG['pipeline_fetch_workers']
+PIPELINE_PREPARE_WORKERS = CONFIG['pipeline_prepare_workers']
+PIPELINE_UPLOAD_WORKERS = CONFIG['pipeline_upload_workers']
+PIPELINE_QUEUE_SIZE = CONFIG['pipeline_queue_size']
+USER_LIST_TTL = CONFIG['user_list_ttl']
+USER_LIST_RETRY_SECONDS = CONFIG['user_list_retry_seconds']
+OTTAI_RATE_LIMIT = CONFIG['ottai_rate_limit']
+OTTAI_RATE_BURST = CONFIG['ottai_rate_burst']
+CIRCUIT_FAILURE_THRESHOLD = CONFIG['circuit_failure_threshold']
+CIRCUIT_OPEN_SECONDS = CONFIG['circuit_open_seconds']
+CIRCUIT_MAX_OPEN_SECONDS = CONFIG['circuit_max_open_seconds']
+OUTBOX_MAX_ENTRIES = CONFIG['outbox_max_entries']
+OUTBOX_DRAIN_INTERVAL = CONFIG['outbox_drain_interval']
+OUTBOX_DRAIN_BATCH = CONFIG['outbox_drain_batch']
+METRICS_PORT = CONFIG['metrics_port']
+METRICS_ADDR = CONFIG['metrics_addr']
+PROFILE = CONFIG['profile']
+PROFILE_CYCLES = CONFIG['profile_cycles']
+PROFILE_DIR = CONFIG['profile_dir']
\ No newline at end of file
@@ -0,0 +1,244 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from setup import STATE_DIR, DEFAULT_ACCOUNT
+from readings import ReadingStore
+
+# ========== ХРАНИЛИЩЕ СОСТОЯНИЯ СИНХРОНИЗАЦИИ ==========
+# SQLite-файл в STATE_DIR (в Docker монтируется как volume),
+# поэтому отметки переживают перезапуск контейнера
+
+STATE_DB_FILE = 'state.sqlite3'
+
+_state_db = {
+    'conn': None,
+    'lock': threading.Lock()
+}
+
+def _get_connection():
+    """Открытие (однократное) базы состояния"""
+    if _state_db['conn'] is None:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(STATE_DIR, STATE_DB_FILE), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                state_key TEXT PRIMARY KEY,
+                last_monitor_time INTEGER NOT NULL,
+                last_data_no INTEGER,
+                updated_at INTEGER NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_progress (
+                job_key TEXT NOT NULL,
+                window_start INTEGER NOT NULL,
+                completed_at INTEGER NOT NULL,
+                PRIMARY KEY (job_key, window_start)
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox_readings (
+                state_key TEXT NOT NULL,
+                date INTEGER NOT NULL,
+                sgv INTEGER NOT NULL,
+                direction TEXT,
+                delta REAL,
+                enqueued_at INTEGER NOT NULL,
+                PRIMARY KEY (state_key, date)
+            )
+        """)
+        # Очередь прежней версии (таблица outbox с JSON записей)
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'outbox'").fetchone():
+            _migrate_legacy_outbox(conn)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_lists (
+                account TEXT PRIMARY KEY,
+                users TEXT NOT NULL,
+                updated_at INTEGER NOT NULL
+            )
+        """)
+        # Список единственного аккаунта из прежней версии (таблица user_list)
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_list'").fetchone():
+            conn.execute("INSERT OR IGNORE INTO user_lists SELECT ?, users, updated_at FROM user_list",
+                         (DEFAULT_ACCOUNT,))
+            conn.execute("DROP TABLE user_list")
+        conn.commit()
+        _state_db['conn'] = conn
+
+    return _state_db['conn']
+
+def _migrate_legacy_outbox(conn):
+    """Перенос записей из таблицы outbox (JSON) в колонки outbox_readings"""
+    rows = []
+    for state_key, entry, enqueued_at in conn.execute("SELECT state_key, entry, enqueued_at FROM outbox"):
+        entry = json.loads(entry)
+        rows.append((state_key, int(entry['date']), int(entry['sgv']), entry.get('direction'), entry.get('delta'),
+                     enqueued_at))
+    conn.executemany("""
+        INSERT OR IGNORE INTO outbox_readings (state_key, date, sgv, direction, delta, enqueued_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.execute("DROP TABLE outbox")
+
+def get_state_key(user_config):
+    """Ключ состояния мастера: config_key + fromUserId"""
+    return f"{user_config['config_key']}:{user_config['from_user_id']}"
+
+def load_sync_state(state_key):
+    """
+    Последняя отметка мастера (записи до неё уже в Nightscout или в очереди
+    отправки) или None, если мастер ещё не синхронизировался
+    """
+    with _state_db['lock']:
+        row = _get_connection().execute(
+            "SELECT last_monitor_time, last_data_no FROM sync_state WHERE state_key = ?",
+            (state_key,)
+        ).fetchone()
+
+    if row is None:
+        return None
+
+    return {'last_monitor_time': row[0], 'last_data_no': row[1]}
+
+def load_latest_monitor_time():
+    """Самая свежая отметка среди всех мастеров (мс) или None"""
+    with _state_db['lock']:
+        row = _get_connection().execute("SELECT MAX(last_monitor_time) FROM sync_state").fetchone()
+
+    return row[0] if row else None
+
+def save_sync_state(state_key, last_monitor_time, last_data_no=None):
+    """Сохранение отметки (только вперёд — отметка никогда не уменьшается)"""
+    with _state_db['lock']:
+        conn = _get_connection()
+        conn.execute("""
+            INSERT INTO sync_state (state_key, last_monitor_time, last_data_no, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(state_key) DO UPDATE SET
+                last_monitor_time = excluded.last_monitor_time,
+                last_data_no = COALESCE(excluded.last_data_no, sync_state.last_data_no),
+                updated_at = excluded.updated_at
+            WHERE excluded.last_monitor_time > sync_state.last_monitor_time
+        """, (state_key, int(last_monitor_time), last_data_no, int(time.time())))
+        conn.commit()
+
+def load_backfill_progress(job_key):
+    """Начала уже загруженных окон бэкфилла (мс)"""
+    with _state_db['lock']:
+        rows = _get_connection().execute(
+            "SELECT window_start FROM backfill_progress WHERE job_key = ?",
+            (job_key,)
+        ).fetchall()
+
+    return {row[0] for row in rows}
+
+def mark_backfill_window_done(job_key, window_start):
+    """Отметка окна бэкфилла как полностью загруженного"""
+    with _state_db['lock']:
+        conn = _get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO backfill_progress (job_key, window_start, completed_at) VALUES (?, ?, ?)",
+            (job_key, int(window_start), int(time.time()))
+        )
+        conn.commit()
+
+# ========== ОЧЕРЕДЬ ОТПРАВКИ В NIGHTSCOUT (OUTBOX) ==========
+# Подготовленные записи сохраняются здесь до подтверждения Nightscout (200),
+# поэтому недоступность Nightscout дольше HOURS_AGO не теряет данные.
+# Хранятся колонки ReadingStore (время, sgv, направление, delta): словари
+# записей создаются только при отправке
+
+def enqueue_outbox(state_key, entries, max_entries):
+    """
+    Добавление показаний ReadingStore в очередь мастера (повторная запись с тем же date заменяется).
+    Если в очереди больше max_entries записей, самые старые удаляются.
+    Возвращает (глубина очереди, удалено старых записей)
+    """
+    now = int(time.time())
+    with _state_db['lock']:
+        conn = _get_connection()
+        conn.executemany("""
+            INSERT OR REPLACE INTO outbox_readings (state_key, date, sgv, direction, delta, enqueued_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, [(state_key, date, sgv, direction, delta, now) for date, sgv, direction, delta in entries.rows()])
+        depth = conn.execute("SELECT COUNT(*) FROM outbox_readings WHERE state_key = ?", (state_key,)).fetchone()[0]
+        dropped = 0
+        if depth > max_entries:
+            dropped = conn.execute("""
+                DELETE FROM outbox_readings WHERE state_key = ? AND date IN (
+                    SELECT date FROM outbox_readings WHERE state_key = ? ORDER BY date LIMIT ?
+                )
+            """, (state_key, state_key, depth - max_entries)).rowcount
+            depth -= dropped
+        conn.commit()
+
+    return depth, dropped
+
+def load_outbox(state_key, limit, device):
+    """
+    Самые старые записи очереди мастера (не больше limit) — ReadingStore
+    с устройством device, упорядоченный по времени
+    """
+    with _state_db['lock']:
+        rows = _get_connection().execute(
+            "SELECT date, sgv, direction, delta FROM outbox_readings WHERE state_key = ? ORDER BY date LIMIT ?",
+            (state_key, limit)
+        ).fetchall()
+
+    store = ReadingStore(device)
+    for date, sgv, direction, delta in rows:
+        store.append_prepared(date, sgv, direction, delta)
+    return store
+
+def ack_outbox(state_key, dates):
+    """Удаление подтверждённых записей; возвращает оставшуюся глубину очереди"""
+    with _state_db['lock']:
+        conn = _get_connection()
+        conn.executemany("DELETE FROM outbox_readings WHERE state_key = ? AND date = ?",
+                         [(state_key, int(date)) for date in dates])
+        conn.commit()
+        return conn.execute("SELECT COUNT(*) FROM outbox_readings WHERE state_key = ?", (state_key,)).fetchone()[0]
+
+def outbox_depths():
+    """Глубина очереди по мастерам: {state_key: число записей}"""
+    with _state_db['lock']:
+        rows = _get_connection().execute(
+            "SELECT state_key, COUNT(*) FROM outbox_readings GROUP BY state_key"
+        ).fetchall()
+
+    return dict(rows)
+
+# ========== ПОСЛЕДНИЙ ПОЛУЧЕННЫЙ СПИСОК МАСТЕРОВ ==========
+# Используется, если Ottai не вернул список (ошибка при запуске)
+
+def save_user_list(account, users):
+    """Сохранение списка мастеров аккаунта фолловера из Ottai"""
+    with _state_db['lock']:
+        conn = _get_connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO user_lists (account, users, updated_at) VALUES (?, ?, ?)",
+            (account, json.dumps(users, ensure_ascii=False, separators=(',', ':')), int(time.time()))
+        )
+        conn.commit()
+
+def load_user_list(account):
+    """Последний сохранённый список мастеров аккаунта: (users, время сохранения) или (None, None)"""
+    with _state_db['lock']:
+        row = _get_connection().execute("SELECT users, updated_at FROM user_lists WHERE account = ?",
+                                        (account,)).fetchone()
+
+    if row is None:
+        return None, None
+
+    return json.loads(row[0]), row[1]
+
+def close_state_store():
+    """Закрытие базы состояния"""
+    with _state_db['lock']:
+        if _state_db['conn'] is not None:
+            _state_db['conn'].close()
+            _state_db['conn'] = None
@@ -0,0 +1,71 @@
+import collections
+
+# ========== НАПРАВЛЕНИЕ ТРЕНДА ==========
+# Ottai не передаёт тренд в curveList, поэтому направление и delta
+# считаются по скользящему окну последних показаний мастера
+
+# Окно: текущее показание + два предыдущих (~10 минут при шаге 5 минут)
+TREND_WINDOW_SIZE = 3
+
+# Показания старше этого не используются для расчёта (мс)
+TREND_MAX_GAP_MS = 15 * 60 * 1000
+
+# Nightscout считает delta за 5 минут
+DELTA_PERIOD_MS = 5 * 60 * 1000
+
+def direction_from_rate(rate):
+    """Направление Nightscout по скорости изменения (мг/дл в минуту)"""
+    if rate > 3:
+        return 'DoubleUp'
+    if rate > 2:
+        return 'SingleUp'
+    if rate > 1:
+        return 'FortyFiveUp'
+    if rate >= -1:
+        return 'Flat'
+    if rate >= -2:
+        return 'FortyFiveDown'
+    if rate >= -3:
+        return 'SingleDown'
+    return 'DoubleDown'
+
+class TrendWindow:
+    """
+    Скользящее окно последних показаний мастера (date, sgv).
+    Каждое новое показание обрабатывается за O(1): окно фиксированного размера,
+    полный пересчёт истории не выполняется
+    """
+
+    __slots__ = ('readings',)
+
+    def __init__(self):
+        self.readings = collections.deque(maxlen=TREND_WINDOW_SIZE)
+
+    def _history_before(self, date):
+        """Показания окна строго до date в пределах TREND_MAX_GAP_MS (от старых к новым)"""
+        return [(reading_date, sgv) for reading_date, sgv in self.readings
+                if reading_date < date and date - reading_date <= TREND_MAX_GAP_MS]
+
+    def push(self, date, sgv):
+        """
+        Добавление показания. Возвращает (direction, delta) или (None, None),
+        если предыдущих показаний рядом нет
+        """
+        history = self._history_before(date)
+
+        # Новые показания добавляем в окно; повторно обработанные (перекрытие окна
+        # загрузки, повтор после ошибки отправки) считаются по той же истории
+        if not self.readings or date > self.readings[-1][0]:
+            self.readings.append((date, sgv))
+
+        if not history:
+            return None, None
+
+        prev_date, prev_sgv = history[-1]
+        delta = (sgv - prev_sgv) * DELTA_PERIOD_MS / (date - prev_date)
+
+        # Направление — по самому старому показанию окна (сглаживает шум датчика)
+        first_date, first_sgv = history[0]
+        rate = (sgv - first_sgv) / ((date - first_date) / 60000)
+
+        return direction_from_rate(rate), round(delta, 1)